@@ -9,7 +9,6 @@ from visualisation_functions import cost_flight_vs_avg, create_flight_map,co2_fl
 from db_connections import get_data_as_dataframe, SQLconnection
 from conversion_metrics import get_most_recent_flight_info
 from conversion_metrics import get_celeb_info, get_total_number_of_flights, get_flight_time
-from conversion_metrics import get_flight_cost, get_flight_co2
 from conversion_metrics import get_new_infographic_text
 from conversion_metrics import CELEB_DROPDOWN_OPTIONS
 
@@ -40,8 +39,7 @@ most_recent_flights= get_most_recent_flight_info(owner_initial, flight_df, aircr
 recent_co2, recent_cost, recent_fuel, recent_time = 0,0,0,0
 
 
-dep_time, arr_time = most_recent_flights['dep_time'][0],most_recent_flights['arr_time'][0]
-recent_display, recent_time = get_flight_time(dep_time, arr_time)
+recent_display, recent_time = get_flight_time(most_recent_flights['flight_hours'][0])
 
 # HTML document
 app.layout = html.Div(
@@ -175,12 +173,11 @@ def swap_celebrity(dropdown_value:str):
     flight_fig, weekday_fig = default_flight_fig(), default_empty_fig()
 
     if most_recent_flights['fuel_usage'] != {}:
-        recent_cost = get_flight_cost(most_recent_flights['fuel_usage'][0])
-        recent_co2 =  get_flight_co2(most_recent_flights['fuel_usage'][0])
+        recent_cost = round(most_recent_flights['fuel_cost'][0], 2)
+        recent_co2 = round(most_recent_flights['co2_emissions'][0], 2)
         recent_fuel = round(most_recent_flights['fuel_usage'][0])
 
-        d_time,a_time = most_recent_flights['dep_time'][0],most_recent_flights['arr_time'][0]
-        recent_display, recent_time = get_flight_time(d_time, a_time)
+        recent_display, recent_time = get_flight_time(most_recent_flights['flight_hours'][0])
 
         flight_cost_string += f"${recent_cost}"
         flight_co2_string += f"{recent_co2} mtCO2"
@@ -265,13 +262,11 @@ def recalculate_flight_data(flight_idx:int):
     flight_fig, weekday_fig = default_flight_fig(), default_empty_fig()
 
     if most_recent_flights['fuel_usage'] != {}:
-        recent_cost = get_flight_cost(most_recent_flights['fuel_usage'][flight_idx])
-        recent_co2 =  get_flight_co2(most_recent_flights['fuel_usage'][flight_idx])
+        recent_cost = round(most_recent_flights['fuel_cost'][flight_idx], 2)
+        recent_co2 = round(most_recent_flights['co2_emissions'][flight_idx], 2)
         recent_fuel = round(most_recent_flights['fuel_usage'][flight_idx])
 
-        d_time = most_recent_flights['dep_time'][flight_idx]
-        a_time = most_recent_flights['arr_time'][flight_idx]
-        recent_display, recent_time = get_flight_time(d_time, a_time)
+        recent_display, recent_time = get_flight_time(most_recent_flights['flight_hours'][flight_idx])
 
         flight_cost_string += f"${recent_cost}"
         flight_co2_string += f"{recent_co2} mtCO2"
@@ -17,9 +17,7 @@ CELEB_DROPDOWN_OPTIONS=[{"label": "Elon Musk", "value": "elon_musk",}, {"label":
                         {"label": "Mark Wahlberg", "value": "mark_wahlberg",}, {"label": "A-Rod", "value": "a_rod",},
                         ]
 
-CO2_PER_GALLON = 0.01 #mtCO2 i.e metric tons of co2
 AVG_CO2_COMMUTE = 0.00496 #mtCo2 src: https://www.climatepartner.com/en/news/how-sustainable-commuting-can-improve-a-company-carbon-footprint#:~:text=Due%20to%20its%20significant%20impact,per%20commuting%20employee%20per%20day.
-AVG_FUEL_COST = 5.91 #https://www.airnav.com/fuel/report.html
 
 
 def get_age_from_birthdate(birthdate: np.datetime64) -> int:
@@ -56,7 +54,7 @@ def get_most_recent_flight_info(owner:DataFrame, flight_df: DataFrame, aircraft_
     combined_df = pd.merge(combined_df, airport, left_on= "arr_airport_id", right_on="airport_id", suffixes=("_dep_airport","_arr_airport"))
 
     fuel_df = combined_df.filter([
-        "fuel_usage","lat_dep_airport","lon_dep_airport",
+        "fuel_usage","fuel_cost","co2_emissions","flight_hours","lat_dep_airport","lon_dep_airport",
         "lat_arr_airport","lon_arr_airport", "dep_time", "arr_time"]).head(100)
 
     return fuel_df.to_dict()
@@ -84,20 +82,12 @@ def get_celeb_info(name: str, owner_df:DataFrame, gender_df:DataFrame) -> list[s
     return [name, gender, age, worth]
 
 
-def get_flight_cost(gallons:float) -> float:
-    """ Gives the cost of the flight in dollars """
-    return round(AVG_FUEL_COST * gallons,2)
+def get_flight_time(flight_hours: float) -> tuple[str, float]:
+    """ Gets the flight time as hours and minutes from the flight hours stored by transform """
+    num_hrs = floor(flight_hours)
+    num_mins = int(flight_hours * 60) - num_hrs*60
 
-def get_flight_co2(gallons:float) -> float:
-    """ Returns the co2 output of a flight """
-    return round(CO2_PER_GALLON * gallons, 2)
-
-def get_flight_time(departure, arrival) -> str:
-    """ Get the flight time from the flight data """
-    num_hrs = floor((arrival.to_pydatetime() - departure.to_pydatetime()).seconds/(3600))
-    num_mins = int((arrival.to_pydatetime() - departure.to_pydatetime()).seconds/(60)) - num_hrs*60
-    
-    return f"{num_hrs} hrs, {num_mins} mins", (arrival.to_pydatetime() - departure.to_pydatetime()).seconds/3600
+    return f"{num_hrs} hrs, {num_mins} mins", flight_hours
 
 
 
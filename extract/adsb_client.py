@@ -0,0 +1,184 @@
+""" This module bounds the time a run spends waiting on the ADS-B Exchange API. Every request of a
+    run shares one deadline budget, slow requests are hedged with a second one, throttled (429) and
+    server (5xx) errors are retried with exponential backoff, and a circuit breaker fails requests
+    fast while the API keeps failing, so a run returns partial results instead of timing out
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+import random
+import time
+import requests
+
+
+class DeadlineExceeded(requests.Timeout):
+    """ The run's deadline budget ran out before the request could be answered """
+
+
+class CircuitOpenError(requests.RequestException):
+    """ The circuit breaker is open, so the request wasn't sent """
+
+
+class DeadlineBudget():
+    """ A deadline shared by every request of a run """
+    def __init__(self, seconds: float) -> None:
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """ Seconds left before the deadline, never negative """
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        """ Whether the deadline has passed """
+        return self.remaining() == 0
+
+
+class CircuitBreaker():
+    """ Opens after failure_threshold failures in a row, rejecting requests for reset_timeout
+        seconds. After that a single trial request is let through (half-open), which closes the
+        breaker again on success or re-opens it on failure
+    """
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = Lock()
+
+    @property
+    def state(self) -> str:
+        """ "closed", "open" or "half-open" """
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def allow(self) -> bool:
+        """ Whether a request may be sent now """
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """ Closes the breaker """
+        with self.lock:
+            self.failures, self.opened_at, self.trial_running = 0, None, False
+
+    def record_failure(self) -> None:
+        """ Counts a failure, opening the breaker at the threshold or when the trial request failed """
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit breaker opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def record_abandoned(self) -> None:
+        """ A request given up on by its own run (out of budget) says nothing about the API, so
+            it isn't counted, but a trial request lets the next one through
+        """
+        with self.lock:
+            self.trial_running = False
+
+
+def is_retryable(response: requests.Response) -> bool:
+    """ Throttling and server errors are worth retrying, other errors aren't """
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class AdsbClient():
+    """ Wraps get(icao, session, timeout) -> requests.Response with the run's deadline budget,
+        hedging, retries and a circuit breaker. get_flight has the signature of the other fetch
+        functions, returning the decoded response or raising a requests.RequestException.
+        Requests are sent from the executor given, which outlives the client, or from one of its own
+    """
+    def __init__(self, get, budget: DeadlineBudget, breaker: CircuitBreaker, timeout: float = 10,
+                 hedge_after: float = 2, hedge_ratio: float = 0.1, max_attempts: int = 3, backoff: float = 0.5,
+                 max_workers: int = 32, executor: ThreadPoolExecutor = None) -> None:
+        self.get = get
+        self.budget = budget
+        self.breaker = breaker
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.hedge_ratio = hedge_ratio
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.requests_sent = 0
+        self.hedges_sent = 0
+        self.lock = Lock()
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="adsb")
+
+    def may_hedge(self) -> bool:
+        """ Hedges are capped at hedge_ratio of the requests sent, so they can't double the API usage """
+        with self.lock:
+            if self.hedges_sent + 1 > self.hedge_ratio * self.requests_sent:
+                return False
+            self.hedges_sent += 1
+            return True
+
+    def submit(self, icao: str, session: requests.Session):
+        """ Sends one request in the background, with a timeout cut to the remaining budget """
+        with self.lock:
+            self.requests_sent += 1
+        return self.executor.submit(self.get, icao, session, min(self.timeout, self.budget.remaining()))
+
+    def send(self, icao: str, session: requests.Session) -> requests.Response:
+        """ Sends a request, and a second one if the first is still outstanding after hedge_after
+            seconds, returning whichever answers first
+        """
+        futures = [self.submit(icao, session)]
+        done, _ = wait(futures, timeout=min(self.hedge_after, self.budget.remaining()))
+        if not done and not self.budget.expired() and self.may_hedge():
+            futures.append(self.submit(icao, session))
+        if not done:
+            done, _ = wait(futures, timeout=self.budget.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded(f"Deadline reached waiting for {icao}")
+        return done.pop().result()
+
+    def get_retry_delay(self, attempt: int, response: requests.Response = None) -> float:
+        """ Exponential backoff with full jitter, or the API's Retry-After when it gives one """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, self.backoff * 2**attempt)
+
+    def get_flight(self, icao: str, session: requests.Session = None) -> dict:
+        """ The current flight info of an ICAO """
+        for attempt in range(self.max_attempts):
+            if self.budget.expired():
+                raise DeadlineExceeded(f"Deadline reached before fetching {icao}")
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit breaker open, not fetching {icao}")
+
+            response = None
+            try:
+                response = self.send(icao, session)
+            except DeadlineExceeded:
+                # The run ran out of budget, which isn't the API failing
+                self.breaker.record_abandoned()
+                raise
+            except (requests.ConnectionError, requests.Timeout):
+                self.breaker.record_failure()
+                if attempt == self.max_attempts - 1:
+                    raise
+            else:
+                if not is_retryable(response):
+                    self.breaker.record_success()
+                    response.raise_for_status()
+                    return response.json()
+                self.breaker.record_failure()
+                if attempt == self.max_attempts - 1:
+                    response.raise_for_status()
+
+            delay = self.get_retry_delay(attempt, response)
+            if delay >= self.budget.remaining():
+                raise DeadlineExceeded(f"Deadline reached before retrying {icao}")
+            time.sleep(delay)
+
+        raise DeadlineExceeded(f"No attempts left for {icao}")
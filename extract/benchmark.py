@@ -0,0 +1,106 @@
+""" Benchmarks for the extract pipeline, run against the DB configured in .env:
+
+        python benchmark.py writers [number of rows]
+        python benchmark.py pipeline [number of aircraft] [number of 10 minute polls]
+
+    The staging writers are compared on a scratch copy of the staging table, which is dropped afterwards.
+    The pipeline benchmark flies synthetic aircraft through extract into staging, then runs transform on it
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+import sqlalchemy as sql
+
+from extract import config, get_flights_for_all_celebs_concurrently, write_staging_rows
+from db_connection import SQL, STAGING_COLUMNS
+from records import build_staging_rows
+from replay import SyntheticProvider
+
+
+BENCHMARK_TABLE = "tracked_event_benchmark"
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../data")
+TRANSFORM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../transform")
+
+
+def make_staging_rows(n_rows: int) -> list[tuple]:
+    """ Makes n_rows of plausible looking staging rows, ordered like STAGING_COLUMNS """
+    start = datetime.utcnow()
+    return [(start + timedelta(seconds=i), f"N{i % 500}", f"N{i % 500}", "GLF6",
+             random.randint(0, 45000), random.randint(0, 45000), random.uniform(0, 500),
+             random.uniform(0, 360), random.uniform(-3000, 3000), "none",
+             random.uniform(-90, 90), random.uniform(-180, 180)) for i in range(n_rows)]
+
+
+def time_writer(name: str, write, n_rows: int) -> float:
+    """ Times a single call of write and prints its throughput in rows per second """
+    started = time.perf_counter()
+    write()
+    elapsed = time.perf_counter() - started
+    print(f"{name:>10}: {n_rows} rows in {elapsed:.2f}s ({n_rows / elapsed:,.0f} rows/s)")
+    return elapsed
+
+
+def benchmark_staging_writers(n_rows: int) -> None:
+    """ Compares DataFrame.to_sql with the COPY based writer """
+    sql_conn = SQL(config)
+    schema = config["STAGING_SCHEMA"]
+    rows = make_staging_rows(n_rows)
+    data = pd.DataFrame(rows, columns=STAGING_COLUMNS)
+
+    with sql_conn.engine.begin() as conn:
+        conn.execute(sql.text(f"""CREATE TABLE {schema}.{BENCHMARK_TABLE}
+                                  (LIKE {schema}.{config["STAGING_TABLE_NAME"]} INCLUDING ALL)"""))
+    try:
+        time_writer("to_sql", lambda: sql_conn.write_df_to_table(data, BENCHMARK_TABLE, schema), n_rows)
+        time_writer("COPY", lambda: sql_conn.copy_rows_to_table(rows, STAGING_COLUMNS, BENCHMARK_TABLE, schema),
+                    n_rows)
+    finally:
+        with sql_conn.engine.begin() as conn:
+            conn.execute(sql.text(f"DROP TABLE {schema}.{BENCHMARK_TABLE}"))
+
+
+def benchmark_pipeline(n_aircraft: int, polls: int) -> None:
+    """ Polls n_aircraft synthetic aircraft every 10 (simulated) minutes into staging, ending an
+        hour ago so their flights count as complete, then times a transform run over the result
+    """
+    provider = SyntheticProvider(n_aircraft, speed=0, start=datetime.utcnow() - timedelta(minutes=10 * polls + 60))
+    celebs = provider.get_celebs()
+
+    latencies, rows_written = [], 0
+    for _ in range(polls):
+        started = time.perf_counter()
+        flights = get_flights_for_all_celebs_concurrently(celebs, fetch=provider.get_flight)
+        rows_written += write_staging_rows(build_staging_rows(list(flights.values())))
+        latencies.append(time.perf_counter() - started)
+        provider.clock.advance(10 * 60)
+
+    latencies.sort()
+    print(f"   extract: {polls} polls of {n_aircraft} aircraft, {rows_written} rows written, "
+          f"{n_aircraft * polls / sum(latencies):,.0f} aircraft/s, poll latency p50 {statistics.median(latencies):.2f}s "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.2f}s")
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        for file_name in ("airports.json", "aircraft_fuel_consumption_rates.json"):
+            shutil.copy(os.path.join(DATA_DIR, file_name), data_dir)
+        with open(os.path.join(data_dir, "celeb_planes.json"), "w", encoding="utf-8") as file:
+            json.dump(celebs, file)
+
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "transform.py"], cwd=TRANSFORM_DIR, check=True, stdout=subprocess.DEVNULL,
+                       env={**os.environ, "LOCAL_DATA_DIR": data_dir})
+        print(f" transform: {rows_written} staging rows in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "pipeline":
+        benchmark_pipeline(int(sys.argv[2]) if len(sys.argv) > 2 else 100, int(sys.argv[3]) if len(sys.argv) > 3 else 36)
+    else:
+        benchmark_staging_writers(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
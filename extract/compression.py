@@ -0,0 +1,61 @@
+""" This module drops the staging samples that add nothing to a flight's track. A sample within
+    the dead-band of the previous stored point is merged into the flight's last row instead of
+    being stored as a new one, so each flight still keeps its exact first and last points
+"""
+from db_connection import STAGING_COLUMNS
+
+
+TIME, FLIGHT_NO, AIRCRAFT_REG = (STAGING_COLUMNS.index(column) for column in ("time_input", "flight_no", "aircraft_reg"))
+ALTITUDE, TRACK, EMERGENCY = (STAGING_COLUMNS.index(column) for column in ("barometric_alt", "true_track", "emergency"))
+LAT, LON = STAGING_COLUMNS.index("lat"), STAGING_COLUMNS.index("lon")
+
+DEFAULT_DEAD_BAND = {"lat_lon": 0.01, "altitude": 250, "track": 5}
+
+
+def is_within_dead_band(row: tuple, reference: tuple, dead_band: dict) -> bool:
+    """ Whether a staging row is close enough to a reference row to be left out of the track.
+        Missing values or a change of emergency status always count as a change
+    """
+    compared = (row[LAT], row[LON], row[ALTITUDE], row[TRACK],
+                reference[LAT], reference[LON], reference[ALTITUDE], reference[TRACK])
+    if any(value is None for value in compared) or row[EMERGENCY] != reference[EMERGENCY]:
+        return False
+
+    track_change = abs(row[TRACK] - reference[TRACK]) % 360
+    return (abs(row[LAT] - reference[LAT]) <= dead_band["lat_lon"]
+            and abs(row[LON] - reference[LON]) <= dead_band["lat_lon"]
+            and abs(row[ALTITUDE] - reference[ALTITUDE]) <= dead_band["altitude"]
+            and min(track_change, 360 - track_change) <= dead_band["track"])
+
+
+def compress_staging_rows(rows: list[tuple], tails: dict[tuple, list[tuple]],
+                          dead_band: dict = None) -> tuple[list[tuple], dict[int, tuple]]:
+    """ Splits new staging rows into the rows to insert and the stored rows to overwrite.
+        tails holds up to the last two stored (event_id, row) pairs of each (aircraft_reg, flight_no),
+        oldest first. A row is merged into the flight's last point when both of them are within the
+        dead-band of the point before, which is never the case for a flight's first point.
+        Returns the rows to insert and the rows to update keyed by event_id
+    """
+    dead_band = dead_band or DEFAULT_DEAD_BAND
+    inserts, updates = [], {}
+    # each point is [event_id or None, row, index in inserts or None]
+    flight_tails = {key: [[event_id, row, None] for event_id, row in tail] for key, tail in tails.items()}
+
+    for row in sorted(rows, key=lambda row: row[TIME]):
+        tail = flight_tails.setdefault((row[AIRCRAFT_REG], row[FLIGHT_NO]), [])
+
+        if len(tail) == 2 and is_within_dead_band(row, tail[0][1], dead_band) \
+                and is_within_dead_band(tail[1][1], tail[0][1], dead_band):
+            last = tail[1]
+            last[1] = row
+            if last[2] is not None:
+                inserts[last[2]] = row
+            else:
+                updates[last[0]] = row
+            continue
+
+        inserts.append(row)
+        tail.append([None, row, len(inserts) - 1])
+        del tail[:-2]
+
+    return inserts, updates
@@ -1,7 +1,37 @@
 """ This module is responsible for sending collected data to the staging DB """
+from datetime import date, datetime, timedelta
+from io import StringIO
+from typing import TYPE_CHECKING
+import csv
+from psycopg2.extras import execute_batch
 import sqlalchemy as sql
 from sqlalchemy.engine.base import Engine
-from pandas import DataFrame
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+STAGING_COLUMNS = ["time_input", "flight_no", "aircraft_reg", "model", "barometric_alt", "geometric_alt",
+                   "ground_speed", "true_track", "barometric_alt_roc", "emergency", "lat", "lon"]
+
+# Upserts the adaptive polling state of an aircraft
+POLL_STATE_QUERY = """INSERT INTO {schema}.aircraft_poll_state
+    (icao_hex, last_polled, last_seen, airborne, phase, last_alt, last_speed, last_reg, next_poll)
+    VALUES (%(icao_hex)s, %(last_polled)s, %(last_seen)s, %(airborne)s, %(phase)s, %(last_alt)s, %(last_speed)s,
+            %(last_reg)s, %(next_poll)s)
+    ON CONFLICT (icao_hex) DO UPDATE SET
+    last_polled = EXCLUDED.last_polled, last_seen = EXCLUDED.last_seen,
+    airborne = EXCLUDED.airborne, phase = EXCLUDED.phase, last_alt = EXCLUDED.last_alt,
+    last_speed = EXCLUDED.last_speed, last_reg = EXCLUDED.last_reg, next_poll = EXCLUDED.next_poll"""
+# Landings spotted by extract, for transform to close the flights they end
+LANDING_QUERY = """INSERT INTO {schema}.landing (aircraft_reg, landed_at)
+    VALUES (%(aircraft_reg)s, %(landed_at)s) ON CONFLICT DO NOTHING"""
+
+# Engines are kept for the life of the process, so warm lambda invocations reuse the connection pool
+engines: dict[str, Engine] = {}
+# Days whose staging partition is known to exist, so that each is only created once per process
+staging_partitions: set[date] = set()
+
 
 class SQL():
     """ This holds the interaction with the DB for ease of use """
@@ -14,22 +44,140 @@ class SQL():
         self.engine = self.create_engine(config["DB_HOST"], config["DB_USER"],
                                          config["DB_PASSWORD"], config["DB_NAME"])
 
-    def write_df_to_table(self, data: DataFrame, table:str, schema:str, if_exists:str='append'):
+    def write_df_to_table(self, data: "DataFrame", table:str, schema:str, if_exists:str='append'):
         """ Writes a given DataFrame to an SQL table and schema """
-        data.to_sql(name=table, con=self.engine.connect(), schema=schema,
-                    if_exists='append', index=False)
+        with self.engine.begin() as conn:
+            data.to_sql(name=table, con=conn, schema=schema, if_exists=if_exists, index=False)
 
+    def copy_rows_to_table(self, rows: list[tuple], columns: list[str], table: str, schema: str,
+                           updates: dict[int, tuple] = None, statements: list[tuple[str, list]] = None) -> None:
+        """ Bulk loads rows (tuples ordered like columns) into a table with COPY FROM STDIN,
+            streamed from an in-memory CSV buffer. None is written as NULL. Any updates
+            (rows keyed by event_id) and further (query, parameter list) statements are
+            applied in the same transaction
+        """
+        buffer = StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        copy_query = f"COPY {schema}.{table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        update_query = f"""UPDATE {schema}.{table} SET {', '.join(f'{column} = %s' for column in columns)}
+                           WHERE event_id = %s"""
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as curs:
+                if updates:
+                    execute_batch(curs, update_query, [(*row, event_id) for event_id, row in updates.items()])
+                curs.copy_expert(copy_query, buffer)
+                for query, params in statements or []:
+                    execute_batch(curs, query, params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
     def create_engine(self, host, username, password, db_name) -> Engine:
-        """ Creates a DB engine from .env parameters """
-        return sql.create_engine(f'postgresql://{username}:{password}@{host}/{db_name}')
+        """ Creates a DB engine from .env parameters, or reuses the one already made for them """
+        url = f'postgresql+psycopg2://{username}:{password}@{host}/{db_name}'
+        if url not in engines:
+            engines[url] = sql.create_engine(url, pool_pre_ping=True)
+        return engines[url]
+
 
+def get_partition_name(table: str, day: date) -> str:
+    """ The name of a table's daily partition, e.g. tracked_event_20230615 """
+    return f"{table}_{day:%Y%m%d}"
 
 
-def push_to_staging_database(config: dict, data: DataFrame):
-    """ Create staging DB if not exists, then push 
-        combined data file to staging DB 
+def ensure_staging_partitions(config: dict, days: set[date]) -> None:
+    """ Creates the daily partitions of the staging table for the given days, unless they exist.
+        An advisory lock stops concurrent shards racing to create the same partition
     """
+    missing = days - staging_partitions
+    if not missing:
+        return
     sql_conn = SQL(config)
     table, schema = config["STAGING_TABLE_NAME"], config["STAGING_SCHEMA"]
-    sql_conn.write_df_to_table(data=data, table=table, schema=schema)
\ No newline at end of file
+    with sql_conn.engine.begin() as conn:
+        conn.execute(sql.text("SELECT pg_advisory_xact_lock(hashtext(:table))"), {"table": f"{schema}.{table}"})
+        for day in sorted(missing):
+            conn.execute(sql.text(f"""CREATE TABLE IF NOT EXISTS {schema}.{get_partition_name(table, day)}
+                                      PARTITION OF {schema}.{table}
+                                      FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')"""))
+    staging_partitions.update(missing)
+
+
+def push_to_staging_database(config: dict, rows: list[tuple], updates: dict[int, tuple] = None,
+                             landings: list[tuple] = None, poll_state: dict[str, dict] = None):
+    """ Pushes staging rows (tuples ordered like STAGING_COLUMNS) to the staging DB, overwriting
+        the stored rows in updates (keyed by event_id) at the same time. The daily partitions
+        the rows fall in are created first if need be. The (aircraft_reg, landed_at) landings
+        and the poll state of the aircraft polled are saved in the same transaction, so a run
+        whose rows aren't written doesn't move the poll state past a landing it spotted
+    """
+    sql_conn = SQL(config)
+    table, schema = config["STAGING_TABLE_NAME"], config["STAGING_SCHEMA"]
+    ensure_staging_partitions(config, {row[0].date() for row in [*rows, *(updates or {}).values()]})
+
+    statements = []
+    if landings:
+        statements.append((LANDING_QUERY.format(schema=schema),
+                           [{"aircraft_reg": aircraft_reg, "landed_at": landed_at} for aircraft_reg, landed_at in landings]))
+    if poll_state:
+        statements.append((POLL_STATE_QUERY.format(schema=schema),
+                           [{"icao_hex": icao, **state} for icao, state in poll_state.items()]))
+    sql_conn.copy_rows_to_table(rows, STAGING_COLUMNS, table, schema, updates, statements)
+
+
+def load_staging_tails(config: dict, aircraft_regs: set[str]) -> dict[tuple, list[tuple]]:
+    """ Reads the last two stored (event_id, row) pairs of every flight of the given aircraft,
+        keyed by (aircraft_reg, flight_no) and oldest first
+    """
+    if not aircraft_regs:
+        return {}
+    sql_conn = SQL(config)
+    table, schema = config["STAGING_TABLE_NAME"], config["STAGING_SCHEMA"]
+    query = sql.text(f"""SELECT event_id, {', '.join(STAGING_COLUMNS)} FROM (
+                             SELECT *, ROW_NUMBER() OVER (PARTITION BY aircraft_reg, flight_no
+                                                          ORDER BY time_input DESC, event_id DESC) AS position
+                             FROM {schema}.{table} WHERE aircraft_reg = ANY(:aircraft_regs)) AS latest
+                         WHERE position <= 2 ORDER BY time_input, event_id""")
+    with sql_conn.engine.connect() as conn:
+        rows = conn.execute(query, {"aircraft_regs": list(aircraft_regs)}).all()
+
+    tails = {}
+    for event_id, *row in rows:
+        record = dict(zip(STAGING_COLUMNS, row))
+        tails.setdefault((record["aircraft_reg"], record["flight_no"]), []).append((event_id, tuple(row)))
+    return tails
+
+
+def load_poll_state(config: dict) -> dict[str, dict]:
+    """ Reads the adaptive polling state of every aircraft, keyed by ICAO """
+    sql_conn = SQL(config)
+    query = sql.text(f"""SELECT icao_hex, last_polled, last_seen, airborne, phase, last_alt, last_speed, last_reg, next_poll
+                         FROM {config["STAGING_SCHEMA"]}.aircraft_poll_state""")
+    with sql_conn.engine.connect() as conn:
+        rows = conn.execute(query).mappings().all()
+    return {row["icao_hex"]: {key: value for key, value in row.items() if key != "icao_hex"} for row in rows}
+
+
+def load_api_budget(config: dict, name: str) -> tuple[float, datetime] | None:
+    """ Reads the tokens left in the named API budget and when it was last updated """
+    sql_conn = SQL(config)
+    query = sql.text(f"SELECT tokens, updated_at FROM {config['STAGING_SCHEMA']}.api_budget WHERE name = :name")
+    with sql_conn.engine.connect() as conn:
+        row = conn.execute(query, {"name": name}).first()
+    return tuple(row) if row else None
+
+
+def save_api_budget(config: dict, name: str, tokens: float, updated_at: datetime) -> None:
+    """ Stores the tokens left in the named API budget """
+    sql_conn = SQL(config)
+    query = sql.text(f"""INSERT INTO {config["STAGING_SCHEMA"]}.api_budget (name, tokens, updated_at)
+                         VALUES (:name, :tokens, :updated_at)
+                         ON CONFLICT (name) DO UPDATE SET tokens = EXCLUDED.tokens, updated_at = EXCLUDED.updated_at""")
+    with sql_conn.engine.begin() as conn:
+        conn.execute(query, {"name": name, "tokens": tokens, "updated_at": updated_at})
\ No newline at end of file
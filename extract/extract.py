@@ -1,40 +1,159 @@
 """ This module runs the extraction process for the celebrity plane current flight data """
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from datetime import datetime
 import os
 import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import boto3
-import pandas as pd
+from botocore.exceptions import ClientError
 
-from pandas import DataFrame
 from dotenv import load_dotenv
-from db_connection import push_to_staging_database
+from db_connection import push_to_staging_database, load_poll_state
+from db_connection import load_api_budget, save_api_budget, load_staging_tails
+from scheduler import TokenBucket, select_icaos_to_poll, update_poll_state
+from records import build_staging_rows, build_staging_record
+from compression import compress_staging_rows, AIRCRAFT_REG
+from replay import get_provider, ResponseRecorder
+from sharding import partition_celebs
+from adsb_client import AdsbClient, CircuitBreaker, DeadlineBudget
+from landings import detect_landing
 
 
 load_dotenv()
 config=os.environ
 
+MAX_CONCURRENT_REQUESTS = int(config.get("MAX_CONCURRENT_REQUESTS", 16))
+BATCH_DEADLINE_SECONDS = float(config.get("BATCH_DEADLINE_SECONDS", 90))
+ADAPTIVE_POLLING = config.get("ADAPTIVE_POLLING", "false").lower() == "true"
+API_BUDGET_NAME = "rapidapi"
+API_CALLS_PER_DAY = float(config.get("API_CALLS_PER_DAY", 3000))
+API_BURST_CALLS = float(config.get("API_BURST_CALLS", 200))
+DEAD_BAND_COMPRESSION = config.get("DEAD_BAND_COMPRESSION", "false").lower() == "true"
+DEAD_BAND = {"lat_lon": float(config.get("DEAD_BAND_LAT_LON", 0.01)),
+             "altitude": float(config.get("DEAD_BAND_ALTITUDE", 250)),
+             "track": float(config.get("DEAD_BAND_TRACK", 5))}
+CELEB_CACHE_TTL_SECONDS = float(config.get("CELEB_CACHE_TTL_SECONDS", 300))
+ADSB_REQUEST_TIMEOUT_SECONDS = float(config.get("ADSB_REQUEST_TIMEOUT_SECONDS", 10))
+ADSB_HEDGE_AFTER_SECONDS = float(config.get("ADSB_HEDGE_AFTER_SECONDS", 2))
+ADSB_MAX_ATTEMPTS = int(config.get("ADSB_MAX_ATTEMPTS", 3))
+# Time kept back from the lambda timeout for writing to staging
+LAMBDA_WRITE_MARGIN_SECONDS = float(config.get("LAMBDA_WRITE_MARGIN_SECONDS", 20))
+EXTRACT_SHARDS = int(config.get("EXTRACT_SHARDS", 1))
+# "process" runs the shards on a local process pool, "lambda" invokes this function once per shard
+EXTRACT_FAN_OUT = config.get("EXTRACT_FAN_OUT", "process").lower()
+LANDING_DETECTION = config.get("LANDING_DETECTION", "false").lower() == "true"
+# The production lambda, invoked as soon as landings are spotted so their flights are materialized straight away
+TRANSFORM_FUNCTION_NAME = config.get("TRANSFORM_FUNCTION_NAME")
+
+http_session = None
+s3_resource = None
+# The watchlist survives warm lambda invocations, and is revalidated against S3 once its TTL is up
+celeb_cache = {"etag": None, "fetched_at": None, "celebs": None, "by_icao": {}}
+# Stand-in for the live API (ADSB_PROVIDER) and optional recording of responses (ADSB_RECORD_FILE)
+adsb_provider = get_provider(config)
+response_recorder = ResponseRecorder(config["ADSB_RECORD_FILE"]) if config.get("ADSB_RECORD_FILE") else None
+# Kept between warm invocations, so a run doesn't start by hammering an API that was failing
+circuit_breaker = CircuitBreaker(int(config.get("CIRCUIT_BREAKER_FAILURES", 10)),
+                                 float(config.get("CIRCUIT_BREAKER_RESET_SECONDS", 30)))
+# The threads sending API requests, kept for the life of the process so warm invocations reuse them.
+# Keyed by process id, as the shards of a local fan-out are forked processes which need their own
+adsb_executors: dict[int, ThreadPoolExecutor] = {}
+
+
+def index_celebs_by_icao(celebs: list[dict]) -> dict[str, dict]:
+    """ Indexes the watchlist by lowercase ICAO hex """
+    return {celeb_plane["icao_hex"].lower(): celeb_plane for celeb_plane in celebs if "icao_hex" in celeb_plane}
+
 
 def get_celeb_json() -> dict:
-    """ Function for getting the celebrity information from our storage """
-    s3_bucket = boto3.resource('s3')
+    """ Function for getting the celebrity information from our storage. The file is cached for
+        CELEB_CACHE_TTL_SECONDS, after which it is only downloaded again if its ETag has changed
+    """
+    global s3_resource # pylint: disable=global-statement
 
-    obj = s3_bucket.Object(config["S3_BUCKET_NAME"], config["CELEB_INFO"])
+    if celeb_cache["celebs"] is not None and time.monotonic() - celeb_cache["fetched_at"] < CELEB_CACHE_TTL_SECONDS:
+        return celeb_cache["celebs"]
 
-    celeb_json = json.load(obj.get()['Body'])
+    if s3_resource is None:
+        s3_resource = boto3.resource('s3')
+    obj = s3_resource.Object(config["S3_BUCKET_NAME"], config["CELEB_INFO"])
+
+    try:
+        response = obj.get(IfNoneMatch=celeb_cache["etag"]) if celeb_cache["etag"] else obj.get()
+    except ClientError as err:
+        if err.response["Error"]["Code"] not in ("304", "NotModified"):
+            raise
+        celeb_cache["fetched_at"] = time.monotonic()
+        return celeb_cache["celebs"]
+
+    celeb_json = json.load(response['Body'])
+    celeb_cache.update(etag=response.get("ETag"), fetched_at=time.monotonic(), celebs=celeb_json,
+                       by_icao=index_celebs_by_icao(celeb_json))
     return celeb_json
 
 
-def get_current_flight_for_icao(icao_number: str) -> json:
-    """ Interacts with ADSB-exchange API to get current flight info w/ given ICAO """
+def get_celeb_index() -> dict[str, dict]:
+    """ The (cached) watchlist keyed by lowercase ICAO hex """
+    get_celeb_json()
+    return celeb_cache["by_icao"]
+
+
+def get_http_session(pool_size: int = MAX_CONCURRENT_REQUESTS) -> requests.Session:
+    """ Returns a pooled HTTP session that is shared across calls (and warm lambda invocations) """
+    global http_session # pylint: disable=global-statement
+
+    if http_session is None:
+        http_session = requests.Session()
+        http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return http_session
+
+
+def request_current_flight_for_icao(icao_number: str, session: requests.Session = None,
+                                    timeout: float = ADSB_REQUEST_TIMEOUT_SECONDS) -> requests.Response:
+    """ Sends the ADSB-exchange API request for the current flight info w/ given ICAO """
 
     url = f"https://adsbexchange-com1.p.rapidapi.com/v2/icao/{icao_number}/"
     headers = {
         "X-RapidAPI-Key": config["RAPIDAPI_KEY"],
         "X-RapidAPI-Host": config["RAPIDAPI_HOST"]
     }
-    response = requests.get(url, headers=headers, timeout=10)
-    return response.json()
+    client = session if session is not None else requests
+    return client.get(url, headers=headers, timeout=timeout)
+
+
+def get_current_flight_for_icao(icao_number: str, session: requests.Session = None) -> json:
+    """ Interacts with ADSB-exchange API to get current flight info w/ given ICAO,
+        optionally reusing the connections of a pooled session
+    """
+    return request_current_flight_for_icao(icao_number, session).json()
+
+
+def get_run_budget(context=None) -> DeadlineBudget:
+    """ The deadline for fetching flights: the batch deadline, cut short when the lambda would
+        otherwise run out of time to write what was fetched
+    """
+    seconds = BATCH_DEADLINE_SECONDS
+    if context is not None:
+        seconds = min(seconds, context.get_remaining_time_in_millis() / 1000 - LAMBDA_WRITE_MARGIN_SECONDS)
+    return DeadlineBudget(max(seconds, 0))
+
+
+def get_fetch_function(budget: DeadlineBudget):
+    """ The fetch(icao, session) function for a run: the stand-in provider, or the live API behind
+        the deadline budget, hedging, retries and circuit breaker. Responses are recorded if asked
+    """
+    if adsb_provider:
+        fetch = adsb_provider.get_flight
+    else:
+        if os.getpid() not in adsb_executors:
+            adsb_executors[os.getpid()] = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_REQUESTS,
+                                                             thread_name_prefix="adsb")
+        executor = adsb_executors[os.getpid()]
+        fetch = AdsbClient(request_current_flight_for_icao, budget, circuit_breaker, ADSB_REQUEST_TIMEOUT_SECONDS,
+                           ADSB_HEDGE_AFTER_SECONDS, max_attempts=ADSB_MAX_ATTEMPTS, executor=executor).get_flight
+    return response_recorder.wrap(fetch) if response_recorder else fetch
 
 
 def get_flights_for_all_celebs(celebs: list[dict]) -> list[dict]:
@@ -48,8 +167,96 @@ def get_flights_for_all_celebs(celebs: list[dict]) -> list[dict]:
     return data_to_append
 
 
-def convert_flight_list_to_df(flights:list[dict]) -> DataFrame:
-    """ Converts the acquired list into a dataframe to easily put it into staging DB """
+def get_flights_for_all_celebs_concurrently(celebs: list[dict] | dict[str, dict], max_workers: int = MAX_CONCURRENT_REQUESTS,
+                                            deadline: float = BATCH_DEADLINE_SECONDS, fetch=None) -> dict[str, dict]:
+    """ Fetches the current flight information for every celeb at once over a shared session.
+        At most max_workers requests are in flight; anything not back within the batch
+        deadline (in seconds) is dropped, so the partial results are returned keyed by ICAO.
+        fetch(icao, session) defaults to get_current_flight_for_icao. celebs may also be
+        given as a watchlist already indexed by lowercase ICAO
+    """
+    fetch = fetch or get_current_flight_for_icao
+    icaos = celebs.keys() if isinstance(celebs, dict) else {celeb_plane["icao_hex"].lower() for celeb_plane in celebs}
+    session = get_http_session(max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(fetch, icao, session): icao for icao in icaos}
+
+    flights = {}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            try:
+                flights[futures[future]] = future.result()
+            except (requests.RequestException, ValueError) as err:
+                print(f"Failed to fetch {futures[future]}: {err}")
+    except FuturesTimeoutError:
+        unfinished = sum(not future.done() for future in futures)
+        print(f"Batch deadline reached, {unfinished} aircraft not fetched")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return flights
+
+
+def get_poll_results(celeb_index: dict[str, dict], poll_state: dict[str, dict], flights: dict[str, dict],
+                     now: datetime) -> tuple[dict[str, dict], list[tuple]]:
+    """ Returns the new poll state of the aircraft just polled, to be saved with their staging rows,
+        and the (aircraft_reg, landed_at) of the ones that landed since their previous poll
+    """
+    landings = []
+    for icao, flight in flights.items():
+        landed_at = detect_landing(poll_state.get(icao), flight)
+        if landed_at is None:
+            continue
+        # A jet that disappeared has no registration in its response, so the one it was last seen with is used
+        aircraft = (flight.get("ac") or [{}])[0]
+        aircraft_reg = (aircraft.get("r") or poll_state[icao].get("last_reg")
+                        or celeb_index.get(icao, {}).get("tail_number"))
+        if aircraft_reg is None:
+            print(f"Landing of {icao} skipped, as its registration isn't known")
+            continue
+        landings.append((aircraft_reg, landed_at))
+
+    return {icao: update_poll_state(poll_state.get(icao), flight, now) for icao, flight in flights.items()}, landings
+
+
+def get_flights_on_schedule(celeb_index: dict[str, dict], fetch=None, shard: int = 0, shards: int = 1,
+                            deadline: float = BATCH_DEADLINE_SECONDS) -> tuple[dict[str, dict], dict[str, dict], list[tuple]]:
+    """ Polls only the aircraft the adaptive scheduler says are due, within the API budget,
+        and works out what was seen so the next run can plan around it. Expects the watchlist
+        indexed by lowercase ICAO. Each of several shards gets its own equal share of the budget.
+        Returns the flights keyed by ICAO, their new poll state and the landings spotted
+    """
+    now = datetime.utcnow()
+    poll_state = load_poll_state(config)
+
+    budget_name = API_BUDGET_NAME if shards == 1 else f"{API_BUDGET_NAME}-{shard}-of-{shards}"
+    budget = load_api_budget(config, budget_name)
+    tokens, updated_at = budget if budget else (None, None)
+    bucket = TokenBucket(API_CALLS_PER_DAY / (24 * 60**2) / shards, API_BURST_CALLS / shards, tokens, updated_at)
+
+    to_poll = select_icaos_to_poll(list(celeb_index), poll_state, bucket, now)
+    save_api_budget(config, budget_name, bucket.tokens, bucket.updated_at)
+
+    flights = get_flights_for_all_celebs_concurrently({icao: celeb_index[icao] for icao in to_poll},
+                                                      deadline=deadline, fetch=fetch)
+    return flights, *get_poll_results(celeb_index, poll_state, flights, now)
+
+
+def notify_transform(landings: list[tuple]) -> None:
+    """ Invokes the production lambda without waiting on it, so it materializes the flights
+        the landings just written end
+    """
+    print(f"{len(landings)} aircraft landed")
+    if TRANSFORM_FUNCTION_NAME:
+        boto3.client("lambda").invoke(FunctionName=TRANSFORM_FUNCTION_NAME, InvocationType="Event",
+                                      Payload=json.dumps({"landings": len(landings)}))
+
+
+def convert_flight_list_to_df(flights:list[dict]):
+    """ Converts the acquired list into a dataframe. pandas is imported here as the staging
+        image doesn't install it, the handler builds rows for COPY with build_staging_rows
+    """
+    import pandas as pd # pylint: disable=import-outside-toplevel
 
     flight_list = []
     for flight in flights:
@@ -59,56 +266,111 @@ def convert_flight_list_to_df(flights:list[dict]) -> DataFrame:
     return pd.DataFrame(flight_list)
 
 
-def get_flight_params(flight: dict) -> list:
+def get_flight_params(flight: dict) -> dict:
     """ extracts staging data from API info """
-    flight_data:dict = {}
-
-    flight_info = flight["ac"][0]
-    flight_data["time_input"] = datetime.utcfromtimestamp(flight["now"]/1000)
-
-    for key in flight_info.keys():
-        if key == "flight":
-            flight_data["flight_no"] = flight_info["flight"]
-        elif key == "r":
-            flight_data["aircraft_reg"] = flight_info["r"]
-        elif key == "t":
-            flight_data["model"] = flight_info["t"]
-        elif key == "alt_baro":
-            flight_data["barometric_alt"] = flight_info["alt_baro"]
-        elif key == "alt_geom":
-            flight_data["geometric_alt"] = flight_info["alt_geom"]
-        elif key == "gs":
-            flight_data["ground_speed"] = flight_info["gs"]
-        elif key == "track":
-            flight_data["true_track"] = flight_info["track"]
-        elif key == "baro_rate":
-            flight_data["barometric_alt_roc"] = flight_info["baro_rate"]
-        elif key == "emergency":
-            flight_data["emergency"] = flight_info["emergency"]
-        elif key == "lat":
-            flight_data["lat"] = flight_info["lat"]
-        elif key == "lon":
-            flight_data["lon"] = flight_info["lon"]
-
-    return flight_data
+    return build_staging_record(flight)
 
 
-def handler(event=None, context=None) -> None:
-    """ The handler function to execute the extraction process """
-    # Pulls celeb info from S3
-    celeb_json = get_celeb_json()
+def write_staging_rows(staging_rows: list[tuple], landings: list[tuple] = None, poll_state: dict[str, dict] = None) -> int:
+    """ Writes staging rows to the staging DB, first merging away the ones inside the dead-band
+        of the stored track when compression is on. Any landings and poll state are saved with
+        them, in the same transaction. Returns the number of rows inserted
+    """
+    updates = {}
+    if DEAD_BAND_COMPRESSION:
+        tails = load_staging_tails(config, {row[AIRCRAFT_REG] for row in staging_rows})
+        staging_rows, updates = compress_staging_rows(staging_rows, tails, DEAD_BAND)
+
+    if staging_rows or updates or landings or poll_state:
+        push_to_staging_database(config, staging_rows, updates, landings, poll_state)
+    return len(staging_rows)
+
+
+def get_watchlist() -> dict[str, dict]:
+    """ The watchlist keyed by lowercase ICAO, from S3 (cached between warm invocations) or from the stand-in provider """
+    return index_celebs_by_icao(adsb_provider.get_celebs()) if adsb_provider else get_celeb_index()
+
+
+def poll_flights(celeb_index: dict[str, dict], budget: DeadlineBudget, shard: int = 0, shards: int = 1,
+                 adaptive: bool = ADAPTIVE_POLLING) -> tuple[dict[str, dict], dict[str, dict], list[tuple]]:
+    """ Fetches the current flights of a watchlist within the deadline budget, or with adaptive
+        polling just the ones due a poll within the API budget. Returns the flights keyed by ICAO,
+        the poll state to save with their staging rows and the landings spotted
+    """
+    fetch = get_fetch_function(budget)
 
-    # Gets a list of current flight data for each celeb
-    flight_data = get_flights_for_all_celebs(celeb_json)
+    # Gets a list of current flight data for each celeb (or just the ones due a poll)
+    if adaptive:
+        flights, poll_state, landings = get_flights_on_schedule(celeb_index, fetch, shard, shards, budget.remaining())
+    else:
+        now = datetime.utcnow()
+        poll_state = load_poll_state(config) if LANDING_DETECTION else {}
+        flights = get_flights_for_all_celebs_concurrently(celeb_index, deadline=budget.remaining(), fetch=fetch)
+        poll_state, landings = get_poll_results(celeb_index, poll_state, flights, now) if LANDING_DETECTION else ({}, [])
 
-    # Converts the data to df
-    flight_df = convert_flight_list_to_df(flight_data)
+    if response_recorder:
+        response_recorder.flush()
+    return flights, poll_state, landings
+
+
+def write_poll_results(staging_rows: list[tuple], landings: list[tuple], poll_state: dict[str, dict]) -> int:
+    """ Pushes staging rows to the staging DB along with the landings and the poll state, so a landing
+        is only forgotten once it's written, and before any flight it ends is closed. Then lets transform
+        know about the landings. Returns the number of rows written
+    """
+    rows_written = write_staging_rows(staging_rows, landings, poll_state)
+    if LANDING_DETECTION and landings:
+        notify_transform(landings)
+    return rows_written
+
+
+def extract_flights(celeb_index: dict[str, dict], shard: int = 0, shards: int = 1, context=None) -> int:
+    """ Fetches the current flights of a watchlist (or just the ones due a poll) and writes
+        them to staging. Returns the number of rows written
+    """
+    flights, poll_state, landings = poll_flights(celeb_index, get_run_budget(context), shard, shards)
+    return write_poll_results(build_staging_rows(list(flights.values())), landings, poll_state)
+
+
+def extract_shard(shard: int, shards: int, context=None) -> int:
+    """ Worker: extracts the part of the watchlist that consistent hashing assigns to one shard """
+    celeb_index = partition_celebs(get_watchlist(), shards)[shard]
+    print(f"Extracting shard {shard} of {shards}: {len(celeb_index)} aircraft")
+    return extract_flights(celeb_index, shard, shards, context)
+
+
+def fan_out_extraction(shards: int, context=None) -> dict[str, int]:
+    """ Coordinator: runs every shard at once, each writing its own rows to staging. Locally the
+        shards run on a process pool and the rows written are summed, returned as rows_written;
+        with the lambda fan-out each shard is an asynchronous invocation of this function, so
+        only the number of shards invoked (shards_invoked) is known
+    """
+    if EXTRACT_FAN_OUT == "lambda":
+        lambda_client = boto3.client("lambda")
+        for shard in range(shards):
+            lambda_client.invoke(FunctionName=context.function_name, InvocationType="Event",
+                                 Payload=json.dumps({"shard": shard, "shards": shards}))
+        print(f"Invoked {shards} extract shards")
+        return {"shards_invoked": shards}
+
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        return {"rows_written": sum(executor.map(extract_shard, range(shards), [shards] * shards))}
+
+
+def handler(event=None, context=None) -> None:
+    """ The handler function to execute the extraction process. An event of {"shard": i, "shards": n}
+        extracts a single shard, otherwise the whole watchlist is extracted, fanned out over
+        EXTRACT_SHARDS shards when there is more than one
+    """
+    event = event or {}
+    if "shard" in event:
+        result = {"rows_written": extract_shard(int(event["shard"]), int(event["shards"]), context)}
+    elif EXTRACT_SHARDS > 1:
+        result = fan_out_extraction(EXTRACT_SHARDS, context)
+    else:
+        result = {"rows_written": extract_flights(get_watchlist(), context=context)}
+    return json.dumps(result)
 
-    # Pushes to staging DB
-    if not flight_df.empty:
-        push_to_staging_database(config, flight_df)
-        return flight_df.to_json()
 
-    
 if __name__ == "__main__":
     handler()
@@ -0,0 +1,50 @@
+""" This module spots landings as the samples come in, so a finished flight can be materialized
+    within a polling interval rather than once it has been quiet for half an hour. Each sample is
+    classified into a flight phase from alt_baro, gs and baro_rate, and a landing is a jet going
+    from the air to the ground, or disappearing while low and descending on approach
+"""
+from datetime import datetime
+
+from records import get_time_input
+
+
+# Below this barometric altitude (feet) a jet slower than LANDED_GROUND_SPEED (knots) is on the ground,
+# even if its transponder doesn't report "ground"
+LOW_ALTITUDE = 2000
+LANDED_GROUND_SPEED = 60
+# A jet descending below this altitude (feet) is on approach, and will be on the ground within a poll or two
+APPROACH_ALTITUDE = 10000
+
+
+def get_flight_phase(flight: dict) -> str:
+    """ Classifies an API response as "missing", "ground", "approach" or "airborne" """
+    aircraft = flight.get("ac") or []
+    if not aircraft:
+        return "missing"
+
+    altitude, speed, climb_rate = aircraft[0].get("alt_baro"), aircraft[0].get("gs"), aircraft[0].get("baro_rate")
+    if altitude == "ground":
+        return "ground"
+    if altitude is None:
+        return "airborne"
+    if altitude < LOW_ALTITUDE and speed is not None and speed < LANDED_GROUND_SPEED:
+        return "ground"
+    if altitude < APPROACH_ALTITUDE and climb_rate is not None and climb_rate < 0:
+        return "approach"
+    return "airborne"
+
+
+def detect_landing(previous: dict | None, flight: dict) -> datetime | None:
+    """ When the jet has landed since its previous poll state, returns the time of its first sample
+        on the ground, or of its last one on approach (its last_seen) if it disappeared, otherwise None.
+        Either is the time_input of a staged row, so transform closes the flight up to and including it
+    """
+    if previous is None or previous.get("phase") not in ("airborne", "approach"):
+        return None
+
+    phase = get_flight_phase(flight)
+    if phase == "ground":
+        return get_time_input(flight)
+    if phase == "missing" and previous["phase"] == "approach":
+        return previous["last_seen"]
+    return None
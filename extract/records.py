@@ -0,0 +1,57 @@
+""" This module maps ADS-B Exchange responses onto staging rows without going through pandas.
+    The mapping is declared once and applied in a single pass, giving tuples ready for COPY
+"""
+from datetime import datetime
+
+
+def parse_altitude(altitude: int | str) -> int:
+    """ ADS-B reports the barometric altitude of an aircraft on the ground as "ground" """
+    return 0 if altitude == "ground" else altitude
+
+
+# (staging column, ADS-B field, converter) in the order of db_connection.STAGING_COLUMNS
+STAGING_FIELDS = (
+    ("flight_no", "flight", None),
+    ("aircraft_reg", "r", None),
+    ("model", "t", None),
+    ("barometric_alt", "alt_baro", parse_altitude),
+    ("geometric_alt", "alt_geom", None),
+    ("ground_speed", "gs", None),
+    ("true_track", "track", None),
+    ("barometric_alt_roc", "baro_rate", None),
+    ("emergency", "emergency", None),
+    ("lat", "lat", None),
+    ("lon", "lon", None),
+)
+
+
+def get_time_input(flight: dict) -> datetime:
+    """ The time of an API response, which is given in milliseconds since the epoch """
+    return datetime.utcfromtimestamp(flight["now"]/1000)
+
+
+def build_staging_row(time_input: datetime, aircraft: dict) -> tuple:
+    """ Maps a single aircraft of an API response onto a staging row, None for missing fields """
+    row = [time_input]
+    for _, field, converter in STAGING_FIELDS:
+        value = aircraft.get(field)
+        row.append(converter(value) if converter and value is not None else value)
+    return tuple(row)
+
+
+def build_staging_rows(flights: list[dict]) -> list[tuple]:
+    """ Builds the staging rows of a batch of API responses in one pass, skipping the
+        responses of aircraft that aren't currently being tracked
+    """
+    return [build_staging_row(get_time_input(flight), flight["ac"][0])
+            for flight in flights if flight.get("ac")]
+
+
+def build_staging_record(flight: dict) -> dict:
+    """ Maps an API response onto a dict of staging columns, only including the fields present """
+    aircraft = flight["ac"][0]
+    record = {"time_input": get_time_input(flight)}
+    for column, field, converter in STAGING_FIELDS:
+        if field in aircraft:
+            record[column] = converter(aircraft[field]) if converter else aircraft[field]
+    return record
@@ -0,0 +1,175 @@
+""" This module lets the extract pipeline run without the live ADS-B Exchange API. Responses can be
+    recorded to gzipped JSONL and replayed later, or synthetic aircraft can be flown instead, at any
+    speed. Both providers stand in for get_current_flight_for_icao and the S3 watchlist
+"""
+from datetime import datetime, timedelta
+from threading import Lock
+import bisect
+import gzip
+import json
+import math
+import random
+import time
+
+
+NAUTICAL_MILES_PER_DEGREE = 60
+
+
+class ResponseRecorder():
+    """ Records API responses to a gzipped JSONL file, one {"icao", "response"} object per line.
+        Responses are buffered and appended to the file as a new gzip member on each flush
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lines = []
+        self.lock = Lock()
+
+    def record(self, icao: str, response: dict) -> None:
+        """ Adds a response to the recording, safe to call from several threads """
+        line = json.dumps({"icao": icao, "response": response})
+        with self.lock:
+            self.lines.append(line + "\n")
+
+    def wrap(self, fetch):
+        """ Returns a fetch function which records every response of the given one """
+        def recording_fetch(icao: str, session=None) -> dict:
+            response = fetch(icao, session)
+            self.record(icao, response)
+            return response
+        return recording_fetch
+
+    def flush(self) -> None:
+        """ Appends the buffered responses to the recording file """
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if lines:
+            with gzip.open(self.path, "at", encoding="utf-8") as file:
+                file.writelines(lines)
+
+
+class ReplayClock():
+    """ Clock starting at a given time and running speed times faster than real time. It can
+        also be moved on by hand, e.g. with a speed of 0 to step through a recording
+    """
+    def __init__(self, start: datetime, speed: float = 1.0) -> None:
+        self.start = start
+        self.speed = speed
+        self.started = time.monotonic()
+        self.offset = timedelta()
+
+    def now(self) -> datetime:
+        """ The current time on the clock """
+        return self.start + self.offset + timedelta(seconds=(time.monotonic() - self.started) * self.speed)
+
+    def advance(self, seconds: float) -> None:
+        """ Moves the clock forward """
+        self.offset += timedelta(seconds=seconds)
+
+
+class ReplayProvider():
+    """ Replays a recording made by ResponseRecorder, answering each ICAO with the latest
+        response recorded for it at the time on the replay clock
+    """
+    def __init__(self, path: str, speed: float = 1.0) -> None:
+        self.responses: dict[str, list[dict]] = {}
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                recorded = json.loads(line)
+                self.responses.setdefault(recorded["icao"].lower(), []).append(recorded["response"])
+
+        self.times: dict[str, list[float]] = {}
+        for icao, responses in self.responses.items():
+            responses.sort(key=lambda response: response["now"])
+            self.times[icao] = [response["now"] for response in responses]
+
+        first = min(times[0] for times in self.times.values())
+        self.clock = ReplayClock(datetime.utcfromtimestamp(first/1000), speed)
+
+    def get_celebs(self) -> list[dict]:
+        """ The watchlist of the recording """
+        return [{"icao_hex": icao} for icao in self.responses]
+
+    def get_flight(self, icao: str, session=None) -> dict: # pylint: disable=unused-argument
+        """ The response recorded for an ICAO at the current replay time """
+        replay_now = (self.clock.now() - datetime(1970, 1, 1)).total_seconds() * 1000
+        position = bisect.bisect_right(self.times.get(icao.lower(), []), replay_now)
+        if position == 0:
+            return {"ac": [], "now": replay_now}
+        return self.responses[icao.lower()][position - 1]
+
+
+class SyntheticProvider():
+    """ Flies n_aircraft synthetic jets between random points. Each alternates between a flight of
+        one to five hours (climb, cruise, descent) and one to eight hours parked on the ground
+    """
+    def __init__(self, n_aircraft: int, speed: float = 1.0, start: datetime = None, seed: int = 0) -> None:
+        self.clock = ReplayClock(start or datetime.utcnow(), speed)
+        rng = random.Random(seed)
+        self.aircraft = {}
+        for i in range(n_aircraft):
+            self.aircraft[f"f{i:05x}"] = {
+                "tail_number": f"SYN{i:05d}",
+                "model": rng.choice(["GLF6", "GLF5", "LJ40", "CL60", "FA7X"]),
+                "lat": rng.uniform(-50, 60), "lon": rng.uniform(-150, 150),
+                "heading": rng.uniform(0, 360), "speed": rng.uniform(350, 480),
+                "flight_time": rng.uniform(1, 5) * 60**2, "parked_time": rng.uniform(1, 8) * 60**2,
+                "phase": rng.uniform(0, 13) * 60**2,
+            }
+
+    def get_celebs(self) -> list[dict]:
+        """ A celeb_planes.json style watchlist of the synthetic aircraft """
+        return [{"name": f"Synthetic Owner {aircraft['tail_number']}", "gender": None, "est_net_worth": None,
+                 "job_role": [], "tail_number": aircraft["tail_number"], "aircraft_model": aircraft["model"],
+                 "icao_hex": icao.upper(), "birthdate": None} for icao, aircraft in self.aircraft.items()]
+
+    def get_flight(self, icao: str, session=None) -> dict: # pylint: disable=unused-argument
+        """ An ADS-B Exchange style response for the aircraft at the current time on the clock """
+        now = self.clock.now()
+        response = {"ac": [], "now": (now - datetime(1970, 1, 1)).total_seconds() * 1000}
+        aircraft = self.aircraft.get(icao.lower())
+        if aircraft is None:
+            return response
+
+        cycle = aircraft["flight_time"] + aircraft["parked_time"]
+        seconds = (now - self.clock.start).total_seconds() + aircraft["phase"]
+        legs, elapsed = divmod(seconds, cycle)
+        if elapsed > aircraft["flight_time"]:
+            return response
+
+        # each leg flies back along the reverse of the previous one
+        heading = (aircraft["heading"] + 180 * (legs % 2)) % 360
+        lat, lon = aircraft["lat"], aircraft["lon"]
+        if legs % 2:
+            lat, lon = self.move(lat, lon, aircraft["heading"], aircraft["speed"], aircraft["flight_time"])
+        lat, lon = self.move(lat, lon, heading, aircraft["speed"], elapsed)
+
+        climb = min(elapsed, aircraft["flight_time"] - elapsed, 20 * 60) / (20 * 60)
+        response["ac"] = [{
+            "hex": icao, "flight": f"{aircraft['tail_number']:<8}", "r": aircraft["tail_number"],
+            "t": aircraft["model"], "alt_baro": round(41000 * climb), "alt_geom": round(41000 * climb) + 200,
+            "gs": round(aircraft["speed"] * max(climb, 0.4), 1), "track": round(heading, 1),
+            "baro_rate": 0 if climb >= 1 else (2000 if elapsed < 20 * 60 else -2000),
+            "emergency": "none", "lat": round(lat, 5), "lon": round(lon, 5),
+        }]
+        return response
+
+    @staticmethod
+    def move(lat: float, lon: float, heading: float, speed: float, seconds: float) -> tuple[float, float]:
+        """ Moves a point along a heading at a speed in knots for some seconds, on a locally flat earth """
+        degrees = speed * seconds / 60**2 / NAUTICAL_MILES_PER_DEGREE
+        lat = max(-85, min(85, lat + degrees * math.cos(math.radians(heading))))
+        lon += degrees * math.sin(math.radians(heading)) / max(0.1, math.cos(math.radians(lat)))
+        return lat, (lon + 180) % 360 - 180
+
+
+def get_provider(config: dict) -> ReplayProvider | SyntheticProvider | None:
+    """ The stand-in provider selected by ADSB_PROVIDER ("replay" or "synthetic"), None when
+        the live API should be used
+    """
+    provider = config.get("ADSB_PROVIDER", "live").lower()
+    speed = float(config.get("ADSB_REPLAY_SPEED", 1))
+    if provider == "replay":
+        return ReplayProvider(config["ADSB_REPLAY_FILE"], speed)
+    if provider == "synthetic":
+        return SyntheticProvider(int(config.get("ADSB_SYNTHETIC_AIRCRAFT", 100)), speed)
+    return None
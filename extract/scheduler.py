@@ -0,0 +1,109 @@
+""" This module decides which aircraft get polled on each run, so the API quota is spent on
+    aircraft that are flying (or about to) rather than ones parked for days
+"""
+from datetime import datetime, timedelta
+
+from landings import get_flight_phase
+from records import get_time_input
+
+
+MIN_POLL_INTERVAL = timedelta(minutes=10)
+MAX_POLL_INTERVAL = timedelta(hours=6)
+# Runs start a little earlier or later than every MIN_POLL_INTERVAL (cold starts, setup and db round trips),
+# so an aircraft counts as due this long before its next poll rather than waiting a whole extra run
+POLL_TOLERANCE = timedelta(minutes=2)
+# Aircraft seen this recently may still be taxiing, in a coverage gap or about to leave again
+RECENTLY_SEEN = timedelta(hours=2)
+
+
+class TokenBucket():
+    """ Token bucket holding the API calls we can afford, refilled at a fixed rate """
+    def __init__(self, rate: float, capacity: float, tokens: float = None, updated_at: datetime = None) -> None:
+        self.rate = rate # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated_at = updated_at
+
+    def refill(self, now: datetime) -> None:
+        """ Adds the tokens earned since the bucket was last updated """
+        if self.updated_at is not None and now > self.updated_at:
+            earned = (now - self.updated_at).total_seconds() * self.rate
+            self.tokens = min(self.capacity, self.tokens + earned)
+        self.updated_at = now
+
+    def consume(self, now: datetime, amount: float = 1) -> bool:
+        """ Takes tokens from the bucket if there are enough of them, returns whether it did """
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+def is_airborne(flight: dict) -> bool:
+    """ Whether an API response shows the aircraft in the air """
+    aircraft = flight.get("ac") or []
+    return bool(aircraft) and aircraft[0].get("alt_baro") != "ground"
+
+
+def get_poll_interval(previous: dict | None, flight: dict, now: datetime) -> timedelta:
+    """ Works out how long to wait before polling an aircraft again. Airborne aircraft and ones
+        seen recently are polled on every run, parked ones back off exponentially
+    """
+    if flight.get("ac") or previous is None:
+        return MIN_POLL_INTERVAL
+
+    last_seen = previous.get("last_seen")
+    if last_seen is not None and now - last_seen <= RECENTLY_SEEN:
+        return MIN_POLL_INTERVAL
+
+    previous_interval = previous["next_poll"] - previous["last_polled"]
+    return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, 2 * previous_interval))
+
+
+def update_poll_state(previous: dict | None, flight: dict, now: datetime) -> dict:
+    """ Returns the new poll state of an aircraft given the API response just received for it. last_seen
+        is the time of the response, which its staging row is stamped with, rather than the run's now
+    """
+    state = dict(previous) if previous else {"last_seen": None, "airborne": False, "phase": None,
+                                             "last_alt": None, "last_speed": None, "last_reg": None}
+    aircraft = flight.get("ac") or []
+
+    if aircraft:
+        state["last_seen"] = get_time_input(flight)
+        altitude = aircraft[0].get("alt_baro")
+        state["last_alt"] = 0 if altitude == "ground" else altitude
+        state["last_speed"] = aircraft[0].get("gs")
+        state["last_reg"] = aircraft[0].get("r") or state.get("last_reg")
+    state["airborne"] = is_airborne(flight)
+    state["phase"] = get_flight_phase(flight)
+    state["last_polled"] = now
+    state["next_poll"] = now + get_poll_interval(previous, flight, now)
+    return state
+
+
+def get_poll_priority(state: dict | None, now: datetime) -> tuple:
+    """ Sort key putting airborne aircraft first, then recently seen ones, then the most overdue """
+    if state is None:
+        return (1, 0, 0)
+
+    recently_seen = state["last_seen"] is not None and now - state["last_seen"] <= RECENTLY_SEEN
+    overdue = (now - state["next_poll"]).total_seconds()
+    return (not state["airborne"], not recently_seen, -overdue)
+
+
+def select_icaos_to_poll(icaos: list[str], poll_state: dict[str, dict], bucket: TokenBucket,
+                         now: datetime) -> list[str]:
+    """ Returns the ICAOs due a poll (or about to be, within POLL_TOLERANCE), most important first,
+        for as long as the budget allows
+    """
+    due = [icao for icao in icaos
+           if icao not in poll_state or poll_state[icao]["next_poll"] <= now + POLL_TOLERANCE]
+    due.sort(key=lambda icao: get_poll_priority(poll_state.get(icao), now))
+
+    selected = []
+    for icao in due:
+        if not bucket.consume(now):
+            break
+        selected.append(icao)
+    return selected
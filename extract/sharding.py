@@ -0,0 +1,38 @@
+""" This module splits the watchlist into shards with consistent hashing, so that each shard can be
+    extracted by its own process or lambda invocation. Changing the number of shards only moves
+    about 1/N of the aircraft to a different shard
+"""
+import bisect
+import hashlib
+
+
+VIRTUAL_NODES = 100
+
+
+def hash_key(key: str) -> int:
+    """ Stable 64 bit hash of a string (python's hash() is salted per process) """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing():
+    """ Consistent hash ring of shards 0 to shards-1, each placed on the ring many times """
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES) -> None:
+        self.shards = shards
+        points = sorted((hash_key(f"shard-{shard}-{node}"), shard)
+                        for shard in range(shards) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def get_shard(self, key: str) -> int:
+        """ The shard owning a key: the first shard point clockwise of the key's hash """
+        position = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[position]
+
+
+def partition_celebs(celeb_index: dict[str, dict], shards: int) -> list[dict[str, dict]]:
+    """ Splits a watchlist indexed by ICAO into one watchlist per shard """
+    ring = HashRing(shards)
+    partitions = [{} for _ in range(shards)]
+    for icao, celeb_plane in celeb_index.items():
+        partitions[ring.get_shard(icao)][icao] = celeb_plane
+    return partitions
@@ -0,0 +1,147 @@
+""" This module runs the extraction as a long-running daemon instead of a scheduled lambda.
+    A poller thread keeps polling the watchlist the way the lambda does and hands each poll to
+    a writer thread through a bounded queue, which writes them to the staging DB in micro-batches
+"""
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Event, Thread
+import signal
+import sys
+import time
+
+from extract import config, get_watchlist, poll_flights, write_poll_results
+from records import build_staging_rows
+from adsb_client import DeadlineBudget
+
+
+POLL_INTERVAL_SECONDS = float(config.get("STREAM_POLL_INTERVAL_SECONDS", 30))
+# The queue and the batches are counted in polls, each holding the staging rows, landings and poll state of one interval
+QUEUE_SIZE = int(config.get("STREAM_QUEUE_POLLS", 100))
+BATCH_SIZE = int(config.get("STREAM_BATCH_POLLS", 10))
+# Kept well under the poll interval, so each poll's state is saved before the next one plans around it
+BATCH_INTERVAL_SECONDS = float(config.get("STREAM_BATCH_INTERVAL_SECONDS", 5))
+# A failed poll or write is retried after a backoff doubling from ERROR_BACKOFF_SECONDS up to MAX_BACKOFF_SECONDS
+ERROR_BACKOFF_SECONDS = float(config.get("STREAM_ERROR_BACKOFF_SECONDS", 1))
+MAX_BACKOFF_SECONDS = float(config.get("STREAM_MAX_BACKOFF_SECONDS", 60))
+# Once stopping, a batch that still can't be written after this many attempts is given up on
+MAX_WRITE_ATTEMPTS = 5
+
+
+def get_backoff(failures: int) -> float:
+    """ Seconds to wait after the given number of failures in a row """
+    return min(MAX_BACKOFF_SECONDS, ERROR_BACKOFF_SECONDS * 2 ** (failures - 1))
+
+
+def poll_positions(polls: Queue, stop: Event, poll_interval: float = POLL_INTERVAL_SECONDS) -> None:
+    """ Each interval, polls the aircraft of the watchlist the adaptive scheduler says are due within
+        the API budget, and queues the staging rows of the poll with its landings and poll state.
+        Blocks while the queue is full, so a slow DB slows the polling down rather than using up memory
+    """
+    failures = 0
+    while not stop.is_set():
+        started = time.monotonic()
+
+        try:
+            flights, poll_state, landings = poll_flights(get_watchlist(), DeadlineBudget(poll_interval), adaptive=True)
+            if flights:
+                polls.put((build_staging_rows(list(flights.values())), landings, poll_state))
+        except Exception as err: # pylint: disable=broad-except
+            failures += 1
+            print(f"{datetime.utcnow()}: poll failed ({err!r}), retrying in {get_backoff(failures):.0f}s")
+            stop.wait(get_backoff(failures))
+            continue
+
+        failures = 0
+        stop.wait(max(0, poll_interval - (time.monotonic() - started)))
+
+
+def write_polls(polls: list[tuple]) -> int:
+    """ Writes a batch of queued polls to staging in one go. Where an aircraft was polled more than
+        once, its latest poll state is the one saved. Returns the number of rows written
+    """
+    staging_rows, landings, poll_state = [], [], {}
+    for poll_rows, poll_landings, poll_poll_state in polls:
+        staging_rows.extend(poll_rows)
+        landings.extend(poll_landings)
+        poll_state.update(poll_poll_state)
+    return write_poll_results(staging_rows, landings, poll_state)
+
+
+def write_with_retries(write, batch: list[tuple], stop: Event) -> None:
+    """ Writes a batch, retrying with backoff until it goes through so a DB outage loses nothing
+        (the queue fills up meanwhile, holding the poller back). Once stopping, the error is
+        raised after MAX_WRITE_ATTEMPTS
+    """
+    failures = 0
+    while True:
+        try:
+            write(batch)
+            return
+        except Exception as err: # pylint: disable=broad-except
+            failures += 1
+            if stop.is_set() and failures >= MAX_WRITE_ATTEMPTS:
+                raise
+            print(f"{datetime.utcnow()}: writing {len(batch)} polls failed ({err!r}), "
+                  f"retrying in {get_backoff(failures):.0f}s")
+            time.sleep(get_backoff(failures))
+
+
+def write_batches(polls: Queue, stop: Event, batch_size: int = BATCH_SIZE,
+                  batch_interval: float = BATCH_INTERVAL_SECONDS, write=None) -> None:
+    """ Takes polls off the queue and writes them to staging once batch_size of them
+        are waiting or batch_interval seconds have passed. Drains the queue when stopped
+    """
+    write = write or write_polls
+    batch = []
+    deadline = time.monotonic() + batch_interval
+
+    while not (stop.is_set() and polls.empty()):
+        try:
+            batch.append(polls.get(timeout=max(0, deadline - time.monotonic())))
+        except Empty:
+            pass
+
+        if len(batch) >= batch_size or time.monotonic() >= deadline:
+            if batch:
+                write_with_retries(write, batch, stop)
+                print(f"{datetime.utcnow()}: wrote {len(batch)} polls to staging")
+            batch = []
+            deadline = time.monotonic() + batch_interval
+
+    if batch:
+        write_with_retries(write, batch, stop)
+
+
+def run() -> None:
+    """ Starts the poller and writer threads and runs until interrupted or terminated. If either
+        thread dies, the other is stopped and the process exits non-zero so it gets restarted
+    """
+    polls = Queue(maxsize=QUEUE_SIZE)
+    stop = Event()
+
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    poller = Thread(target=poll_positions, args=(polls, stop), daemon=True)
+    writer = Thread(target=write_batches, args=(polls, stop))
+    poller.start()
+    writer.start()
+
+    failed = False
+    while writer.is_alive():
+        writer.join(timeout=1)
+        if not poller.is_alive() and not stop.is_set():
+            print("Poller thread died, writing what it queued and exiting")
+            failed = True
+            stop.set()
+
+    if not stop.is_set():
+        print("Writer thread died, exiting")
+        failed = True
+        stop.set()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
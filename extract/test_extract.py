@@ -1,10 +1,25 @@
 """Unit tests for extract module."""
 from unittest.mock import MagicMock, patch
 import os
-from datetime import datetime
+import time
+from queue import Queue
+from threading import Event
+from datetime import datetime, timedelta
 import pytest
 
 from extract import get_flights_for_all_celebs, get_flight_params, get_celeb_json, get_current_flight_for_icao
+from extract import get_flights_for_all_celebs_concurrently, get_celeb_index, handler, get_poll_results
+from extract import write_staging_rows
+from botocore.exceptions import ClientError
+from db_connection import SQL, STAGING_COLUMNS
+from records import build_staging_rows
+from compression import compress_staging_rows
+from replay import ResponseRecorder, ReplayProvider, SyntheticProvider
+from adsb_client import AdsbClient, CircuitBreaker, DeadlineBudget, DeadlineExceeded
+from sharding import HashRing, partition_celebs
+from stream import write_batches, write_polls, poll_positions, run
+from landings import get_flight_phase, detect_landing
+from scheduler import TokenBucket, select_icaos_to_poll, update_poll_state, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL
 
 
 def test_celebs_have_expected_plane_info(celeb_planes_data):
@@ -24,6 +39,37 @@ def test_get_flights_for_celebs(mocked_flight_info, celeb_planes_data):
     assert isinstance(result, list) and len(celeb_planes_data) == len(result)
 
 
+@patch("extract.get_current_flight_for_icao")
+def test_get_flights_for_celebs_concurrently(mocked_flight_info, celeb_planes_data):
+    """Checks that the concurrent fetch returns one response per distinct ICAO, keyed by
+    the lowercase ICAO, and shares a single session between requests."""
+
+    mocked_flight_info.side_effect = lambda icao, session: {"icao": icao}
+    result = get_flights_for_all_celebs_concurrently(celeb_planes_data, max_workers=4)
+
+    icaos = {celeb_plane["icao_hex"].lower() for celeb_plane in celeb_planes_data}
+    assert set(result) == icaos
+    assert all(flight == {"icao": icao} for icao, flight in result.items())
+    assert len({call.args[1] for call in mocked_flight_info.call_args_list}) == 1
+
+
+@patch("extract.get_current_flight_for_icao")
+def test_get_flights_for_celebs_concurrently_returns_partial_results(mocked_flight_info):
+    """Checks that requests still running at the batch deadline are dropped, while the
+    responses that arrived in time are returned."""
+
+    def fake_flight_info(icao, session):
+        if icao == "slow":
+            time.sleep(1)
+        return {"icao": icao}
+
+    mocked_flight_info.side_effect = fake_flight_info
+    celebs = [{"icao_hex": "FAST"}, {"icao_hex": "slow"}]
+    result = get_flights_for_all_celebs_concurrently(celebs, max_workers=2, deadline=0.2)
+
+    assert result == {"fast": {"icao": "fast"}}
+
+
 def test_get_flight_params_raises_keyerror():
     """Test function responds as expected to invalid input."""
 
@@ -41,6 +87,8 @@ def test_get_flight_params_unix_conversion():
     assert get_flight_params(data)["time_input"] == datetime(1970, 1, 1, 0, 0, 0, 1000)
 
 
+@patch("extract.s3_resource", None)
+@patch.dict("extract.celeb_cache", {"etag": None, "fetched_at": None, "celebs": None, "by_icao": {}})
 @patch("boto3.resource")
 def test_get_celeb_json_from_s3(mocked_s3):
     """Tests get celeb json extracts and loads file contents correctly using mocked boto3
@@ -59,6 +107,32 @@ def test_get_celeb_json_from_s3(mocked_s3):
     assert data == {"please": "work"}
 
 
+@patch("extract.s3_resource", None)
+@patch.dict("extract.celeb_cache", {"etag": None, "fetched_at": None, "celebs": None, "by_icao": {}})
+@patch("boto3.resource")
+def test_celeb_json_is_cached_and_revalidated_with_etag(mocked_s3):
+    """Tests the watchlist is only fetched once within the cache TTL, is revalidated with its
+    ETag once the TTL is up, and is indexed by lowercase ICAO."""
+
+    os.environ["S3_BUCKET_NAME"] = "test_bucket"
+    os.environ["CELEB_INFO"] = "test"
+
+    mock_object = mocked_s3.return_value.Object.return_value
+    mock_readable = MagicMock()
+    mock_readable.read.return_value = '[{"icao_hex": "A835AF", "name": "Elon Musk"}]'
+    mock_object.get.return_value = {"Body": mock_readable, "ETag": '"abc"'}
+
+    assert get_celeb_index() == {"a835af": {"icao_hex": "A835AF", "name": "Elon Musk"}}
+    get_celeb_json()
+    mock_object.get.assert_called_once_with()
+
+    with patch("extract.CELEB_CACHE_TTL_SECONDS", 0):
+        mock_object.get.side_effect = ClientError({"Error": {"Code": "304"}}, "GetObject")
+        assert get_celeb_json() == [{"icao_hex": "A835AF", "name": "Elon Musk"}]
+    mock_object.get.assert_called_with(IfNoneMatch='"abc"')
+    mocked_s3.assert_called_once()
+
+
 @patch("requests.get")
 def test_api_call(mock_request):
     """Test the get current flight for icao function calls the api and reads the
@@ -72,3 +146,422 @@ def test_api_call(mock_request):
 
     mock_request.assert_called()
     assert data == "Success"
+
+
+def test_token_bucket_refills_up_to_capacity():
+    """Test the token bucket only hands out the tokens it has and refills over time."""
+
+    start = datetime(2023, 1, 1)
+    bucket = TokenBucket(rate=1, capacity=2, tokens=1, updated_at=start)
+
+    assert bucket.consume(start)
+    assert not bucket.consume(start)
+    assert bucket.consume(start + timedelta(seconds=1))
+    bucket.refill(start + timedelta(hours=1))
+    assert bucket.tokens == 2
+
+
+def test_parked_aircraft_backs_off_and_airborne_is_polled_every_run():
+    """Test an aircraft that isn't seen has its poll interval doubled up to the maximum, while
+    an airborne aircraft stays on the minimum interval."""
+
+    now = datetime(2023, 1, 1)
+    state = update_poll_state(None, {"ac": []}, now)
+    assert state["next_poll"] - now == MIN_POLL_INTERVAL
+
+    for _ in range(10):
+        now = state["next_poll"]
+        previous_interval = state["next_poll"] - state["last_polled"]
+        state = update_poll_state(state, {"ac": []}, now)
+        assert state["next_poll"] - now == min(MAX_POLL_INTERVAL, 2 * previous_interval)
+
+    state = update_poll_state(state, make_sample(now, alt_baro=35000, gs=450), now)
+    assert state["airborne"] and state["last_alt"] == 35000
+    assert state["next_poll"] - now == MIN_POLL_INTERVAL
+
+
+def make_sample(now: datetime, **aircraft) -> dict:
+    """Makes an API response with one aircraft sample at the given time."""
+    return {"ac": [{"r": "N1", "flight": "F1", **aircraft}] if aircraft else [],
+            "now": (now - datetime(1970, 1, 1)).total_seconds() * 1000}
+
+
+def test_flight_phases_and_landings_are_classified_from_samples():
+    """Test samples are classified from alt_baro, gs and baro_rate, and that a landing is spotted when a jet
+    is back on the ground, or disappears on approach, but not when it drops out of coverage at altitude."""
+
+    now = datetime(2023, 1, 1, 12)
+    assert get_flight_phase(make_sample(now)) == "missing"
+    assert get_flight_phase(make_sample(now, alt_baro="ground", gs=12)) == "ground"
+    assert get_flight_phase(make_sample(now, alt_baro=400, gs=20)) == "ground"
+    assert get_flight_phase(make_sample(now, alt_baro=1200, gs=140, baro_rate=-700)) == "approach"
+    assert get_flight_phase(make_sample(now, alt_baro=1200, gs=140, baro_rate=1500)) == "airborne"
+    assert get_flight_phase(make_sample(now, alt_baro=8000, gs=250, baro_rate=-1500)) == "approach"
+    assert get_flight_phase(make_sample(now, alt_baro=35000, gs=450, baro_rate=0)) == "airborne"
+
+    cruising = {"phase": "airborne", "last_seen": now - timedelta(minutes=10)}
+    approaching = dict(cruising, phase="approach")
+    assert detect_landing(cruising, make_sample(now, alt_baro="ground", gs=30)) == now
+    assert detect_landing(approaching, make_sample(now)) == now - timedelta(minutes=10)
+    assert detect_landing(cruising, make_sample(now)) is None
+    assert detect_landing({"phase": "ground"}, make_sample(now, alt_baro="ground")) is None
+    assert detect_landing(None, make_sample(now, alt_baro="ground")) is None
+
+
+def test_landing_on_approach_is_stamped_with_the_last_staged_sample():
+    """Test a jet that disappears on approach lands at the time its last staging row is stamped with (the
+    API response's now, later than the run's), so transform's landing closes the flight up to that row."""
+
+    run_started = datetime(2023, 1, 1, 12)
+    approach = make_sample(run_started + timedelta(seconds=4), alt_baro=1200, gs=140, baro_rate=-700)
+    state = update_poll_state(None, approach, run_started)
+
+    landed_at = detect_landing(state, make_sample(run_started + timedelta(minutes=10)))
+
+    assert landed_at == build_staging_rows([approach])[0][0] > run_started
+
+
+def test_poll_results_give_new_state_and_landings():
+    """Test the new poll state of every aircraft polled is returned (to be saved with its staging rows),
+    and only the ones that landed are returned as landings."""
+
+    now = datetime(2023, 1, 1, 12)
+    previous = {"last_polled": now - timedelta(minutes=10), "last_seen": now - timedelta(minutes=10),
+                "airborne": True, "phase": "approach", "last_alt": 1200, "last_speed": 140, "next_poll": now}
+    poll_state = {"abc123": previous, "def456": dict(previous, phase="airborne")}
+    flights = {"abc123": make_sample(now), "def456": make_sample(now, alt_baro=30000, gs=400)}
+
+    new_state, landings = get_poll_results({"abc123": {"tail_number": "N1"}}, poll_state, flights, now)
+
+    assert landings == [("N1", now - timedelta(minutes=10))]
+    assert new_state["abc123"]["phase"] == "missing" and new_state["def456"]["phase"] == "airborne"
+
+
+def test_landing_of_a_jet_missing_from_a_replay_watchlist_uses_its_last_registration():
+    """Test a jet that disappears on approach, with a watchlist carrying only ICAOs (as a replay's does),
+    lands under the registration it was last seen with, and is skipped rather than failing the run if
+    there isn't one."""
+
+    now = datetime(2023, 1, 1, 12)
+    approach = make_sample(now - timedelta(minutes=10), alt_baro=1200, gs=140, baro_rate=-700)
+    state = update_poll_state(None, approach, now - timedelta(minutes=10))
+    poll_state = {"abc123": state, "def456": dict(state, last_reg=None)}
+
+    _, landings = get_poll_results({"abc123": {"icao_hex": "abc123"}, "def456": {"icao_hex": "def456"}}, poll_state,
+                                   {"abc123": make_sample(now), "def456": make_sample(now)}, now)
+
+    assert state["last_reg"] == "N1" and landings == [("N1", state["last_seen"])]
+
+
+@patch("extract.push_to_staging_database")
+def test_poll_state_is_saved_only_with_the_staging_rows(mocked_push):
+    """Test the poll state and landings go in the same write as the staging rows, so a failed write
+    leaves the previous poll state for the next run to spot the landing again."""
+
+    now = datetime(2023, 1, 1, 12)
+    rows = build_staging_rows([make_sample(now, alt_baro="ground", gs=20)])
+    landings, poll_state = [("N1", now)], {"abc123": {"phase": "ground"}}
+    mocked_push.side_effect = ConnectionError
+
+    with patch("extract.DEAD_BAND_COMPRESSION", False), pytest.raises(ConnectionError):
+        write_staging_rows(rows, landings, poll_state)
+
+    mocked_push.assert_called_once()
+    assert mocked_push.call_args.args[1:] == (rows, {}, landings, poll_state)
+
+
+def test_select_icaos_to_poll_prioritises_airborne_within_budget():
+    """Test only due aircraft are selected, airborne first, and no more than the budget allows."""
+
+    now = datetime(2023, 1, 1)
+    parked = {"last_polled": now - timedelta(hours=3), "last_seen": None, "airborne": False,
+              "last_alt": None, "last_speed": None, "next_poll": now - timedelta(hours=1)}
+    airborne = dict(parked, airborne=True, last_seen=now, next_poll=now)
+    not_due = dict(parked, next_poll=now + timedelta(hours=1))
+    poll_state = {"parked": parked, "airborne": airborne, "not_due": not_due}
+
+    bucket = TokenBucket(rate=0, capacity=2, updated_at=now)
+    icaos = ["parked", "not_due", "new", "airborne"]
+
+    assert select_icaos_to_poll(icaos, poll_state, bucket, now) == ["airborne", "new"]
+
+
+def test_airborne_aircraft_is_due_on_a_run_that_starts_early():
+    """Test an aircraft polled every run is still due when the next run starts a second early, while a
+    parked one backing off isn't polled before its interval is up."""
+
+    polled_at = datetime(2023, 1, 1, 12, 0, 5)
+    airborne = update_poll_state(None, make_sample(polled_at, alt_baro=30000, gs=400), polled_at)
+    parked = {"last_polled": polled_at, "last_seen": None, "airborne": False, "last_alt": None,
+              "last_speed": None, "next_poll": polled_at + timedelta(hours=1)}
+    next_run = polled_at + MIN_POLL_INTERVAL - timedelta(seconds=1)
+
+    bucket = TokenBucket(rate=0, capacity=10, updated_at=next_run)
+    assert select_icaos_to_poll(["airborne", "parked"], {"airborne": airborne, "parked": parked},
+                                bucket, next_run) == ["airborne"]
+
+
+def test_write_batches_splits_queue_into_micro_batches():
+    """Test the stream writer drains the queue in batches of at most batch_size once stopped."""
+
+    positions = Queue()
+    for position in range(5):
+        positions.put(position)
+    stop = Event()
+    stop.set()
+
+    batches = []
+    write_batches(positions, stop, batch_size=2, batch_interval=60, write=batches.append)
+
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+@patch("stream.get_watchlist")
+@patch("stream.poll_flights")
+def test_poll_positions_queues_only_aircraft_in_the_air(mocked_poll, _):
+    """Test the stream poller polls on the adaptive schedule and queues the rows of aircraft with
+    flight data along with the poll's landings and poll state."""
+
+    stop = Event()
+    mocked_poll.side_effect = lambda *args, **kwargs: stop.set() or (
+        {"a": {"now": 0, "ac": [{"r": "N1"}]}, "b": {"now": 0, "ac": []}},
+        {"a": {"last_reg": "N1"}, "b": {"last_reg": "N2"}}, [("N2", "landed")])
+
+    polls = Queue(maxsize=10)
+    poll_positions(polls, stop, poll_interval=0)
+
+    assert mocked_poll.call_args.kwargs["adaptive"] is True
+    rows, landings, poll_state = polls.get()
+    assert [row[2] for row in rows] == ["N1"] and landings == [("N2", "landed")] and set(poll_state) == {"a", "b"}
+
+
+@patch("stream.write_poll_results")
+def test_write_polls_saves_the_latest_poll_state_of_each_aircraft(mocked_write):
+    """Test a batch of polls is written in one go, keeping the latest poll state of an aircraft polled twice."""
+
+    write_polls([([("row", 1)], [("N1", "landed")], {"a": {"next_poll": 1}}),
+                 ([("row", 2)], [], {"a": {"next_poll": 2}, "b": {"next_poll": 3}})])
+
+    mocked_write.assert_called_once_with([("row", 1), ("row", 2)], [("N1", "landed")],
+                                         {"a": {"next_poll": 2}, "b": {"next_poll": 3}})
+
+
+@patch("stream.ERROR_BACKOFF_SECONDS", 0)
+@patch("stream.get_watchlist")
+@patch("stream.poll_flights")
+def test_stream_threads_survive_poll_and_write_errors(mocked_poll, mocked_watchlist):
+    """Test a failed poll is retried, and a failed write is retried with the same batch rather than
+    losing the polls in it."""
+
+    stop = Event()
+    mocked_watchlist.side_effect = [ConnectionError, {}]
+    mocked_poll.side_effect = lambda *args, **kwargs: stop.set() or ({"a": {"now": 0, "ac": [{"r": "N1"}]}}, {}, [])
+    polls = Queue(maxsize=10)
+    poll_positions(polls, stop, poll_interval=0)
+    assert polls.qsize() == 1
+
+    write = MagicMock(side_effect=[ConnectionError, ConnectionError, None])
+    write_batches(polls, stop, batch_size=1, batch_interval=60, write=write)
+    assert write.call_count == 3 and all(call.args[0][0][0][0][2] == "N1" for call in write.call_args_list)
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+@patch("stream.signal.signal")
+@patch("stream.write_batches")
+@patch("stream.poll_positions")
+def test_stream_exits_non_zero_when_a_thread_dies(mocked_poll, mocked_write, _):
+    """Test the daemon stops and exits with an error when its writer thread dies."""
+
+    mocked_poll.side_effect = lambda positions, stop: stop.wait()
+    mocked_write.side_effect = RuntimeError
+
+    with pytest.raises(SystemExit) as exit_info:
+        run()
+    assert exit_info.value.code == 1
+
+
+@patch("sqlalchemy.create_engine")
+def test_sql_engine_is_reused_between_connections(mocked_create_engine):
+    """Test a second SQL object made with the same config reuses the cached engine."""
+
+    config = {"DB_HOST": "cached-host", "DB_PORT": 5432, "DB_USER": "user", "DB_PASSWORD": "pw", "DB_NAME": "db"}
+
+    assert SQL(config).engine is SQL(config).engine
+    mocked_create_engine.assert_called_once()
+
+
+def test_build_staging_rows_matches_get_flight_params():
+    """Test the columnar rows hold the same values as get_flight_params, in staging column
+    order, skip aircraft that aren't tracked and store "ground" altitudes as 0."""
+
+    flights = [{"now": 1686000000000, "ac": [{"flight": "N628TS  ", "r": "N628TS", "t": "GLF6",
+                                              "alt_baro": "ground", "gs": 12.5, "lat": 51.5, "lon": -0.1,
+                                              "hex": "a835af", "category": "A3"}]},
+               {"now": 1686000000000, "ac": []}]
+
+    rows = build_staging_rows(flights)
+    record = get_flight_params(flights[0])
+
+    assert len(rows) == 1
+    assert rows[0] == tuple(record.get(column) for column in STAGING_COLUMNS)
+    assert record["barometric_alt"] == 0 and "emergency" not in record
+
+
+def make_staging_row(minute: int, lat: float, alt: int = 0, flight_no: str = "N1") -> tuple:
+    """Makes a staging row of aircraft N1 at the given minute past midnight and position."""
+
+    return (datetime(2023, 1, 1, 0, minute), flight_no, "N1", "GLF6", alt, alt, 0, 90, 0, "none", lat, 0)
+
+
+def test_dead_band_compression_keeps_first_and_last_points():
+    """Test that samples of a parked aircraft are merged into a single trailing row, keeping the
+    first and latest points, while a sample outside the dead-band is inserted."""
+
+    parked = [make_staging_row(minute, 51.5) for minute in range(5)]
+    moved = make_staging_row(5, 52.5, alt=10000)
+
+    inserts, updates = compress_staging_rows(parked + [moved], {})
+
+    assert inserts == [parked[0], parked[-1], moved] and not updates
+
+
+def test_dead_band_compression_updates_stored_last_point():
+    """Test that a sample within the dead-band of the stored track overwrites the stored last
+    point, but never the stored first point of a flight."""
+
+    first, last = make_staging_row(0, 51.5), make_staging_row(1, 51.5)
+    new = make_staging_row(2, 51.5)
+
+    assert compress_staging_rows([new], {("N1", "N1"): [(7, first)]}) == ([new], {})
+    assert compress_staging_rows([new], {("N1", "N1"): [(7, first), (8, last)]}) == ([], {8: new})
+    assert compress_staging_rows([make_staging_row(2, 51.5, flight_no="N2")],
+                                 {("N1", "N1"): [(7, first), (8, last)]})[1] == {}
+
+
+def test_recorded_responses_are_replayed_in_time(tmp_path):
+    """Test responses written by the recorder are replayed as the latest one recorded at the time
+    on the replay clock."""
+
+    responses = iter([{"now": 1686000000000, "ac": [{"r": "N1"}]}, {"now": 1686000600000, "ac": [{"r": "N1"}]}])
+    recorder = ResponseRecorder(str(tmp_path / "responses.jsonl.gz"))
+    fetch = recorder.wrap(lambda icao, session: next(responses))
+    fetch("A1")
+    fetch("A1")
+    recorder.flush()
+
+    provider = ReplayProvider(str(tmp_path / "responses.jsonl.gz"), speed=0)
+    assert provider.get_celebs() == [{"icao_hex": "a1"}]
+    assert provider.get_flight("A1")["now"] == 1686000000000
+    provider.clock.advance(600)
+    assert provider.get_flight("a1")["now"] == 1686000600000
+    assert provider.get_flight("b2")["ac"] == []
+
+
+def test_synthetic_aircraft_fly_plausible_tracks():
+    """Test synthetic aircraft give valid staging rows and move at a plausible speed between polls."""
+
+    provider = SyntheticProvider(50, speed=0)
+    celebs = provider.get_celebs()
+
+    before = {celeb["icao_hex"]: provider.get_flight(celeb["icao_hex"]) for celeb in celebs}
+    provider.clock.advance(60)
+    after = {celeb["icao_hex"]: provider.get_flight(celeb["icao_hex"]) for celeb in celebs}
+
+    flying = [icao for icao in before if before[icao]["ac"] and after[icao]["ac"]]
+    assert flying and len(build_staging_rows(list(after.values()))) <= len(celebs)
+    for icao in flying:
+        start, end = before[icao]["ac"][0], after[icao]["ac"][0]
+        assert 0 <= start["alt_baro"] <= 41000 and -90 <= start["lat"] <= 90
+        assert abs(end["lat"] - start["lat"]) < 0.2
+
+
+def test_consistent_hashing_balances_shards_and_moves_few_aircraft():
+    """Test the watchlist is split evenly over shards, and adding a shard only moves the aircraft
+    it takes over."""
+
+    celeb_index = {f"{i:06x}": {"icao_hex": f"{i:06x}"} for i in range(4000)}
+    partitions = partition_celebs(celeb_index, 4)
+    assert sum(len(partition) for partition in partitions) == 4000
+    assert all(700 < len(partition) < 1300 for partition in partitions)
+
+    four, five = HashRing(4), HashRing(5)
+    moved = [icao for icao in celeb_index if four.get_shard(icao) != five.get_shard(icao)]
+    assert all(five.get_shard(icao) == 4 for icao in moved)
+    assert len(moved) < 1300
+
+
+@patch("extract.extract_flights")
+@patch("extract.get_watchlist")
+def test_handler_extracts_only_its_shard(mocked_watchlist, mocked_extract):
+    """Test a worker invocation only extracts the aircraft of its own shard."""
+
+    celeb_index = {f"{i:06x}": {"icao_hex": f"{i:06x}"} for i in range(100)}
+    mocked_watchlist.return_value = celeb_index
+    mocked_extract.return_value = 3
+
+    assert handler({"shard": 1, "shards": 3}) == '{"rows_written": 3}'
+    assert mocked_extract.call_args.args == (partition_celebs(celeb_index, 3)[1], 1, 3, None)
+
+
+@patch("extract.EXTRACT_FAN_OUT", "lambda")
+@patch("extract.EXTRACT_SHARDS", 4)
+@patch("extract.boto3.client")
+def test_handler_reports_shards_invoked_by_lambda_fan_out(mocked_client):
+    """Test the coordinator of a lambda fan-out invokes every shard and says so, as it can't know the rows written."""
+
+    assert handler({}, MagicMock(function_name="extract")) == '{"shards_invoked": 4}'
+    assert mocked_client.return_value.invoke.call_count == 4
+
+
+def make_response(status_code: int, body: dict = None) -> MagicMock:
+    """Makes a mocked requests.Response."""
+    response = MagicMock(status_code=status_code, headers={})
+    response.json.return_value = body
+    return response
+
+
+def test_adsb_client_retries_throttled_requests_with_backoff():
+    """Test 429 and 5xx responses are retried, and other responses returned straight away."""
+
+    responses = iter([make_response(429), make_response(503), make_response(200, {"ac": []})])
+    client = AdsbClient(lambda icao, session, timeout: next(responses), DeadlineBudget(10), CircuitBreaker(),
+                        backoff=0.01)
+    assert client.get_flight("a1") == {"ac": []}
+    assert client.requests_sent == 3
+
+
+def test_adsb_client_hedges_slow_requests_within_the_deadline():
+    """Test a slow request is answered by its hedge, and a run out of budget gives up."""
+
+    calls = []
+    def get(icao, session, timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.5)
+        return make_response(200, {"ac": [], "call": len(calls)})
+
+    client = AdsbClient(get, DeadlineBudget(5), CircuitBreaker(), hedge_after=0.05, hedge_ratio=1)
+    assert client.get_flight("a1")["call"] == 2
+    assert all(timeout <= 5 for timeout in calls)
+
+    breaker = CircuitBreaker(failure_threshold=1)
+    client = AdsbClient(lambda icao, session, timeout: time.sleep(0.5), DeadlineBudget(0.1), breaker,
+                        hedge_after=1)
+    with pytest.raises(DeadlineExceeded):
+        client.get_flight("a1")
+    # Running out of the run's own budget doesn't count against the API
+    assert breaker.state == "closed"
+
+
+def test_circuit_breaker_opens_and_half_opens():
+    """Test the breaker rejects requests after repeated failures, then lets a single trial through."""
+
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
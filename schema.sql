@@ -16,7 +16,7 @@ CREATE TABLE "tracked_event"(
     "flight_no" VARCHAR(10) NOT NULL,
     "aircraft_reg" VARCHAR(10) NOT NULL,
     "model" VARCHAR(10) NOT NULL,
-    "borometric_alt" INTEGER NOT NULL,
+    "barometric_alt" INTEGER NOT NULL,
     "geometric_alt" INTEGER NOT NULL,
     "ground_speed" FLOAT NOT NULL,
     "true_track" FLOAT NOT NULL,
@@ -24,7 +24,70 @@ CREATE TABLE "tracked_event"(
     "emergency" TEXT NOT NULL,
     "lat" FLOAT NOT NULL,
     "lon" FLOAT NOT NULL,
-    PRIMARY KEY("event_id")
+    PRIMARY KEY("event_id", "time_input")
+   ) PARTITION BY RANGE ("time_input");
+-- Daily partitions (tracked_event_YYYYMMDD) are created by extract as rows arrive for a day,
+-- and dropped by transform once every event in them has been processed
+
+CREATE INDEX "tracked_event_time_input_index" ON "tracked_event"("time_input");
+CREATE INDEX "tracked_event_flight_index" ON "tracked_event"("aircraft_reg", "flight_no", "time_input");
+
+-- Flights still in the air as of the transform watermark, so transform only reads newer events
+CREATE TABLE "open_flight"(
+    "aircraft_reg" VARCHAR(10) NOT NULL,
+    "flight_no" VARCHAR(10) NOT NULL,
+    "dep_time" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    "dep_lat" FLOAT NOT NULL,
+    "dep_lon" FLOAT NOT NULL,
+    "arr_time" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    "arr_lat" FLOAT NOT NULL,
+    "arr_lon" FLOAT NOT NULL,
+    "max_alt" INTEGER NOT NULL,
+    "airborne" BOOLEAN NOT NULL DEFAULT FALSE,
+    "emergency" TEXT NOT NULL,
+    "duration" INTERVAL GENERATED ALWAYS AS ("arr_time" - "dep_time") STORED,
+    PRIMARY KEY("aircraft_reg", "flight_no")
+   );
+
+-- Landings spotted by extract. Transform closes the landed jet's flights with them straight away,
+-- and then (applied) skips the jet's events up to the landing as they have been folded in already
+CREATE TABLE "landing"(
+    "aircraft_reg" VARCHAR(10) NOT NULL,
+    "landed_at" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    "applied" BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY("aircraft_reg", "landed_at")
+   );
+
+CREATE TABLE "transform_watermark"(
+    "name" VARCHAR(20) NOT NULL,
+    "watermark" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY("name")
+   );
+
+-- Parallel transform runs whose flight shards are to be committed (see insert_flights_in_parallel)
+CREATE TABLE "transform_commit"(
+    "run_id" VARCHAR(32) NOT NULL,
+    PRIMARY KEY("run_id")
+   );
+
+CREATE TABLE "aircraft_poll_state"(
+    "icao_hex" VARCHAR(6) NOT NULL,
+    "last_polled" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    "last_seen" TIMESTAMP(0) WITHOUT TIME ZONE,
+    "airborne" BOOLEAN NOT NULL DEFAULT FALSE,
+    "phase" VARCHAR(10),
+    "last_alt" INTEGER,
+    "last_speed" FLOAT,
+    "last_reg" VARCHAR(10),
+    "next_poll" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY("icao_hex")
+   );
+
+CREATE TABLE "api_budget"(
+    "name" VARCHAR(20) NOT NULL,
+    "tokens" FLOAT NOT NULL,
+    "updated_at" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY("name")
    );
 
 
@@ -53,8 +116,8 @@ CREATE TABLE IF NOT EXISTS "gender"(
 );
 
 CREATE TABLE IF NOT EXISTS "owner_role_link"(
-    "owner_id" INTEGER GENERATED ALWAYS AS IDENTITY,
-    "job_role_id" INTEGER NOT NULL UNIQUE,
+    "owner_id" INTEGER NOT NULL,
+    "job_role_id" INTEGER NOT NULL,
     UNIQUE ("owner_id", "job_role_id")
 );
 
@@ -89,6 +152,14 @@ CREATE TABLE IF NOT EXISTS "airport"(
     PRIMARY KEY("airport_id")
 );
 
+-- The version of each reference file the production tables were last loaded from, so that an unchanged
+-- file isn't loaded again
+CREATE TABLE IF NOT EXISTS "reference_source"(
+    "name" VARCHAR(50) NOT NULL,
+    "version" TEXT NOT NULL,
+    PRIMARY KEY("name")
+);
+
 CREATE TABLE IF NOT EXISTS "flight"(
     "flight_id" INTEGER GENERATED ALWAYS AS IDENTITY,
     "flight_number" VARCHAR(10) NOT NULL,
@@ -98,7 +169,11 @@ CREATE TABLE IF NOT EXISTS "flight"(
     "arr_time" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
     "tail_number" VARCHAR(10) NOT NULL,
     "emergency_id" INTEGER NOT NULL,
+    "flight_hours" FLOAT NOT NULL,
     "fuel_usage" FLOAT,
+    "fuel_cost" FLOAT,
+    "co2_emissions" FLOAT,
+    UNIQUE("tail_number", "flight_number", "dep_time"),
     PRIMARY KEY("flight_id")
 );
 
@@ -23,6 +23,18 @@ data aws_iam_policy_document lambda_s3 {
       "arn:aws:s3:::${aws_s3_bucket.jet_bucket.bucket}/*"
     ]
   }
+
+  # The staging lambda invokes itself once per shard of the watchlist, and the production
+  # lambda when it spots landings
+  statement {
+    actions = [
+      "lambda:InvokeFunction"
+    ]
+    resources = [
+      aws_lambda_function.jet_staging_lambda.arn,
+      aws_lambda_function.jet_production_lambda.arn
+    ]
+  }
 }
 
 
@@ -78,6 +90,14 @@ resource "aws_lambda_function" "jet_staging_lambda" {
 
         S3_BUCKET_NAME=aws_s3_bucket.jet_bucket.bucket
         CELEB_INFO=var.celeb_info
+
+        # A single invocation polls the whole watchlist; raise EXTRACT_SHARDS to fan a large watchlist
+        # out over that many asynchronous invocations of this lambda
+        EXTRACT_SHARDS=1
+        EXTRACT_FAN_OUT="lambda"
+
+        LANDING_DETECTION="true"
+        TRANSFORM_FUNCTION_NAME=aws_lambda_function.jet_production_lambda.function_name
     }
   }
 }
@@ -117,6 +137,8 @@ resource "aws_lambda_function" "jet_production_lambda" {
   image_uri     = "${var.account_id}.dkr.ecr.eu-west-2.amazonaws.com/jet-production-repo:latest"
   package_type  = "Image"
   architectures = ["x86_64"]
+  # Runs triggered by landings queue up behind each other rather than racing
+  reserved_concurrent_executions = 1
 
   # Define environment variables in lambda
   environment {
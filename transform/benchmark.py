@@ -0,0 +1,30 @@
+"""Benchmarks flight segmentation on a synthetic staging table, comparing segment_flights with the
+nested loops it replaced (on a slice of the table, as they are far too slow for all of it):
+
+    python benchmark.py [number of rows]
+"""
+import sys
+import time
+import pandas as pd
+
+from synthetic import make_tracked_events, segment_flights, segment_flights_nested_loops
+
+
+def time_segmentation(name: str, segment, events: pd.DataFrame, now: pd.Timestamp) -> None:
+    """Times a segmentation function over the events and prints its throughput."""
+
+    started = time.perf_counter()
+    flights = segment(events, now)
+    elapsed = time.perf_counter() - started
+    print(f"{name:>12}: {len(events):,} rows, {len(flights):,} flights in {elapsed:.2f}s "
+          f"({len(events) / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    tracked_events = make_tracked_events(rows)
+    benchmark_now = pd.Timestamp.now()
+
+    time_segmentation("nested loops", segment_flights_nested_loops, tracked_events[:min(rows, 50_000)], benchmark_now)
+    time_segmentation("single pass", segment_flights, tracked_events[:min(rows, 50_000)], benchmark_now)
+    time_segmentation("single pass", segment_flights, tracked_events, benchmark_now)
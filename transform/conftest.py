@@ -1,8 +1,10 @@
 import pytest
 import os
 import json
+import pandas as pd
 
 from utilities import clean_airport_data
+from synthetic import make_tracked_events
 
 
 def load_json_from_data_directory(file_name: str) -> dict | list:
@@ -16,6 +18,12 @@ def load_json_from_data_directory(file_name: str) -> dict | list:
         return json.load(f)
 
 
+@pytest.fixture
+def tracked_events() -> pd.DataFrame:
+    """Returns a shuffled staging table of 5000 synthetic tracked events over 20 jets."""
+    return make_tracked_events(5000, n_jets=20)
+
+
 @pytest.fixture
 def airport_data() -> dict[dict]:
     """Returns airport data as dict of dicts."""
@@ -0,0 +1,51 @@
+"""This module contains an in-memory cache of the small dimension tables of the production db (gender,
+job role, owner, model, emergency, airport), so that ids are resolved without a query per row."""
+from psycopg2.extras import execute_values
+from psycopg2.extensions import cursor
+
+
+class DimensionCache():
+    """Maps the keys of a dimension table to their ids, loaded with a single SELECT. Unknown keys are
+    queued with add and inserted together by flush, which also records their new ids. Expects a
+    RealDictCursor, the table, key and id column names, and the columns a new row is inserted with
+    (just the key column if not given, otherwise starting with it)."""
+
+    def __init__(self, curs: cursor, table: str, key_column: str, id_column: str, columns: list[str] = None) -> None:
+        self.curs = curs
+        self.table = table
+        self.key_column = key_column
+        self.id_column = id_column
+        self.columns = columns or [key_column]
+        self.pending = {}
+
+        curs.execute(f"SELECT {key_column}, {id_column} FROM {table}")
+        self.ids = {row[key_column]: row[id_column] for row in curs.fetchall()}
+
+    def __contains__(self, key) -> bool:
+        return key in self.ids
+
+    def __getitem__(self, key) -> int:
+        return self.ids[key]
+
+    def get(self, key) -> int | None:
+        """Returns the id of a key, or None if it isn't in the table (yet)."""
+
+        return self.ids.get(key)
+
+    def add(self, key, *values) -> None:
+        """Queues a row for the key to be inserted on the next flush, unless the key is already known.
+        Expects the values of the rest of the columns, in order."""
+
+        if key is not None and key not in self.ids and key not in self.pending:
+            self.pending[key] = (key, *values)
+
+    def flush(self) -> None:
+        """Inserts all queued rows in one statement and records their ids."""
+
+        if not self.pending:
+            return
+        rows = execute_values(self.curs, f"""INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES %s
+                              RETURNING {self.key_column}, {self.id_column}""", list(self.pending.values()),
+                              fetch=True)
+        self.ids.update((row[self.key_column], row[self.id_column]) for row in rows)
+        self.pending.clear()
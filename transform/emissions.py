@@ -0,0 +1,39 @@
+"""This module derives the duration, fuel usage, fuel cost and CO2 emissions of a batch of flights in one go,
+as numpy arrays, so that transform can store them with each flight and the dashboard only has to read them."""
+import numpy as np
+
+
+CO2_PER_GALLON = 0.01 # metric tons of CO2 per gallon of jet fuel
+FUEL_COST_PER_GALLON = 5.91 # dollars, https://www.airnav.com/fuel/report.html
+
+
+def get_flight_hours(dep_times: list, arr_times: list) -> np.ndarray:
+    """Returns the duration in hours of each flight, however long, counting whole seconds. Expects departure
+    and arrival times as sequences of datetimes (or datetime64 arrays)."""
+
+    durations = np.asarray(arr_times, dtype="datetime64[us]") - np.asarray(dep_times, dtype="datetime64[us]")
+    return (durations // np.timedelta64(1, "s")) / 60**2
+
+
+def get_fuel_rates(aircraft_models: list[str], aircraft_info: dict[dict]) -> np.ndarray:
+    """Looks up the fuel consumption rate (galph = gallons per hour) of each flight's aircraft model, once
+    per distinct model. Models without fuel data get NaN."""
+
+    models, model_indexes = np.unique(np.asarray(aircraft_models, dtype=object), return_inverse=True)
+    rates = np.array([aircraft_info.get(model, {}).get("galph", np.nan) for model in models], dtype=float)
+    return rates[model_indexes]
+
+
+def calculate_flight_emissions(dep_times: list, arr_times: list, aircraft_models: list[str],
+                               aircraft_info: dict[dict]) -> dict[str, np.ndarray]:
+    """Calculates the hours, fuel usage (gallons), fuel cost (dollars) and CO2 emissions (metric tons)
+    of a batch of flights. Expects departure/arrival times, aircraft model codes and aircraft info.
+    Returns an array of each, keyed by "flight_hours", "fuel_usage", "fuel_cost" and "co2_emissions"."""
+
+    if np.size(dep_times) == 0:
+        return {name: np.empty(0) for name in ("flight_hours", "fuel_usage", "fuel_cost", "co2_emissions")}
+
+    flight_hours = get_flight_hours(dep_times, arr_times)
+    fuel_usage = flight_hours * get_fuel_rates(aircraft_models, aircraft_info)
+    return {"flight_hours": flight_hours, "fuel_usage": fuel_usage,
+            "fuel_cost": fuel_usage * FUEL_COST_PER_GALLON, "co2_emissions": fuel_usage * CO2_PER_GALLON}
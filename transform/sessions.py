@@ -0,0 +1,116 @@
+"""This module splits the stream of tracked events into flights incrementally. The flights still in the
+air are kept as compact open-flight state (first and last points, highest altitude and emergency), so each
+run only reads what was staged since the last one instead of rebuilding every flight from raw events. The
+database hands over the new events already gathered into runs of each flight, which fold in like single events."""
+from datetime import datetime, timedelta
+
+
+# barometric altitude of a jet on the ground (extract stores ADS-B's "ground" as 0)
+GROUND_ALTITUDE = 0
+# Below this barometric altitude (feet) a jet slower than LANDED_GROUND_SPEED (knots) is on the ground too,
+# even if its transponder doesn't report "ground" (the same rule as extract's landing detection)
+LOW_ALTITUDE = 2000
+LANDED_GROUND_SPEED = 60
+
+OPEN_FLIGHT_COLUMNS = ["aircraft_reg", "flight_no", "dep_time", "dep_lat", "dep_lon",
+                       "arr_time", "arr_lat", "arr_lon", "max_alt", "airborne", "emergency"]
+# A run of a flight's events, as found by the database
+SEGMENT_COLUMNS = ["aircraft_reg", "flight_no", "continues", "dep_time", "dep_lat", "dep_lon",
+                   "arr_time", "arr_lat", "arr_lon", "max_alt", "airborne", "landed", "emergency"]
+
+
+def is_on_ground(event: dict) -> bool:
+    """Whether a tracked event shows its jet on the ground: reported as such, or low and slow."""
+
+    altitude, speed = event["barometric_alt"], event["ground_speed"]
+    return altitude <= GROUND_ALTITUDE or (altitude < LOW_ALTITUDE and speed is not None and speed < LANDED_GROUND_SPEED)
+
+
+class FlightSessionizer():
+    """Folds tracked events into open flights keyed by aircraft registration and flight number. A flight
+    is closed when its jet lands (is back on the ground after having been airborne), or when it has had
+    no events for longer than gap. Closed flights that never left the ground (taxiing, or parked with a
+    flight number, at any airport elevation) are dropped. Expects the open flights as dicts with the OPEN_FLIGHT_COLUMNS, and the gap."""
+
+    def __init__(self, open_flights: list[dict], gap: timedelta) -> None:
+        self.open_flights = {(flight["aircraft_reg"], flight["flight_no"]): dict(flight) for flight in open_flights}
+        self.gap = gap
+        self.closed_flights = []
+
+    def add(self, event: dict) -> None:
+        """Folds a tracked event into its flight, opening a new one if there isn't one. Expects the
+        events of each flight in time order."""
+
+        key = (event["aircraft_reg"], event["flight_no"])
+        if None in key:
+            return
+
+        flight = self.open_flights.get(key)
+        if flight is not None and event["time_input"] <= flight["arr_time"]:
+            return
+        on_ground = is_on_ground(event)
+        continues = flight is not None and event["time_input"] - flight["arr_time"] <= self.gap
+        self.add_segment({"aircraft_reg": key[0], "flight_no": key[1], "continues": continues,
+                          "dep_time": event["time_input"], "dep_lat": event["lat"], "dep_lon": event["lon"],
+                          "arr_time": event["time_input"], "arr_lat": event["lat"], "arr_lon": event["lon"],
+                          "max_alt": event["barometric_alt"], "airborne": not on_ground,
+                          "landed": continues and on_ground and flight["airborne"], "emergency": event["emergency"]})
+
+    def add_segment(self, segment: dict) -> None:
+        """Folds a run of a flight's events into it, closing the open flight first unless the run continues
+        it (comes within the gap of it, with no landing in between). Expects the run's first and last points,
+        highest altitude and last emergency, whether it was airborne, and whether it ended by landing, as
+        dicts with the SEGMENT_COLUMNS, and the runs of each flight in time order."""
+
+        key = (segment["aircraft_reg"], segment["flight_no"])
+        flight = self.open_flights.get(key)
+        if flight is not None and not segment["continues"]:
+            self.close(key)
+            flight = None
+        if flight is None:
+            flight = self.open_flights[key] = {"aircraft_reg": key[0], "flight_no": key[1],
+                                               "dep_time": segment["dep_time"], "dep_lat": segment["dep_lat"],
+                                               "dep_lon": segment["dep_lon"], "max_alt": segment["max_alt"],
+                                               "airborne": False}
+
+        flight.update(arr_time=segment["arr_time"], arr_lat=segment["arr_lat"], arr_lon=segment["arr_lon"],
+                      max_alt=max(flight["max_alt"], segment["max_alt"]), emergency=segment["emergency"],
+                      airborne=flight["airborne"] or segment["airborne"])
+        if segment["landed"]:
+            self.close(key)
+
+    def close(self, key: tuple) -> None:
+        """Closes an open flight, keeping it if the jet took off."""
+
+        flight = self.open_flights.pop(key)
+        if flight["airborne"]:
+            self.closed_flights.append(flight)
+
+    def land(self, aircraft_reg: str, landed_at: datetime) -> None:
+        """Closes the flights of a jet that extract saw land, unless they have events after the landing."""
+
+        for key, flight in list(self.open_flights.items()):
+            if key[0] == aircraft_reg and flight["arr_time"] <= landed_at:
+                self.close(key)
+
+    def close_idle(self, cutoff: datetime) -> None:
+        """Closes the flights without events after the cutoff, as their jets are no longer in the air."""
+
+        for key, flight in list(self.open_flights.items()):
+            if flight["arr_time"] <= cutoff:
+                self.close(key)
+
+    def get_state(self) -> list[tuple]:
+        """Returns the open flights as rows of the OPEN_FLIGHT_COLUMNS."""
+
+        return [tuple(flight[column] for column in OPEN_FLIGHT_COLUMNS) for flight in self.open_flights.values()]
+
+    def pop_closed_flights(self) -> list[tuple]:
+        """Returns the flights closed so far as (tail number, flight number, departure time, departure
+        location, arrival time, arrival location, emergency) tuples, in the order they closed."""
+
+        flights = [(flight["aircraft_reg"], flight["flight_no"], flight["dep_time"], (flight["dep_lat"], flight["dep_lon"]),
+                    flight["arr_time"], (flight["arr_lat"], flight["arr_lon"]), flight["emergency"])
+                   for flight in self.closed_flights]
+        self.closed_flights = []
+        return flights
@@ -0,0 +1,252 @@
+"""This module compiles the reference datasets (airports, aircraft fuel consumption rates and jet owners) into
+a compact, versioned binary snapshot, so that a cold start neither downloads and parses the JSON files nor
+builds the airport index. A snapshot file is laid out as:
+
+    MAGIC | header length (uint32) | JSON header | padding to 8 bytes | arrays
+
+The header holds the format version, the versions of the source files the snapshot was built from, the
+small datasets and the string columns of the airports, and the dtype, shape and offset of each array (the
+airport coordinates and unit vectors, and the airport index's tree). The arrays are read straight from a
+memory map, and the batch airport lookups use them as they are.
+
+Snapshots are stored next to the source files, in S3 or LOCAL_DATA_DIR, and cached in SNAPSHOT_CACHE_DIR.
+Running this module builds and stores a fresh snapshot:
+
+    python snapshot.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mmap
+import os
+import struct
+import numpy as np
+from dotenv import load_dotenv
+from s3fs import S3FileSystem
+
+from utilities import AirportIndex, clean_airport_data
+
+
+AIRPORTS_JSON = "airports.json"
+AIRCRAFTS_JSON = "aircraft_fuel_consumption_rates.json"
+JET_OWNERS_JSON = "celeb_planes.json"
+SOURCE_FILES = (AIRPORTS_JSON, AIRCRAFTS_JSON, JET_OWNERS_JSON)
+S3_BUCKET_NAME = "jet-bucket"
+SNAPSHOT_FILE = "reference_snapshot.bin"
+SNAPSHOT_FORMAT_VERSION = 2
+MAGIC = b"JETSNAP\0"
+ALIGNMENT = 8
+
+# The reference data of the last invocation, reused by warm invocations while the sources are unchanged
+reference_cache = {"sources": None, "reference": None}
+
+
+class ReferenceStore():
+    """Reads and writes the reference files in LOCAL_DATA_DIR if it is set, otherwise in the s3 bucket.
+    Expects the environment config."""
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.local_dir = config.get("LOCAL_DATA_DIR")
+        self.s3_session = None
+
+    def get_s3_session(self) -> S3FileSystem:
+        """Returns an s3 session, made on first use and shared by all the store's requests."""
+
+        if self.s3_session is None:
+            self.s3_session = S3FileSystem(key=self.config["ACCESS_KEY"], secret=self.config["SECRET_KEY"])
+        return self.s3_session
+
+    def get_path(self, file_name: str) -> str:
+        """The local or s3 path of a file."""
+
+        if self.local_dir:
+            return os.path.join(self.local_dir, file_name)
+        return f"{self.config.get('S3_BUCKET_NAME', S3_BUCKET_NAME)}/{file_name}"
+
+    def get_version(self, file_name: str) -> str | None:
+        """A string that changes whenever the file does (the ETag in s3, size and modification time
+        locally), or None if the file doesn't exist."""
+
+        try:
+            if self.local_dir:
+                stat = os.stat(self.get_path(file_name))
+                return f"{stat.st_size}-{stat.st_mtime_ns}"
+            return self.get_s3_session().info(self.get_path(file_name))["ETag"]
+        except FileNotFoundError:
+            return None
+
+    def read(self, file_name: str) -> bytes:
+        """Reads a whole file."""
+
+        if self.local_dir:
+            with open(self.get_path(file_name), "rb") as file:
+                return file.read()
+        return self.get_s3_session().cat_file(self.get_path(file_name))
+
+    def download(self, file_name: str, path: str) -> None:
+        """Copies a file to a local path, replacing any file there in one go rather than rewriting it
+        in place, as it may be the snapshot memory-mapped by the reference data in use."""
+
+        with open(path + ".part", "wb") as file:
+            file.write(self.read(file_name))
+        os.replace(path + ".part", path)
+
+    def upload(self, path: str, file_name: str) -> None:
+        """Stores a local file under the given name."""
+
+        with open(path, "rb") as file:
+            data = file.read()
+        if self.local_dir:
+            with open(self.get_path(file_name), "wb") as file:
+                file.write(data)
+        else:
+            self.get_s3_session().pipe_file(self.get_path(file_name), data)
+
+
+class ReferenceData():
+    """The reference datasets as loaded from a snapshot: the airport index, the name and ISO country
+    code of each airport (in the index's listing order), the aircraft fuel data and the jet owners."""
+
+    def __init__(self, sources: dict[str, str], airport_index: AirportIndex, airport_names: list[str],
+                 airport_isos: list[str], aircraft_info: dict[dict], owner_info: list[dict]) -> None:
+        self.sources = sources
+        self.airport_index = airport_index
+        self.airport_names = airport_names
+        self.airport_isos = airport_isos
+        self.aircraft_info = aircraft_info
+        self.owner_info = owner_info
+
+    def get_airport_info(self) -> dict[dict]:
+        """The airports in the form of clean_airport_data, keyed by IATA code."""
+
+        airport_index = self.airport_index
+        return {iata: {"name": name, "iata": iata, "lat": lat, "lon": lon, "iso": iso}
+                for iata, name, lat, lon, iso in zip(airport_index.iatas, self.airport_names,
+                                                     airport_index.lats.tolist(), airport_index.lons.tolist(),
+                                                     self.airport_isos)}
+
+
+def build_snapshot(airports: list[dict], aircraft_info: dict[dict], owner_info: list[dict], sources: dict[str, str]) -> bytes:
+    """Compiles the parsed reference files into a snapshot. Expects the airports as listed in airports.json,
+    the aircraft fuel data, the jet owners and the versions of the source files. Returns the snapshot."""
+
+    airport_info = clean_airport_data(airports)
+    airport_index = AirportIndex(airport_info)
+    tree_orders, tree_axes, _ = airport_index.get_tree_arrays()
+    arrays = {"lats": airport_index.lats.astype("<f8"), "lons": airport_index.lons.astype("<f8"),
+              "vectors": airport_index.vectors.astype("<f8"), "tree_orders": tree_orders, "tree_axes": tree_axes}
+
+    array_headers, offset = {}, 0
+    for name, array in arrays.items():
+        array_headers[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        "format": SNAPSHOT_FORMAT_VERSION, "sources": sources, "arrays": array_headers,
+        "airports": {"iata": airport_index.iatas, "name": [airport.get("name") for airport in airport_info.values()],
+                     "iso": [airport.get("iso") for airport in airport_info.values()]},
+        "aircraft_info": aircraft_info, "owner_info": owner_info,
+    }, separators=(",", ":")).encode("utf-8")
+
+    snapshot = bytearray(MAGIC + struct.pack("<I", len(header)) + header)
+    snapshot += bytes(-len(snapshot) % ALIGNMENT)
+    for array in arrays.values():
+        snapshot += array.tobytes()
+        snapshot += bytes(-array.nbytes % ALIGNMENT)
+    return bytes(snapshot)
+
+
+def read_snapshot_header(snapshot: bytes | mmap.mmap) -> tuple[dict, int]:
+    """Reads the header of a snapshot. Returns it with the offset the arrays start at, raising
+    ValueError if the file isn't a snapshot of the current format."""
+
+    if snapshot[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a reference data snapshot")
+    (header_length,) = struct.unpack("<I", snapshot[len(MAGIC):len(MAGIC) + 4])
+    header_end = len(MAGIC) + 4 + header_length
+    header = json.loads(bytes(snapshot[len(MAGIC) + 4:header_end]))
+    if header["format"] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Snapshot format {header['format']} isn't supported")
+    return header, header_end + -header_end % ALIGNMENT
+
+
+def load_snapshot(path: str) -> ReferenceData:
+    """Loads a snapshot file. The arrays are views of a read-only memory map of the file, so they
+    are neither copied nor parsed."""
+
+    with open(path, "rb") as file:
+        snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    header, arrays_start = read_snapshot_header(snapshot)
+
+    arrays = {}
+    for name, array in header["arrays"].items():
+        count = int(np.prod(array["shape"]))
+        arrays[name] = np.frombuffer(snapshot, dtype=array["dtype"], count=count,
+                                     offset=arrays_start + array["offset"]).reshape(array["shape"])
+
+    airports = header["airports"]
+    airport_index = AirportIndex.from_arrays(airports["iata"], arrays["lats"], arrays["lons"], arrays["vectors"],
+                                             arrays["tree_orders"], arrays["tree_axes"])
+    return ReferenceData(header["sources"], airport_index, airports["name"], airports["iso"],
+                         header["aircraft_info"], header["owner_info"])
+
+
+def get_snapshot_sources(path: str) -> dict[str, str] | None:
+    """The source versions a snapshot file was built from, or None if there isn't a usable snapshot there."""
+
+    try:
+        with open(path, "rb") as file:
+            snapshot = file.read(len(MAGIC) + 4)
+            if len(snapshot) < len(MAGIC) + 4:
+                return None
+            (header_length,) = struct.unpack("<I", snapshot[len(MAGIC):])
+            return read_snapshot_header(snapshot + file.read(header_length))[0]["sources"]
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def build_snapshot_from_store(store: ReferenceStore, sources: dict[str, str], path: str) -> None:
+    """Fetches the three reference files at once, and writes the snapshot compiled from them to path."""
+
+    with ThreadPoolExecutor(max_workers=len(SOURCE_FILES)) as executor:
+        airports, aircraft_info, owner_info = executor.map(lambda name: json.loads(store.read(name)), SOURCE_FILES)
+
+    with open(path + ".part", "wb") as file:
+        file.write(build_snapshot(airports, aircraft_info, owner_info, sources))
+    os.replace(path + ".part", path)
+
+
+def load_reference_data(config: dict) -> ReferenceData:
+    """Loads the reference datasets, checking the versions of the source files first (all at once).
+    In order of preference they come from this process' memory, the snapshot cached in
+    SNAPSHOT_CACHE_DIR, the stored snapshot, or a snapshot built from the source files, which is
+    then stored for the next cold start. Expects the environment config."""
+
+    store = ReferenceStore(config)
+    with ThreadPoolExecutor(max_workers=len(SOURCE_FILES)) as executor:
+        sources = dict(zip(SOURCE_FILES, executor.map(store.get_version, SOURCE_FILES)))
+    if reference_cache["sources"] == sources:
+        return reference_cache["reference"]
+
+    path = os.path.join(config.get("SNAPSHOT_CACHE_DIR", "/tmp"), SNAPSHOT_FILE)
+    if get_snapshot_sources(path) != sources:
+        if store.get_version(SNAPSHOT_FILE):
+            store.download(SNAPSHOT_FILE, path)
+        if get_snapshot_sources(path) != sources:
+            print("Reference data snapshot out of date, rebuilding it")
+            build_snapshot_from_store(store, sources, path)
+            store.upload(path, SNAPSHOT_FILE)
+
+    reference = load_snapshot(path)
+    reference_cache.update(sources=sources, reference=reference)
+    return reference
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    reference_store = ReferenceStore(os.environ)
+    snapshot_sources = {name: reference_store.get_version(name) for name in SOURCE_FILES}
+    snapshot_path = os.path.join(os.environ.get("SNAPSHOT_CACHE_DIR", "/tmp"), SNAPSHOT_FILE)
+    build_snapshot_from_store(reference_store, snapshot_sources, snapshot_path)
+    reference_store.upload(snapshot_path, SNAPSHOT_FILE)
+    print(f"Stored a snapshot of {len(get_snapshot_sources(snapshot_path))} reference files")
@@ -0,0 +1,68 @@
+"""This module makes synthetic staging tables of tracked events and segments them into flights in memory
+with pandas, as references for the tests and benchmarks of transform's sessionizing. It is not part of
+the transform image."""
+import numpy as np
+import pandas as pd
+
+
+def make_tracked_events(n_rows: int, n_jets: int = 500, seed: int = 0) -> pd.DataFrame:
+    """Makes a shuffled staging table of n_rows tracked events spread over n_jets jets, each flying
+    eight flights of up to three hours over the last day, the last of which may still be in the air.
+    Some events miss their flight number, like real ones."""
+
+    rng = np.random.default_rng(seed)
+    jets = rng.integers(0, n_jets, n_rows)
+    flights = rng.integers(0, 8, n_rows)
+    now = pd.Timestamp.now()
+    time_input = now - pd.Timedelta(hours=24) + pd.to_timedelta(flights * 3*60**2 + rng.integers(0, 170*60, n_rows), unit="s")
+
+    flight_no = pd.Series([f"FL{jet}{flight}" for jet, flight in zip(jets, flights)], dtype=object)
+    flight_no[rng.random(n_rows) < 0.01] = None
+    return pd.DataFrame({"event_id": np.arange(n_rows), "time_input": time_input, "flight_no": flight_no,
+                         "aircraft_reg": [f"N{jet}" for jet in jets], "model": "GLF6",
+                         "lat": rng.uniform(-60, 70, n_rows), "lon": rng.uniform(-180, 180, n_rows),
+                         "barometric_alt": rng.integers(1000, 45000, n_rows),
+                         "ground_speed": rng.uniform(150, 500, n_rows),
+                         "emergency": rng.choice(["none", None], n_rows)})
+
+
+def segment_flights(tracked_event_df: pd.DataFrame, now: pd.Timestamp) -> list[tuple]:
+    """Splits tracked events into flights by aircraft registration and flight number in a single sort,
+    ignoring flights whose last event was within half an hour of now as the jet may still be in the air.
+    Returns (tail number, flight number, departure time, departure location, arrival time, arrival location,
+    emergency) tuples, ordered by when each jet and then each of its flights was first seen. This segments
+    a whole DataFrame of events in one go, without the gap and landing detection of FlightSessionizer."""
+
+    events = tracked_event_df.dropna(subset=["aircraft_reg", "flight_no"])
+    if events.empty:
+        return []
+
+    events = events.assign(jet_order=pd.factorize(events["aircraft_reg"])[0],
+                           flight_order=events.groupby(["aircraft_reg", "flight_no"], sort=False).ngroup())
+    events = events.sort_values("time_input", kind="stable")
+
+    arrivals = events.drop_duplicates("flight_order", keep="last")
+    arrivals = arrivals[(now - arrivals["time_input"]).dt.total_seconds() >= 30*60]
+    arrivals = arrivals.sort_values(["jet_order", "flight_order"]).set_index("flight_order")
+    departures = events.drop_duplicates("flight_order", keep="first").set_index("flight_order").loc[arrivals.index]
+
+    return list(zip(arrivals["aircraft_reg"].tolist(), arrivals["flight_no"].tolist(),
+                    departures["time_input"].tolist(), zip(departures["lat"].tolist(), departures["lon"].tolist()),
+                    arrivals["time_input"].tolist(), zip(arrivals["lat"].tolist(), arrivals["lon"].tolist()),
+                    arrivals["emergency"].tolist()))
+
+
+def segment_flights_nested_loops(tracked_event_df: pd.DataFrame, now: pd.Timestamp) -> list[tuple]:
+    """The nested loops formerly in extract_todays_flights, for comparison."""
+
+    parsed_flights = []
+    for jet in tracked_event_df["aircraft_reg"].unique():
+        flights = tracked_event_df[tracked_event_df["aircraft_reg"] == jet].reset_index()
+        for flight_no in flights["flight_no"].unique():
+            flight = flights[flights["flight_no"] == flight_no].sort_values("time_input").reset_index().to_dict("records")
+            if not flight or (now - flight[-1]["time_input"]).total_seconds() < 30*60:
+                continue
+            parsed_flights.append((jet, flight_no, flight[0]["time_input"], (flight[0]["lat"], flight[0]["lon"]),
+                                   flight[-1]["time_input"], (flight[-1]["lat"], flight[-1]["lon"]),
+                                   flight[-1]["emergency"]))
+    return parsed_flights
@@ -1,11 +1,24 @@
 """Tests for transform module and it's utility functions."""
 from datetime import datetime, timedelta
+import json
+import random
+import numpy as np
+import pytest
 from unittest.mock import patch, MagicMock
 from psycopg2.extras import RealDictCursor
 import pandas as pd
 
-from utilities import haversine_distance, find_nearest_airport, calculate_fuel_consumption
-from transform import extract_todays_flights
+from utilities import haversine_distance, find_nearest_airport, calculate_fuel_consumption, AirportIndex
+from utilities import find_flight_airports
+from dimensions import DimensionCache
+from emissions import calculate_flight_emissions, CO2_PER_GALLON, FUEL_COST_PER_GALLON
+from snapshot import build_snapshot, load_snapshot, get_snapshot_sources, load_reference_data, reference_cache
+from snapshot import SOURCE_FILES, SNAPSHOT_FILE, JET_OWNERS_JSON, ReferenceStore
+from conftest import load_json_from_data_directory
+from synthetic import segment_flights, segment_flights_nested_loops
+from sessions import FlightSessionizer, OPEN_FLIGHT_COLUMNS
+from transform import extract_todays_flights, resolve_countries, insert_airport_info, SEGMENTS_QUERY
+from transform import get_flight_shard, resolve_prepared_shards, SHARD_XID_PREFIX, CHUNK_END_QUERY, handler
 
 
 def test_antipodal_haversine_distance_is_half_circumference_of_earth():
@@ -41,6 +54,25 @@ def test_find_nearest_airport_wkk(airport_data):
     assert find_nearest_airport(59.3, -158.61, airport_data) == "WKK"
 
 
+def test_airport_index_matches_find_nearest_airport(airport_data):
+    """Checks that the airport index finds the same nearest airports as find_nearest_airport,
+    one at a time and as a batch, for airport locations and random points, and lists the k
+    nearest closest first."""
+
+    airport_index = AirportIndex(airport_data)
+    rng = random.Random(0)
+    points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(200)]
+    points += [(float(airport["lat"]) + 0.01, float(airport["lon"]) - 0.01) for airport in list(airport_data.values())[::100]]
+
+    expected = [find_nearest_airport(lat, lon, airport_data) for lat, lon in points]
+    assert [airport_index.nearest(lat, lon) for lat, lon in points] == expected
+    assert airport_index.nearest_many(*zip(*points))[0].tolist() == expected
+
+    nearest = sorted(airport_data, key=lambda iata: haversine_distance(
+        float(airport_data[iata]["lat"]), float(airport_data[iata]["lon"]), 52.36, 13.51))
+    assert airport_index.k_nearest(52.36, 13.51, 5) == nearest[:5]
+
+
 def test_fuel_usage_of_lj40_over_one_hour(aircraft_data):
     """Tests the fuel usage of LJ40 jet over a single hour."""
 
@@ -57,19 +89,339 @@ def test_fuel_usage_of_ga5c(aircraft_data):
     assert round(calculate_fuel_consumption(test_dep_time, test_arr_time, "GA5C", aircraft_data)) == 3105
 
 
-@patch('pandas.read_sql')
-def test_extract_flights_creates_cursor(mock_read):
-    """Checks that a cursor is created and cursor execute is called."""
+def test_extract_flights_creates_cursor():
+    """Checks that a cursor is created, only the runs of events after the watermark are read, a flight extract saw
+    land is closed straight away, and the flights still in the air are saved as open flights."""
 
     mocked_db_connection = MagicMock()
     mocked_cursor = mocked_db_connection.cursor
     mocked_cursor_execute = mocked_cursor.return_value.execute
 
-    mocked_df = pd.DataFrame({"aircraft_reg": [1], "flight_no": [1], "time_input": [datetime.now()-timedelta(hours=3)],
-                              "lat": [1], "lon": [1], "emergency": [None]})
-    mock_read.return_value = mocked_df
+    watermark = datetime.now() - timedelta(hours=4)
+    dep_time, arr_time = datetime.now()-timedelta(hours=3), datetime.now()-timedelta(hours=1)
+    mocked_cursor.return_value.fetchone.side_effect = [{"watermark": watermark}, None]
+    mocked_cursor.return_value.fetchall.side_effect = [[
+        {"aircraft_reg": "N1", "flight_no": "F1", "dep_time": dep_time, "dep_lat": 1, "dep_lon": 2,
+         "arr_time": arr_time-timedelta(minutes=10), "arr_lat": 1, "arr_lon": 2, "max_alt": 30000, "airborne": True,
+         "emergency": "none"}],
+        [{"aircraft_reg": "N1", "landed_at": arr_time}]]
+    n2_time = datetime.now()-timedelta(minutes=10)
+    mocked_cursor.return_value.__iter__.return_value = [
+        {"aircraft_reg": "N1", "flight_no": "F1", "continues": True, "dep_time": arr_time, "dep_lat": 3, "dep_lon": 4,
+         "arr_time": arr_time, "arr_lat": 3, "arr_lon": 4, "max_alt": 800, "airborne": True, "landed": False,
+         "emergency": "none"},
+        {"aircraft_reg": "N2", "flight_no": "F2", "continues": False, "dep_time": n2_time, "dep_lat": 1, "dep_lon": 2,
+         "arr_time": n2_time, "arr_lat": 1, "arr_lon": 2, "max_alt": 30000, "airborne": True, "landed": False,
+         "emergency": "none"}]
+
+    with patch("transform.execute_values") as mock_execute_values:
+        flights, drained = extract_todays_flights(mocked_db_connection)
+
+    mocked_cursor.assert_any_call(cursor_factory=RealDictCursor)
+    assert drained
+    assert flights == [("N1", "F1", dep_time, (1, 2), arr_time, (3, 4), "none")]
+    mocked_cursor.assert_any_call("new_segments", cursor_factory=RealDictCursor)
+    assert [call.args[1]["watermark"] for call in mocked_cursor_execute.call_args_list
+            if call.args[0] == SEGMENTS_QUERY] == [watermark]
+    assert [row[:2] for row in mock_execute_values.call_args.args[2]] == [("N2", "F2")]
+
+
+def test_extract_flights_stops_at_the_end_of_the_chunk():
+    """Checks a run with more events staged than a chunk only reads up to the chunk's last event, and
+    checkpoints the watermark there rather than at the horizon."""
+
+    mocked_db_connection = MagicMock()
+    mocked_cursor = mocked_db_connection.cursor
+    mocked_cursor_execute = mocked_cursor.return_value.execute
+
+    watermark, chunk_end = datetime(2024, 1, 1, 8), datetime(2024, 1, 1, 9)
+    mocked_cursor.return_value.fetchone.side_effect = [{"watermark": watermark}, {"time_input": chunk_end}]
+    mocked_cursor.return_value.fetchall.side_effect = [[], []]
+    mocked_cursor.return_value.__iter__.return_value = []
+
+    with patch("transform.execute_values"):
+        flights, drained = extract_todays_flights(mocked_db_connection, chunk_size=1000)
+
+    assert flights == [] and not drained
+    chunk_query = next(call.args[1] for call in mocked_cursor_execute.call_args_list if call.args[0] == CHUNK_END_QUERY)
+    assert chunk_query["watermark"] == watermark and chunk_query["chunk_size"] == 1000
+    assert [call.args[1]["horizon"] for call in mocked_cursor_execute.call_args_list
+            if call.args[0] == SEGMENTS_QUERY] == [chunk_end]
+    assert (("tracked_event", chunk_end),) in [call.args[1:] for call in mocked_cursor_execute.call_args_list]
+
+
+def test_sessionizer_closes_flights_on_landing_and_gaps():
+    """Checks a flight is closed when its jet lands or its events stop for longer than the gap, that a new
+    flight opens with the next event, and that a flight which never left the ground is dropped."""
+
+    start = datetime(2024, 1, 1)
+    sessionizer = FlightSessionizer([], timedelta(minutes=30))
+
+    def add(minutes, altitude, flight_no="F1", speed=300):
+        sessionizer.add({"aircraft_reg": "N1", "flight_no": flight_no, "time_input": start + timedelta(minutes=minutes),
+                         "lat": minutes, "lon": 0, "barometric_alt": altitude, "ground_speed": speed, "emergency": "none"})
+
+    for minutes, altitude in [(0, 0), (10, 5000), (20, 30000), (30, 0), (40, 0), (100, 9000), (110, 12000)]:
+        add(minutes, altitude)
+    add(0, 0, flight_no=None)
+    assert sessionizer.pop_closed_flights() == [
+        ("N1", "F1", start, (0, 0), start + timedelta(minutes=30), (30, 0), "none")]
+
+    sessionizer.close_idle(start + timedelta(minutes=105))
+    assert [row[2] for row in sessionizer.get_state()] == [start + timedelta(minutes=100)]
+
+    add(115, 1500, flight_no="F2")
+    sessionizer.land("N1", start + timedelta(minutes=112))
+    sessionizer.land("N2", start + timedelta(minutes=120))
+    assert [row[1] for row in sessionizer.get_state()] == ["F2"]
+    assert sessionizer.pop_closed_flights()[0][2:5:2] == (start + timedelta(minutes=100), start + timedelta(minutes=110))
+
+    # extract stamps a landing on approach with the jet's last staged sample, which the landing includes
+    sessionizer.land("N1", start + timedelta(minutes=115))
+    assert sessionizer.get_state() == [] and sessionizer.pop_closed_flights()[0][1] == "F2"
+
+
+def test_sessionizer_counts_low_slow_jets_as_on_the_ground():
+    """Checks a jet taxiing at an airport above sea level (a numeric altitude, at taxi speed) lands like one
+    reporting "ground", and that a session of taxiing alone isn't kept as a flight."""
+
+    start = datetime(2024, 1, 1)
+    sessionizer = FlightSessionizer([], timedelta(minutes=30))
+    for minutes, altitude, speed, flight_no in [(0, 1500, 15, "F1"), (10, 20000, 400, "F1"), (20, 1500, 40, "F1"),
+                                                (30, 1500, 10, "F2"), (35, 1600, 20, "F2")]:
+        sessionizer.add({"aircraft_reg": "N1", "flight_no": flight_no, "time_input": start + timedelta(minutes=minutes),
+                         "lat": 0, "lon": 0, "barometric_alt": altitude, "ground_speed": speed, "emergency": "none"})
+    sessionizer.close_idle(start + timedelta(hours=1))
+
+    assert [(flight[1], flight[4]) for flight in sessionizer.pop_closed_flights()] == [
+        ("F1", start + timedelta(minutes=20))]
+
+
+def test_sessionizer_matches_segment_flights(tracked_events):
+    """Checks folding events into the sessionizer in batches, as successive runs do, gives the same flights
+    as segmenting them all at once when no jet lands or goes quiet mid flight."""
+
+    events = tracked_events.sort_values(["time_input", "event_id"])
+    now = events["time_input"].max() + pd.Timedelta(hours=1)
+
+    state, flights = [], []
+    for batch in (events.iloc[start:start+1250] for start in range(0, 5000, 1250)):
+        sessionizer = FlightSessionizer([dict(zip(OPEN_FLIGHT_COLUMNS, row)) for row in state], timedelta(hours=3))
+        for event in batch.to_dict("records"):
+            sessionizer.add(event)
+        state = sessionizer.get_state()
+        flights += sessionizer.pop_closed_flights()
+    sessionizer.close_idle(now)
+    flights += sessionizer.pop_closed_flights()
+
+    assert sorted(flights) == sorted(segment_flights(events, now))
+
+
+def test_batch_airport_lookup_matches_single_lookups(airport_data):
+    """Checks the array versions of the distance and nearest airport functions agree with the
+    scalar ones, and that tiny distances don't hit a domain error."""
+
+    airport_index = AirportIndex(airport_data)
+    rng = np.random.default_rng(0)
+    dep_lats, arr_lats = rng.uniform(-60, 70, 500), rng.uniform(-60, 70, 500)
+    dep_lons, arr_lons = rng.uniform(-180, 180, 500), rng.uniform(-180, 180, 500)
+
+    dep_iatas, arr_iatas, distances = find_flight_airports(dep_lats, dep_lons, arr_lats, arr_lons, airport_index)
+    for i in range(500):
+        assert dep_iatas[i] == airport_index.nearest(dep_lats[i], dep_lons[i])
+        assert arr_iatas[i] == airport_index.nearest(arr_lats[i], arr_lons[i])
+    for i in range(0, 500, 10):
+        assert distances[i] == pytest.approx(haversine_distance(dep_lats[i], dep_lons[i], arr_lats[i], arr_lons[i]))
+
+    ber = airport_data["BER"]
+    iatas, airport_distances = airport_index.nearest_many([float(ber["lat"]), np.nan], [float(ber["lon"]), 0])
+    assert list(iatas) == ["BER", None] and airport_distances[0] == 0
+    assert 0 < haversine_distance(52.36, 13.51, 52.36, 13.5100001) < 0.001
+
+
+def test_segment_flights_matches_nested_loops(tracked_events):
+    """Checks single pass segmentation gives the same flights, in the same order, as the nested
+    loops it replaced, on shuffled events with missing flight numbers and flights still in the air."""
+
+    now = pd.Timestamp.now()
+    flights = segment_flights(tracked_events, now)
+    assert flights and len(flights) < 20 * 8
+    assert flights == segment_flights_nested_loops(tracked_events, now)
+
+
+def test_resolve_countries_looks_up_each_code_once():
+    """Checks distinct ISO codes are resolved to country and continent names in one batch, that
+    unknown codes are left out, and that known codes aren't looked up again."""
+
+    with patch.dict("transform.country_cache", clear=True):
+        assert resolve_countries({"DE", "JP", "AN"}) == {"DE": ("Germany", "Europe"), "JP": ("Japan", "Asia")}
+
+        with patch("country_converter.CountryConverter") as mocked_converter:
+            assert resolve_countries({"DE"}) == {"DE": ("Germany", "Europe")}
+            mocked_converter.assert_not_called()
+
+
+@patch("transform.execute_values")
+def test_airports_are_only_loaded_when_their_source_changes(mock_execute_values, airport_data):
+    """Checks the airports aren't upserted again while the airports file is unchanged, and that
+    the version of a changed one is saved with its airports."""
+
+    mocked_cursor = MagicMock()
+    mocked_conn = MagicMock()
+    mocked_conn.cursor.return_value = mocked_cursor
+    mocked_cursor.fetchone.return_value = {"version": "v1"}
+
+    insert_airport_info(mocked_conn, airport_data, "v1")
+    mock_execute_values.assert_not_called()
+
+    mocked_cursor.fetchall.return_value = []
+    with patch("transform.resolve_countries", return_value={}):
+        insert_airport_info(mocked_conn, airport_data, "v2")
+    assert "INSERT INTO airport" in mock_execute_values.call_args.args[1]
+    assert mocked_cursor.execute.call_args.args[1] == ("airports.json", "v2")
+
+
+@patch("dimensions.execute_values")
+def test_dimension_cache_inserts_only_new_keys_in_one_batch(mock_execute_values):
+    """Checks a dimension is loaded once, known keys are resolved in memory, and new keys are
+    inserted together on flush with their ids recorded."""
+
+    mocked_cursor = MagicMock()
+    mocked_cursor.fetchall.return_value = [{"type": "none", "emergency_id": 1}]
+    mock_execute_values.return_value = [{"type": "general", "emergency_id": 2}]
+
+    emergencies = DimensionCache(mocked_cursor, "emergency", "type", "emergency_id")
+    for emergency in ["none", "general", "general", None]:
+        emergencies.add(emergency)
+    assert emergencies["none"] == 1 and "general" not in emergencies
+
+    emergencies.flush()
+    emergencies.flush()
+    mock_execute_values.assert_called_once()
+    assert mock_execute_values.call_args.args[2] == [("general",)]
+    assert emergencies["general"] == 2 and mocked_cursor.execute.call_count == 1
+
+
+def test_reference_snapshot_round_trip(airport_data, aircraft_data, tmp_path):
+    """Checks a snapshot loads back into the same reference data, with an airport index giving
+    the same answers as one built from the airport data."""
+
+    airports = load_json_from_data_directory("airports.json")
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(build_snapshot(airports, aircraft_data, [{"name": "A"}], {"airports.json": "v1"}))
+
+    assert get_snapshot_sources(str(path)) == {"airports.json": "v1"}
+    reference = load_snapshot(str(path))
+    assert reference.aircraft_info == aircraft_data and reference.owner_info == [{"name": "A"}]
+    assert reference.get_airport_info()["BER"]["iso"] == airport_data["BER"]["iso"]
+
+    airport_index = AirportIndex(airport_data)
+    lats, lons = np.array([52.36, 59.3, -33.9, 0]), np.array([13.51, -158.61, 151.2, 0])
+    # The batch lookups search the memory-mapped arrays as they are, without unpacking the tree into lists
+    assert not reference.airport_index.vectors.flags.owndata and not reference.airport_index.vectors.flags.writeable
+    assert not reference.airport_index.get_tree_arrays()[0].flags.owndata
+    assert reference.airport_index.nearest_many(lats, lons)[0].tolist() == airport_index.nearest_many(lats, lons)[0].tolist()
+    assert reference.airport_index.points is None
+    for lat, lon in zip(lats, lons):
+        assert reference.airport_index.k_nearest(lat, lon, 3) == airport_index.k_nearest(lat, lon, 3)
+
+
+def test_reference_data_is_rebuilt_only_when_sources_change(tmp_path):
+    """Checks the snapshot is built from the source files on first use, reused while they are unchanged,
+    and rebuilt once one of them changes."""
+
+    data_dir, cache_dir = tmp_path / "data", tmp_path / "cache"
+    data_dir.mkdir()
+    cache_dir.mkdir()
+    for file_name in SOURCE_FILES:
+        (data_dir / file_name).write_text(json.dumps(load_json_from_data_directory(file_name)))
+    config = {"LOCAL_DATA_DIR": str(data_dir), "SNAPSHOT_CACHE_DIR": str(cache_dir)}
+
+    with patch.dict("snapshot.reference_cache", {"sources": None, "reference": None}), \
+            patch("snapshot.build_snapshot", wraps=build_snapshot) as mocked_build:
+        reference = load_reference_data(config)
+        assert load_reference_data(config) is reference
+        reference_cache["sources"] = None
+        load_reference_data(config)
+        assert mocked_build.call_count == 1 and (data_dir / SNAPSHOT_FILE).exists()
+
+        (data_dir / JET_OWNERS_JSON).write_text("[]")
+        assert load_reference_data(config).owner_info == []
+        assert mocked_build.call_count == 2
+
+        # Downloading the stored snapshot over the cached one replaces the file rather than truncating
+        # the one the loaded reference data has memory-mapped
+        loaded, cached = load_reference_data(config), cache_dir / SNAPSHOT_FILE
+        inode = cached.stat().st_ino
+        ReferenceStore(config).download(SNAPSHOT_FILE, str(cached))
+        assert cached.stat().st_ino != inode and loaded.airport_index.nearest(52.36, 13.51) == "BER"
+
+
+def test_flight_emissions_match_fuel_consumption_for_long_flights(aircraft_data):
+    """Checks the batch calculation agrees with calculate_fuel_consumption, that flights over a day long
+    aren't wrapped around, and that cost and CO2 follow from the fuel used."""
+
+    dep_time = datetime(2024, 1, 1, 8)
+    arr_times = [dep_time + timedelta(hours=1), dep_time + timedelta(hours=7, minutes=43, seconds=27),
+                 dep_time + timedelta(hours=26)]
+    models = ["LJ40", "GA5C", "LJ40"]
+
+    emissions = calculate_flight_emissions([dep_time] * 3, arr_times, models, aircraft_data)
+
+    assert emissions["flight_hours"].tolist() == [1, 7 + 43/60 + 27/60**2, 26]
+    assert emissions["fuel_usage"].tolist() == [calculate_fuel_consumption(dep_time, arr_time, model, aircraft_data)
+                                                for arr_time, model in zip(arr_times, models)]
+    assert emissions["fuel_usage"][2] == 26 * 207
+    assert emissions["fuel_cost"][0] == 207 * FUEL_COST_PER_GALLON and emissions["co2_emissions"][0] == 207 * CO2_PER_GALLON
+    assert np.isnan(calculate_flight_emissions([dep_time], [arr_times[0]], ["XXXX"], aircraft_data)["fuel_usage"][0])
+
+
+def test_flight_shards_keep_each_jets_flights_together():
+    """Checks every flight of a jet goes to the same shard whatever the run, and that the shards are
+    all used."""
+
+    tail_numbers = [f"N{number}AB" for number in range(200)]
+    shards = [get_flight_shard(tail_number, 4) for tail_number in tail_numbers]
+
+    assert shards == [get_flight_shard(tail_number, 4) for tail_number in tail_numbers]
+    assert set(shards) == {0, 1, 2, 3}
+    assert get_flight_shard("N1AB", 1) == 0
+
+
+def test_prepared_shards_are_committed_only_if_their_run_was():
+    """Checks the shards a dead run left prepared are committed if the run recorded its commit and
+    rolled back otherwise, leaving other databases' and applications' prepared transactions alone."""
+
+    mock_conn = MagicMock()
+    mock_conn.info.dbname = "jet"
+    mock_conn.cursor.return_value.fetchall.return_value = [("committed",)]
+    committed, aborted = MagicMock(gtrid=SHARD_XID_PREFIX + "committed", database="jet"), \
+        MagicMock(gtrid=SHARD_XID_PREFIX + "aborted", database="jet")
+    other_db, other_app = MagicMock(gtrid=SHARD_XID_PREFIX + "aborted", database="other"), \
+        MagicMock(gtrid="billing-1", database="jet")
+    mock_conn.tpc_recover.return_value = [committed, aborted, other_db, other_app]
+
+    resolve_prepared_shards(mock_conn)
+
+    mock_conn.tpc_commit.assert_called_once_with(committed)
+    mock_conn.tpc_rollback.assert_called_once_with(aborted)
+    mock_conn.cursor.return_value.execute.assert_called_with("DELETE FROM transform_commit")
+
+
+@patch("transform.insert_airport_info", side_effect=RuntimeError)
+@patch("transform.load_reference_data")
+@patch("transform.get_db_connection")
+def test_handler_releases_its_lock_when_a_run_fails(mock_get_connection, _, __):
+    """Checks a failing run rolls back, gives the transform lock back and closes its connection."""
+
+    mock_conn = mock_get_connection.return_value
+    mock_conn.cursor.return_value.fetchall.return_value = []
+    mock_conn.tpc_recover.return_value = []
 
-    extract_todays_flights(mocked_db_connection)
+    with pytest.raises(RuntimeError):
+        handler()
 
-    mocked_cursor.assert_called_with(cursor_factory=RealDictCursor)
-    mocked_cursor_execute.assert_called()
+    statements = [call.args[0] for call in mock_conn.cursor.return_value.execute.call_args_list]
+    assert statements[0].startswith("SELECT pg_advisory_lock") and statements[-1].startswith("SELECT pg_advisory_unlock")
+    mock_conn.rollback.assert_called_once()
+    mock_conn.close.assert_called_once()
@@ -1,29 +1,143 @@
 """This module reads tracked events from the staging database, and inserts the parsed flight information
 into the production database using airports data, aircraft data and tracked owners data stored in s3."""
-import json
 import os
-from datetime import datetime
+import json
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+from datetime import datetime, timedelta
 import country_converter as coco
+import boto3
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2.extensions import connection, cursor
 from dotenv import load_dotenv
-import pandas as pd
-from s3fs import S3FileSystem
+import numpy as np
 
-from utilities import find_nearest_airport, calculate_fuel_consumption, clean_airport_data
+from dimensions import DimensionCache
+from sessions import FlightSessionizer, OPEN_FLIGHT_COLUMNS, GROUND_ALTITUDE, LOW_ALTITUDE, LANDED_GROUND_SPEED
+from snapshot import load_reference_data, AIRPORTS_JSON
+from emissions import calculate_flight_emissions
+from utilities import AirportIndex, find_flight_airports
 
 
 load_dotenv()
 config = os.environ
 
 
-AIRPORTS_JSON = "airports.json"
-AIRCRAFTS_JSON= "aircraft_fuel_consumption_rates.json"
-JET_OWNERS_JSON = "celeb_planes.json"
 STAGING_SCHEMA = "staging"
 PRODUCTION_SCHEMA = "production"
-S3_BUCKET_NAME = "jet-bucket"
+TRANSFORM_WATERMARK = "tracked_event"
+# (country name, continent name) of each ISO code looked up so far, kept between warm invocations
+country_cache: dict[str, tuple[str, str]] = {}
+# partitions older than this are dropped even if the watermark is held back, e.g. by a flight that never ends
+STAGING_RETENTION = timedelta(days=int(config.get("STAGING_RETENTION_DAYS", 7)))
+# a flight without events for this long has ended, as its jet is no longer in the air
+IN_FLIGHT_WINDOW = timedelta(minutes=30)
+
+# events stamped within this long of now may still be being written by an extract run, so aren't read yet
+SETTLE_LAG = timedelta(minutes=int(config.get("SESSION_SETTLE_LAG_MINUTES", 5)))
+# number of runs of new events fetched from the server side cursor at a time
+SEGMENT_BATCH_SIZE = 10000
+# staging is transformed in chunks of about this many events, each committed with the watermark it moves to
+TRANSFORM_CHUNK_EVENTS = int(config.get("TRANSFORM_CHUNK_EVENTS", 50000))
+# seconds of an invocation kept back to wrap up in, after the last chunk that fits
+TRANSFORM_TIME_RESERVE = int(config.get("TRANSFORM_TIME_RESERVE_SECONDS", 20))
+
+# The time of the chunk_size-th event past the watermark, which a chunk ends at (events stamped the same second
+# are read with it). There isn't one when fewer events than that are left before the horizon
+CHUNK_END_QUERY = """
+    SELECT time_input FROM tracked_event
+    WHERE time_input > %(watermark)s AND time_input <= %(horizon)s
+    ORDER BY time_input OFFSET %(chunk_size)s - 1 LIMIT 1"""
+
+# The runs of each flight's events staged since the last run (which prunes the scan to the partitions from the
+# watermark's day on), in the order they started. The events of a jet extract saw land are read up to its landing
+# even if that's past the horizon, and skipped from then on. Rows updated by extract's compression get a later
+# time_input, so are read again as new events, and of the events of a flight stamped the same second only the first
+# is kept. Each open flight's last point goes in as a boundary row, so a run that carries on from it is marked as
+# continuing it. A flight's events are split into runs where they are more
+# than the gap apart, where extract saw its jet land in between, and after the jet touches down (is back on the
+# ground after being in the air), the same rules the sessionizer applies to single events
+SEGMENTS_QUERY = """
+    WITH event AS (
+        SELECT DISTINCT ON (aircraft_reg, flight_no, time_input) aircraft_reg, flight_no, time_input, lat, lon,
+               barometric_alt, tracked_event.emergency, FALSE AS boundary,
+               COALESCE(barometric_alt <= %(ground_altitude)s
+                        OR (barometric_alt < %(low_altitude)s AND ground_speed < %(landed_ground_speed)s), FALSE) AS on_ground
+        FROM tracked_event
+        LEFT JOIN open_flight USING (aircraft_reg, flight_no)
+        WHERE time_input > %(watermark)s
+        AND (time_input <= %(horizon)s
+             OR time_input <= (SELECT max(landed_at) FROM landing
+                               WHERE NOT applied AND landing.aircraft_reg = tracked_event.aircraft_reg))
+        AND NOT EXISTS (SELECT 1 FROM landing
+                        WHERE applied AND landing.aircraft_reg = tracked_event.aircraft_reg
+                        AND tracked_event.time_input <= landing.landed_at)
+        AND aircraft_reg IS NOT NULL AND flight_no IS NOT NULL
+        AND (open_flight.arr_time IS NULL OR time_input > open_flight.arr_time)
+        ORDER BY aircraft_reg, flight_no, time_input, event_id
+    ),
+    step AS (
+        SELECT *, LAG(time_input) OVER flight AS prev_time, LAG(on_ground) OVER flight AS prev_on_ground
+        FROM (SELECT * FROM event
+              UNION ALL
+              SELECT aircraft_reg, flight_no, arr_time, arr_lat, arr_lon, max_alt, emergency, TRUE, NOT airborne
+              FROM open_flight) AS events
+        WINDOW flight AS (PARTITION BY aircraft_reg, flight_no ORDER BY time_input)
+    ),
+    split AS (
+        SELECT *, prev_time IS NULL OR time_input - prev_time > %(gap)s
+                  OR EXISTS (SELECT 1 FROM landing WHERE NOT applied AND landing.aircraft_reg = step.aircraft_reg
+                             AND landed_at >= prev_time AND landed_at < time_input) AS parted
+        FROM step
+    ),
+    touchdown AS (
+        SELECT *, on_ground AND NOT parted AND NOT prev_on_ground AS landed FROM split
+    ),
+    start AS (
+        SELECT *, parted OR LAG(landed, 1, FALSE) OVER flight AS starts
+        FROM touchdown
+        WINDOW flight AS (PARTITION BY aircraft_reg, flight_no ORDER BY time_input)
+    ),
+    segment AS (
+        SELECT *, SUM(starts::int) OVER (PARTITION BY aircraft_reg, flight_no ORDER BY time_input) AS segment
+        FROM start
+    )
+    SELECT aircraft_reg, flight_no, bool_or(boundary) AS continues,
+           min(time_input) FILTER (WHERE NOT boundary) AS dep_time,
+           (array_agg(lat ORDER BY time_input) FILTER (WHERE NOT boundary))[1] AS dep_lat,
+           (array_agg(lon ORDER BY time_input) FILTER (WHERE NOT boundary))[1] AS dep_lon,
+           max(time_input) AS arr_time,
+           (array_agg(lat ORDER BY time_input DESC))[1] AS arr_lat,
+           (array_agg(lon ORDER BY time_input DESC))[1] AS arr_lon,
+           max(barometric_alt) FILTER (WHERE NOT boundary) AS max_alt,
+           bool_or(NOT on_ground) FILTER (WHERE NOT boundary) AS airborne,
+           bool_or(landed) AS landed,
+           (array_agg(emergency ORDER BY time_input DESC))[1] AS emergency
+    FROM segment
+    GROUP BY aircraft_reg, flight_no, segment
+    HAVING bool_and(NOT boundary) OR count(*) > 1
+    ORDER BY dep_time, aircraft_reg, flight_no"""
+
+# With more than one worker, flights are inserted by a process pool sharded by tail number (which needs
+# max_prepared_transactions of at least this many on the db, as the shards are committed with two-phase commit)
+TRANSFORM_WORKERS = int(config.get("TRANSFORM_WORKERS", 1))
+# The global transaction id of each parallel run's flight shards starts with this
+SHARD_XID_PREFIX = "jet-transform-"
+# The reference data of a worker process of a parallel run
+worker_reference = {}
+
+# The derived columns of a flight, as calculated by calculate_flight_emissions
+FLIGHT_METRIC_COLUMNS = ["flight_hours", "fuel_usage", "fuel_cost", "co2_emissions"]
+
+# Marks the landings read by a run as applied, and forgets the ones the watermark has passed
+APPLY_LANDINGS_QUERY = """
+    UPDATE landing SET applied = TRUE
+    FROM unnest(%(aircraft_regs)s::varchar[], %(landed_ats)s::timestamp[]) AS applied_landing (aircraft_reg, landed_at)
+    WHERE landing.aircraft_reg = applied_landing.aircraft_reg AND landing.landed_at = applied_landing.landed_at;
+    DELETE FROM landing WHERE applied AND landed_at <= %(watermark)s"""
 
 
 def get_db_connection(schema: str) -> connection:
@@ -38,293 +152,479 @@ def get_db_connection(schema: str) -> connection:
                             options = f"-c search_path={schema}")
 
 
-def load_json_file_from_s3(file_name: str, bucket_name: str) -> list | dict:
-    """Reads a json file from an s3 bucket and returns the object. Requires the names of the bucket
-    and file as strings."""
-
-    s3_session = S3FileSystem(key=config["ACCESS_KEY"],
-                      secret=config["SECRET_KEY"])
+def load_watermark(curs: cursor, name: str) -> datetime | None:
+    """Returns the persisted watermark with the given name, or None if there isn't one yet.
+    Expects a staging db cursor."""
 
-    return json.load(s3_session.open(path=f"{bucket_name}/{file_name}"))
+    curs.execute("SELECT watermark FROM transform_watermark WHERE name = %s", (name,))
+    row = curs.fetchone()
+    return row["watermark"] if row else None
 
 
-def extract_todays_flights(conn: connection) -> list[tuple]:
-    """Parses events from staging db and extracts flight number, tail number, departure time/location
-    and arrival time/location. Yields these values as a tuple. Expects staging DB connection object."""
+def save_watermark(curs: cursor, name: str, watermark: datetime) -> None:
+    """Persists a watermark under the given name. Expects a staging db cursor."""
 
-    tracked_event_df = pd.read_sql("SELECT * FROM tracked_event;", conn)
-    curs = conn.cursor(cursor_factory=RealDictCursor)
+    curs.execute("""INSERT INTO transform_watermark (name, watermark) VALUES (%s, %s)
+                 ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark""", (name, watermark))
 
-    parsed_flights = []
 
-    jets = tracked_event_df["aircraft_reg"].unique()
-    for jet in jets:
-        flights = tracked_event_df[tracked_event_df["aircraft_reg"] == jet].reset_index()
+def extract_todays_flights(conn: connection, chunk_size: int = TRANSFORM_CHUNK_EVENTS) -> tuple[list[tuple], bool]:
+    """Folds the next chunk of events staged since the last run, gathered into runs of each flight by the db, into
+    the open flights persisted in the staging db, and extracts flight number, tail number, departure time/location
+    and arrival time/location of the flights that closed (landed, or went quiet for longer than the in-flight
+    window). Landings recorded by extract close their jet's flights straight away. The watermark moves up to the
+    end of the chunk, and the open flights are saved in the same transaction, so committing it checkpoints the
+    chunk. Returns these values as a list of tuples, and whether the chunk reached the horizon. Expects staging DB
+    connection object and the chunk size."""
 
-        flight_numbers = flights["flight_no"].unique()
-        for flight_no in flight_numbers:
-            flight = flights[flights["flight_no"] == flight_no].sort_values("time_input").reset_index().to_dict("records")
+    curs = conn.cursor(cursor_factory=RealDictCursor)
+    horizon = (datetime.now() - SETTLE_LAG).replace(microsecond=0)
+
+    # Stops overlapping runs folding the same events in twice
+    curs.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{STAGING_SCHEMA}.open_flight",))
+    watermark = load_watermark(curs, TRANSFORM_WATERMARK) or datetime.min
+    curs.execute(CHUNK_END_QUERY, {"watermark": watermark, "horizon": horizon, "chunk_size": chunk_size})
+    chunk_end = curs.fetchone()
+    drained = chunk_end is None
+    if not drained:
+        horizon = chunk_end["time_input"]
+    curs.execute(f"SELECT {', '.join(OPEN_FLIGHT_COLUMNS)} FROM open_flight")
+    sessionizer = FlightSessionizer(curs.fetchall(), IN_FLIGHT_WINDOW)
+    curs.execute("SELECT aircraft_reg, landed_at FROM landing WHERE NOT applied ORDER BY landed_at")
+    landings = curs.fetchall()
+
+    # Folds in the runs of new events, then the landings (the runs are already split where each landing falls)
+    segments = conn.cursor("new_segments", cursor_factory=RealDictCursor)
+    segments.itersize = SEGMENT_BATCH_SIZE
+    segments.execute(SEGMENTS_QUERY, {"watermark": watermark, "horizon": horizon, "gap": IN_FLIGHT_WINDOW,
+                                      "ground_altitude": GROUND_ALTITUDE, "low_altitude": LOW_ALTITUDE,
+                                      "landed_ground_speed": LANDED_GROUND_SPEED})
+    for segment in segments:
+        sessionizer.add_segment(segment)
+    segments.close()
+    for landing in landings:
+        sessionizer.land(**landing)
+
+    watermark = max(watermark, horizon)
+    sessionizer.close_idle(watermark - IN_FLIGHT_WINDOW)
+
+    curs.execute("DELETE FROM open_flight")
+    execute_values(curs, f"INSERT INTO open_flight ({', '.join(OPEN_FLIGHT_COLUMNS)}) VALUES %s",
+                   sessionizer.get_state(), page_size=1000)
+    save_watermark(curs, TRANSFORM_WATERMARK, watermark)
+    curs.execute(APPLY_LANDINGS_QUERY, {"aircraft_regs": [landing["aircraft_reg"] for landing in landings],
+                                        "landed_ats": [landing["landed_at"] for landing in landings],
+                                        "watermark": watermark})
+    curs.close()
+    return sessionizer.pop_closed_flights(), drained
 
-            if not flight:
-                continue
 
-            dep_time = flight[0]["time_input"]
-            dep_location = (flight[0]["lat"], flight[0]["lon"])
+def drop_processed_partitions(conn: connection) -> list[str]:
+    """Drops the daily partitions of tracked_event that end before the watermark, as every event in them
+    has been processed, or that are older than the retention period. Returns the names of the dropped
+    partitions. Expects a db connection with the staging schema on its search path."""
 
-            arr_time = flight[-1]["time_input"]
+    curs = conn.cursor(cursor_factory=RealDictCursor)
+    watermark = load_watermark(curs, TRANSFORM_WATERMARK)
+    if watermark is None:
+        curs.close()
+        return []
+    keep_from = max(watermark, datetime.now() - STAGING_RETENTION)
+
+    curs.execute("""SELECT partition.relname AS name FROM pg_inherits
+                 JOIN pg_class AS partition ON partition.oid = pg_inherits.inhrelid
+                 WHERE pg_inherits.inhparent = %s::regclass""", (f"{STAGING_SCHEMA}.tracked_event",))
+    dropped = []
+    for partition in curs.fetchall():
+        day = datetime.strptime(partition["name"].rsplit("_", 1)[1], "%Y%m%d")
+        if day + timedelta(days=1) <= keep_from:
+            curs.execute(f"DROP TABLE {STAGING_SCHEMA}.{partition['name']}")
+            dropped.append(partition["name"])
 
-            # if last event was within half an hour, the jet may still be in the air.
-            if (pd.Timestamp.now() - arr_time).total_seconds() < 30*60:
-                continue
+    curs.close()
+    return dropped
 
-            arr_location = (flight[-1]["lat"], flight[-1]["lon"])
 
-            emergency = flight[-1]["emergency"]
+def resolve_countries(iso_codes: set[str]) -> dict[str, tuple[str, str]]:
+    """Looks up the short name and continent of each distinct ISO code in one batch, caching the
+    results between warm invocations. Codes country_converter doesn't know are left out. Expects a
+    set of ISO codes and returns a dict of (country name, continent name) tuples keyed by code."""
 
-            parsed_flights.append((jet, flight_no, dep_time, dep_location, arr_time, arr_location, emergency))
-            curs.execute("DELETE FROM tracked_event WHERE aircraft_reg = %s AND flight_no = %s",
-                        (jet, flight_no))
+    missing = sorted(iso_codes - country_cache.keys())
+    if missing:
+        country_converter = coco.CountryConverter()
+        country_names = country_converter.convert(names=missing, to="name_short")
+        continent_names = country_converter.convert(names=missing, to="continent")
+        if len(missing) == 1:
+            country_names, continent_names = [country_names], [continent_names]
+        country_cache.update(zip(missing, zip(country_names, continent_names)))
 
-    curs.close()
-    return parsed_flights
+    return {code: country_cache[code] for code in iso_codes if "not found" not in country_cache[code]}
 
 
-def insert_airport_info(conn: connection, airport_info: dict[dict]) -> None:
-    """Inserts airport data into production db and populates country/ continent tables.
-    Expects the production db connection object and the airport data."""
+def load_source_version(curs: cursor, name: str) -> str | None:
+    """Returns the version of the reference file with the given name that production was last loaded
+    from, or None if it hasn't been yet. Expects a production db cursor."""
 
-    curs = conn.cursor(cursor_factory=RealDictCursor)
-    curs.execute("SELECT * FROM airport LIMIT 1")
-    if curs.fetchall():
-        return
+    curs.execute("SELECT version FROM reference_source WHERE name = %s", (name,))
+    row = curs.fetchone()
+    return row["version"] if row else None
 
-    country_converter = coco.CountryConverter()
 
+def save_source_version(curs: cursor, name: str, version: str) -> None:
+    """Persists the version of a reference file production has been loaded from. Expects a production db cursor."""
 
-    continent_codes = {"Asia": "AS", "Europe": "EU", "Africa": "AF", "Oceania": "OC", "America": "AM"}
+    curs.execute("""INSERT INTO reference_source (name, version) VALUES (%s, %s)
+                 ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version""", (name, version))
 
-    for airport in airport_info:
-        name = airport_info[airport]["name"]
-        iata = airport_info[airport]["iata"]
-        lat = airport_info[airport]["lat"]
-        lon = airport_info[airport]["lon"]
 
-        country = airport_info[airport]["iso"]
-        country_name = country_converter.convert(names=country, to="name_short")
-        continent_name = country_converter.convert(names=country, to="continent")
+def insert_airport_info(conn: connection, airport_info: dict[dict], source_version: str = None) -> None:
+    """Inserts airport data into production db and populates country/ continent tables, as one set
+    each: continents and countries are added if missing and airports upserted, so changed airport
+    data is picked up on the next run. Nothing is done if the data was loaded from the same version
+    of the airports file already. Expects the production db connection object, the airport data and
+    the version of the airports file it came from (None if unknown, which always loads it)."""
 
-        if country_name == "not found" or continent_name == "not found":
-            continue
-        continent = continent_codes[continent_name]
-
-        curs.execute("SELECT country_id FROM country WHERE code = %s", (country,))
-        country_id = curs.fetchall()
-
-        if not country_id:
-            curs.execute("SELECT continent_id FROM continent WHERE code = %s", (continent,))
-            continent_id = curs.fetchall()
-            if not continent_id:
-                curs.execute("INSERT INTO continent (code, name) VALUES (%s, %s) RETURNING continent_id",
-                             (continent, continent_name))
-                continent_id = curs.fetchall()[0]["continent_id"]
-            else:
-                continent_id = continent_id[0]["continent_id"]
-            curs.execute("INSERT INTO country (code, name, continent_id) VALUES (%s, %s, %s) RETURNING country_id",
-                         (country, country_name, continent_id))
-            country_id = curs.fetchall()[0]["country_id"]
-        else:
-            country_id = country_id[0]["country_id"]
+    curs = conn.cursor(cursor_factory=RealDictCursor)
+    if source_version is not None and load_source_version(curs, AIRPORTS_JSON) == source_version:
+        curs.close()
+        return
 
-        curs.execute("INSERT INTO airport (name, iata, lat, lon, country_id) VALUES (%s, %s, %s, %s, %s)",
-                     (name, iata, lat, lon, country_id))
+    continent_codes = {"Asia": "AS", "Europe": "EU", "Africa": "AF", "Oceania": "OC", "America": "AM"}
+    countries = resolve_countries({airport["iso"] for airport in airport_info.values() if airport.get("iso")})
+
+    continents = {(continent_codes[continent_name], continent_name) for _, continent_name in countries.values()}
+    execute_values(curs, "INSERT INTO continent (code, name) VALUES %s ON CONFLICT DO NOTHING", list(continents))
+    curs.execute("SELECT code, continent_id FROM continent")
+    continent_ids = {row["code"]: row["continent_id"] for row in curs.fetchall()}
+
+    execute_values(curs, "INSERT INTO country (code, name, continent_id) VALUES %s ON CONFLICT DO NOTHING",
+                   [(code, country_name, continent_ids[continent_codes[continent_name]])
+                    for code, (country_name, continent_name) in countries.items()])
+    curs.execute("SELECT code, country_id FROM country")
+    country_ids = {row["code"]: row["country_id"] for row in curs.fetchall()}
+
+    airports = [(airport["name"], airport["iata"], airport["lat"], airport["lon"], country_ids[airport["iso"]])
+                for airport in airport_info.values() if airport.get("iso") in country_ids]
+    execute_values(curs, """INSERT INTO airport (name, iata, lat, lon, country_id) VALUES %s
+                   ON CONFLICT (iata) DO UPDATE SET name = EXCLUDED.name, lat = EXCLUDED.lat, lon = EXCLUDED.lon,
+                   country_id = EXCLUDED.country_id
+                   WHERE (airport.name, airport.lat, airport.lon, airport.country_id)
+                   IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.lat, EXCLUDED.lon, EXCLUDED.country_id)""",
+                   airports, page_size=1000)
+    if source_version is not None:
+        save_source_version(curs, AIRPORTS_JSON, source_version)
 
     curs.close()
 
 
-def insert_job_roles(curs: cursor, job_roles: list, owner_id: int) -> None:
-    """Inserts an owners jobs/occupations into db. Expects a cursor object connect to production,
-    a list of jobs and the owner id as an int. Returns none."""
-
-    for job_role in job_roles:
-        curs.execute("SELECT job_role_id FROM job_role WHERE name = %s", (job_role,))
-        job_role_id = curs.fetchall()
-        if not job_role_id:
-            curs.execute("INSERT INTO job_role (name) VALUES (%s) RETURNING job_role_id", (job_role,))
-            job_role_id = curs.fetchall()[0]["job_role_id"]
-        else:
-            job_role_id = job_role_id[0]["job_role_id"]
+def parse_birthdate(birthdate: str | None) -> datetime | None:
+    """Parses a birthdate from the jet owners data, which are given as dd/mm/yyyy strings."""
 
-        curs.execute("INSERT INTO owner_role_link (owner_id, job_role_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                    (owner_id, job_role_id))
+    return datetime.strptime(birthdate, "%d/%m/%Y") if birthdate else None
 
 
-def get_aircraft_model_id(curs: cursor, aircraft_model: str, aircraft_info: dict[dict]) -> int | None:
-    """Returns the id of the aircraft model if it exists in the dataset. Otherwise returns none."""
+def insert_jet_owner_info(conn: connection, aircraft_info: dict[dict], owner_info: list[dict]) -> None:
+    """Inserts jet owner data for the aircraft not in the db yet. Genders, owners, models and job roles
+    are resolved through dimension caches, with the new ones inserted a batch at a time."""
 
-    if not aircraft_model or aircraft_model not in aircraft_info:
-        return None
+    curs = conn.cursor(cursor_factory=RealDictCursor)
 
-    aircraft_model_name = aircraft_info[aircraft_model]["name"]
-    fuel_efficiency = aircraft_info[aircraft_model]["galph"]
+    curs.execute("SELECT tail_number FROM aircraft")
+    known_tail_numbers = {row["tail_number"] for row in curs.fetchall()}
+    new_owners = {}
+    for owner in owner_info:
+        if owner["tail_number"] not in known_tail_numbers:
+            new_owners.setdefault(owner["tail_number"], owner)
+    if not new_owners:
+        curs.close()
+        return
 
-    curs.execute("SELECT model_id FROM model WHERE code = %s", (aircraft_model,))
-    model_id = curs.fetchall()
-    if model_id:
-        return model_id[0]["model_id"]
+    models = DimensionCache(curs, "model", "code", "model_id", ["code", "name", "fuel_efficiency"])
+    for owner in new_owners.values():
+        if owner["aircraft_model"] in aircraft_info:
+            models.add(owner["aircraft_model"], aircraft_info[owner["aircraft_model"]]["name"],
+                       aircraft_info[owner["aircraft_model"]]["galph"])
+    models.flush()
+
+    # aircraft need a model, so jets of models without fuel data can't be tracked
+    for tail_number, owner in list(new_owners.items()):
+        if owner["aircraft_model"] not in models:
+            print(f"Skipping {tail_number}, no data for model {owner['aircraft_model']}")
+            del new_owners[tail_number]
+
+    genders = DimensionCache(curs, "gender", "name", "gender_id")
+    for owner in new_owners.values():
+        genders.add(owner["gender"])
+    genders.flush()
+
+    owners = DimensionCache(curs, "owner", "name", "owner_id", ["name", "gender_id", "est_net_worth", "birthdate"])
+    job_roles = DimensionCache(curs, "job_role", "name", "job_role_id")
+    for owner in new_owners.values():
+        owners.add(owner["name"], genders.get(owner["gender"]), owner["est_net_worth"], parse_birthdate(owner["birthdate"]))
+        for job_role in owner["job_role"]:
+            job_roles.add(job_role)
+    owners.flush()
+    job_roles.flush()
+
+    aircraft = [(tail_number, models[owner["aircraft_model"]], owners[owner["name"]])
+                for tail_number, owner in new_owners.items()]
+    role_links = {(owners[owner["name"]], job_roles[job_role])
+                  for owner in new_owners.values() for job_role in owner["job_role"]}
+
+    execute_values(curs, "INSERT INTO aircraft (tail_number, model_id, owner_id) VALUES %s", aircraft)
+    execute_values(curs, "INSERT INTO owner_role_link (owner_id, job_role_id) VALUES %s ON CONFLICT DO NOTHING",
+                   list(role_links))
 
-    curs.execute("INSERT INTO model (code, name, fuel_efficiency) VALUES (%s, %s, %s) RETURNING model_id",
-                (aircraft_model, aircraft_model_name, fuel_efficiency))
-    return curs.fetchall()[0]["model_id"]
+    curs.close()
 
 
-def get_aircraft_owner_id(curs: cursor, name: str, gender_id: int, est_net_worth: int, birthdate: datetime) -> int:
-    """Returns the jet owner id if it exists, otherwise inserts a new owner and returns their
-    owner id. Expects a cursor object connected to the production db as well as information about
-    the owner. Returns an integer."""
+def insert_emergencies(curs: cursor, flights: list[tuple]) -> DimensionCache:
+    """Adds the emergency types of the flights that aren't in the db yet. Returns the emergency dimension."""
 
-    curs.execute("SELECT owner_id FROM owner WHERE name = %s", (name,))
-    owner_id = curs.fetchall()
-    if owner_id:
-        return owner_id[0]["owner_id"]
+    emergencies = DimensionCache(curs, "emergency", "type", "emergency_id")
+    for flight in flights:
+        emergencies.add(flight[6] or "none")
+    emergencies.flush()
+    return emergencies
 
-    curs.execute("""INSERT INTO owner (name, gender_id, est_net_worth, birthdate)
-                VALUES (%s, %s, %s, %s) RETURNING owner_id""",
-                (name, gender_id, est_net_worth, birthdate))
-    return curs.fetchall()[0]["owner_id"]
 
+def insert_flights(conn: connection, flights: list[tuple], airport_index: AirportIndex, aircraft_info: dict[dict]) -> None:
+    """Inserts flights into the database in batches, skipping any flight already there (same tail number,
+    flight number and departure time), so a retried run can't duplicate flights. Expects a production
+    connection object and the flights as returned by extract_todays_flights."""
 
-def get_gender_id(curs: cursor, gender: str) -> int | None:
-    """Returns appropriate gender id from db if it exists, otherwise inserts the gender and
-    returns the new gender id. Expects a cursor object connected to the production db and the 
-    gender as a string. Gender id is an integer."""
+    curs = conn.cursor(cursor_factory=RealDictCursor)
 
-    if not gender:
-        return None
+    # Resolves the airports at both ends of every flight in one go
+    dep_locations = np.array([flight[3] for flight in flights], dtype=float)
+    arr_locations = np.array([flight[5] for flight in flights], dtype=float)
+    dep_airports, arr_airports, _ = find_flight_airports(dep_locations[:, 0], dep_locations[:, 1],
+                                                         arr_locations[:, 0], arr_locations[:, 1], airport_index)
 
-    curs.execute("SELECT gender_id FROM gender WHERE name = %s", (gender,))
-    gender_id = curs.fetchall()
-    if gender_id:
-        return gender_id[0]["gender_id"]
+    # Loads the dimensions once, so each flight resolves its ids in memory
+    airports = DimensionCache(curs, "airport", "iata", "airport_id")
+    emergencies = insert_emergencies(curs, flights)
+    curs.execute("SELECT tail_number, code FROM aircraft JOIN model ON model.model_id = aircraft.model_id")
+    aircraft_models = {row["tail_number"]: row["code"] for row in curs.fetchall()}
 
-    curs.execute("INSERT INTO gender (name) VALUES (%s) RETURNING gender_id", (gender,))
-    return curs.fetchall()[0]["gender_id"]
+    flight_rows, flight_models = [], []
+    for flight, dep_airport, arr_airport in zip(flights, dep_airports.tolist(), arr_airports.tolist()):
+        tail_number, flight_no, dep_time, _, arr_time, _, emergency = flight
 
+        print(tail_number)
+        if tail_number not in aircraft_models:
+            continue
 
-def insert_jet_owner_info(conn: connection, aircraft_info: dict[dict], owner_info: list[dict]) -> None:
-    """Inserts jet owner data."""
+        if dep_airport not in airports or arr_airport not in airports or dep_airport == arr_airport:
+            continue
 
-    curs = conn.cursor(cursor_factory=RealDictCursor)
+        flight_rows.append((flight_no, airports[dep_airport], airports[arr_airport], dep_time, arr_time, tail_number,
+                            emergencies[emergency or "none"]))
+        flight_models.append(aircraft_models[tail_number])
 
-    for owner in owner_info:
+    # Derives the duration, fuel, cost and CO2 of every flight at once, to be stored alongside them (NULL
+    # where the model has no fuel data)
+    emissions = calculate_flight_emissions([row[3] for row in flight_rows], [row[4] for row in flight_rows],
+                                           flight_models, aircraft_info)
+    metric_columns = [np.where(np.isnan(emissions[name]), None, emissions[name]).tolist() for name in FLIGHT_METRIC_COLUMNS]
+    flight_rows = [(*row, *metrics) for row, metrics in zip(flight_rows, zip(*metric_columns))]
 
-        tail_number = owner["tail_number"]
+    # Flights already in production (e.g. from a retried run) are left as they are
+    inserted = execute_values(curs, f"""INSERT INTO flight (flight_number, dep_airport_id, arr_airport_id, dep_time,
+                              arr_time, tail_number, emergency_id, {', '.join(FLIGHT_METRIC_COLUMNS)}) VALUES %s
+                              ON CONFLICT (tail_number, flight_number, dep_time) DO NOTHING
+                              RETURNING flight_id""", flight_rows, page_size=1000, fetch=True)
+    print(f"Inserted {len(inserted)} of {len(flight_rows)} flights")
 
-        curs.execute("SELECT * FROM aircraft WHERE tail_number = %s", (tail_number,))
-        if curs.fetchall():
-            continue
+    curs.close()
 
-        name = owner["name"]
-        gender = owner["gender"]
-        est_net_worth = owner["est_net_worth"]
-        birthdate = owner["birthdate"]
-        if birthdate:
-            birthdate = datetime.strptime(birthdate, "%d/%m/%Y")
-        job_roles = owner["job_role"]
-        aircraft_model = owner["aircraft_model"]
 
-        gender_id = get_gender_id(curs, gender)
+def get_flight_shard(aircraft_reg: str, shards: int) -> int:
+    """The shard that inserts a jet's flights, the same in every process and on every run."""
 
-        owner_id = get_aircraft_owner_id(curs, name, gender_id, est_net_worth, birthdate)
+    return zlib.crc32(aircraft_reg.encode("utf-8")) % shards
 
-        model_id = get_aircraft_model_id(curs, aircraft_model, aircraft_info)
 
-        curs.execute("INSERT INTO aircraft (tail_number, model_id, owner_id) VALUES (%s, %s, %s)",
-                     (tail_number, model_id, owner_id))
+def load_worker_reference() -> None:
+    """Process pool initializer loading the reference data once per worker, from the snapshot the
+    coordinator has just cached."""
 
-        insert_job_roles(curs, job_roles, owner_id)
+    worker_reference["reference"] = load_reference_data(config)
 
-    curs.close()
 
+def insert_flight_shard(gtrid: str, bqual: str, flights: list[tuple]) -> tuple[str, str]:
+    """Worker: inserts one shard of the flights on a connection of its own, and prepares the transaction
+    for the coordinator to commit along with the other shards. Returns the transaction's (gtrid, bqual)."""
 
-def insert_todays_flights(prod_conn: connection, stage_conn: connection,
-                          airport_info: dict[dict], aircraft_info: dict[dict]) -> None:
-    """Inserts todays flights into the database. Expects a production connection object."""
+    reference = worker_reference["reference"]
+    conn = get_db_connection(f"{PRODUCTION_SCHEMA},{STAGING_SCHEMA}")
+    try:
+        conn.tpc_begin(conn.xid(0, gtrid, bqual))
+        insert_flights(conn, flights, reference.airport_index, reference.aircraft_info)
+        conn.tpc_prepare()
+    finally:
+        conn.close()
+    return gtrid, bqual
 
-    curs = prod_conn.cursor(cursor_factory=RealDictCursor)
 
-    for flight in extract_todays_flights(stage_conn):
-        tail_number, flight_no, dep_time, dep_location, arr_time, arr_location, emergency = flight
+def resolve_prepared_shards(conn: connection) -> None:
+    """Finishes the flight shards a parallel run left prepared when it died: they are committed if the run
+    recorded its commit, otherwise rolled back. Expects a connection outside a transaction."""
 
-        print(tail_number)
-        curs.execute("SELECT * FROM aircraft WHERE tail_number = %s", (tail_number,))
-        if not curs.fetchall():
-            continue
+    curs = conn.cursor()
+    curs.execute("SELECT run_id FROM transform_commit")
+    committed_runs = {row[0] for row in curs.fetchall()}
+    conn.commit()
 
-        dep_airport = find_nearest_airport(*dep_location, airport_info)
-        arr_airport = find_nearest_airport(*arr_location, airport_info)
-        if dep_airport == arr_airport:
+    for xid in conn.tpc_recover():
+        if xid.database != conn.info.dbname or not (xid.gtrid or "").startswith(SHARD_XID_PREFIX):
             continue
-
-        curs.execute("SELECT airport_id FROM airport WHERE iata = %s", (dep_airport,))
-        dep_airport_id = curs.fetchall()[0]["airport_id"]
-        curs.execute("SELECT airport_id FROM airport WHERE iata = %s", (arr_airport,))
-        arr_airport_id = curs.fetchall()[0]["airport_id"]
-
-        curs.execute("""SELECT code FROM model JOIN aircraft ON model.model_id = aircraft.model_id
-                     WHERE aircraft.tail_number = %s""", (tail_number,))
-        aircraft_model = curs.fetchall()
-        if aircraft_model:
-            aircraft_model = aircraft_model[0]["code"]
-            fuel_usage = calculate_fuel_consumption(dep_time, arr_time, aircraft_model, aircraft_info)
-        else:
-            fuel_usage = None
-
-        if not emergency:
-            emergency = "none"
-        curs.execute("SELECT emergency_id FROM emergency WHERE type = %s", (emergency,))
-        emergency_id = curs.fetchall()
-        if not emergency_id:
-            curs.execute("INSERT INTO emergency (type) VALUES (%s) RETURNING emergency_id", (emergency,))
-            emergency_id = curs.fetchall()[0]["emergency_id"]
+        if xid.gtrid.removeprefix(SHARD_XID_PREFIX) in committed_runs:
+            conn.tpc_commit(xid)
         else:
-            emergency_id = emergency_id[0]["emergency_id"]
+            conn.tpc_rollback(xid)
+
+    curs.execute("DELETE FROM transform_commit")
+    conn.commit()
+    curs.close()
 
-        curs.execute("""INSERT INTO flight (flight_number, dep_airport_id, arr_airport_id, dep_time, arr_time, tail_number,
-                     emergency_id, fuel_usage) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                     (flight_no, dep_airport_id, arr_airport_id, dep_time, arr_time, tail_number, emergency_id, fuel_usage))
 
+def insert_flights_in_parallel(conn: connection, flights: list[tuple], workers: int) -> None:
+    """Coordinator: splits the flights into shards by tail number, which a process pool inserts on a
+    connection each, and commits the shards together with the open-flight state of the connection given,
+    by two-phase commit. The shards are prepared first, then the coordinator's commit (which records the
+    run's commit too) decides the run, then the shards are committed. If the coordinator dies in between,
+    resolve_prepared_shards finishes them on the next run. Expects the connection flights were extracted with."""
+
+    run_id = uuid4().hex
+    shards = [[] for _ in range(workers)]
+    for flight in flights:
+        shards[get_flight_shard(flight[0], workers)].append(flight)
+    shards = {str(shard): shard_flights for shard, shard_flights in enumerate(shards) if shard_flights}
+
+    # The workers only read the dimensions, so the new emergency types are added and committed first
+    dimensions_conn = get_db_connection(f"{PRODUCTION_SCHEMA},{STAGING_SCHEMA}")
+    insert_emergencies(dimensions_conn.cursor(cursor_factory=RealDictCursor), flights)
+    dimensions_conn.commit()
+    dimensions_conn.close()
+
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards)), initializer=load_worker_reference) as executor:
+            prepared = list(executor.map(insert_flight_shard, [SHARD_XID_PREFIX + run_id] * len(shards),
+                                         shards.keys(), shards.values()))
+    except Exception:
+        conn.rollback()
+        resolve_prepared_shards(conn)
+        raise
+
+    curs = conn.cursor()
+    curs.execute("INSERT INTO transform_commit (run_id) VALUES (%s)", (run_id,))
+    conn.commit()
+    for gtrid, bqual in prepared:
+        conn.tpc_commit(conn.xid(0, gtrid, bqual))
+    curs.execute("DELETE FROM transform_commit WHERE run_id = %s", (run_id,))
+    conn.commit()
     curs.close()
+    print(f"Committed {len(flights)} flights from {len(prepared)} shards")
 
 
-def handler(event = None, context = None) -> None:
-    """AWS lambda handler function that loads in json data, reads from the staging db and
-    inserts flights, airports and owners into production db."""
+def insert_todays_flights(prod_conn: connection, stage_conn: connection, airport_index: AirportIndex,
+                          aircraft_info: dict[dict], workers: int = 1) -> bool:
+    """Inserts the flights ended by the next chunk of staged events into the database. With more than one
+    worker they are inserted by a process pool, sharded by tail number, and committed here. Expects a
+    production connection object, and a staging one (which may be the same). Returns whether staging
+    has been drained up to the horizon."""
 
-    # Load data sets from S3
-    airport_data = clean_airport_data(load_json_file_from_s3(AIRPORTS_JSON, S3_BUCKET_NAME))
-    aircraft_data = load_json_file_from_s3(AIRCRAFTS_JSON, S3_BUCKET_NAME)
-    jet_owners_data = load_json_file_from_s3(JET_OWNERS_JSON, S3_BUCKET_NAME)
+    flights, drained = extract_todays_flights(stage_conn)
+    if not flights:
+        return drained
 
-    # Establish db connections
-    staging_conn = get_db_connection(STAGING_SCHEMA)
-    production_conn = get_db_connection(PRODUCTION_SCHEMA)
+    if workers > 1:
+        insert_flights_in_parallel(stage_conn, flights, workers)
+    else:
+        insert_flights(prod_conn, flights, airport_index, aircraft_info)
+    return drained
 
-    # Insert airport data if it's not already there
-    insert_airport_info(production_conn, airport_data)
 
-    # Insert jet owner data if it's not already there or if it's been updated
-    insert_jet_owner_info(production_conn, aircraft_data, jet_owners_data)
+def has_time_for_chunk(context, chunk_seconds: float) -> bool:
+    """Whether the invocation has time left for another chunk as long as the last one, keeping the reserve
+    to wrap up in. Always true when not run by lambda. Expects the lambda context (or None)."""
 
-    # Insert all completed flights from past 24 hours
-    insert_todays_flights(production_conn, staging_conn, airport_data, aircraft_data)
+    if context is None:
+        return True
+    return context.get_remaining_time_in_millis() / 1000 > chunk_seconds + TRANSFORM_TIME_RESERVE
 
-    # Commit changes to the dbs
-    production_conn.commit()
-    staging_conn.commit()
 
-    # Close the db connections
-    production_conn.close()
-    staging_conn.close()
+def continue_transform(context) -> None:
+    """Invokes this lambda again without waiting on it, so it carries on from the last checkpoint."""
+
+    boto3.client("lambda").invoke(FunctionName=context.function_name, InvocationType="Event",
+                                  Payload=json.dumps({"resume": True}))
+
+
+def handler(event = None, context = None) -> None:
+    """AWS lambda handler function that loads in json data, reads from the staging db and
+    inserts flights, airports and owners into production db. Runs on a schedule, and whenever
+    extract spots landings (with an event of {"landings": n}), and again by itself while a backlog of
+    staged events is left (with an event of {"resume": true})."""
+
+    if event and event.get("landings"):
+        print(f"Materializing the flights of {event['landings']} landings")
+
+    # Load the reference data sets from their snapshot in S3 (or a local data directory), cached in /tmp
+    reference = load_reference_data(config)
+
+    # Establish a db connection seeing both schemas, so that flights are inserted into production
+    # and the open flights they closed saved in staging in the same transaction
+    conn = get_db_connection(f"{PRODUCTION_SCHEMA},{STAGING_SCHEMA}")
+
+    # Runs take turns, as a parallel run commits its flight shards after its own transaction, and the
+    # shards of a run that died are finished before anything else
+    lock_name = f"{STAGING_SCHEMA}.transform_commit"
+    conn.cursor().execute("SELECT pg_advisory_lock(hashtext(%s))", (lock_name,))
+    conn.commit()
+    try:
+        resolve_prepared_shards(conn)
+
+        # Insert airport data unless it's been loaded from this version of the airports file already
+        insert_airport_info(conn, reference.get_airport_info(), reference.sources.get(AIRPORTS_JSON))
+
+        # Insert jet owner data if it's not already there or if it's been updated
+        insert_jet_owner_info(conn, reference.aircraft_info, reference.owner_info)
+
+        # Commit the reference data, so that the workers of a parallel run see it
+        conn.commit()
+
+        # Insert the completed flights a chunk of staged events at a time, committing each chunk with the
+        # watermark and open flights it leaves, so a run that runs out of time keeps the chunks it finished
+        drained, chunk_seconds = False, 0
+        while not drained and has_time_for_chunk(context, chunk_seconds):
+            chunk_started = time.perf_counter()
+            drained = insert_todays_flights(conn, conn, reference.airport_index, reference.aircraft_info,
+                                            TRANSFORM_WORKERS)
+            conn.commit()
+            chunk_seconds = time.perf_counter() - chunk_started
+
+        # Drop the staging partitions that have been fully processed, in a short transaction of its own
+        # as dropping a partition locks the whole staging table
+        drop_processed_partitions(conn)
+        conn.commit()
+    finally:
+        # Give the lock back and close the db connection even if the run failed (a connection that was
+        # lost has released the lock already)
+        try:
+            conn.rollback()
+            conn.cursor().execute("SELECT pg_advisory_unlock(hashtext(%s))", (lock_name,))
+            conn.commit()
+        except psycopg2.Error as err:
+            print(f"Couldn't release the transform lock: {err}")
+        conn.close()
+
+    # Leave the rest of a backlog to a fresh invocation, which resumes from the last committed chunk
+    if not drained:
+        print("Out of time with staged events left, continuing in a new invocation")
+        continue_transform(context)
 
 
 if __name__ == "__main__":
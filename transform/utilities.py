@@ -1,21 +1,39 @@
 """This module contains utility function for calculating the fuel consumption of an aircraft, calculating
-Haversine distances and finding nearest airports based on longitude and latitude."""
-from math import sin, cos, acos, pi
-from datetime import datetime
+Haversine distances and finding nearest airports based on longitude and latitude, one location at a
+time or for whole arrays of them."""
+from math import sin, cos, asin, sqrt, pi
+from datetime import datetime, timedelta
+import heapq
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+# Subtrees of the airport index with up to this many airports are checked whole by AirportIndex.nearest_many
+LEAF_SIZE = 16
 
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculates distance in km between two locations. The latitudes and longitudes are 
-    converted to radians and the distance is calculated using the Haversine formula. 
-    r is the radius of the earth. Expects floats and returns a float."""
+    converted to radians and the distance is calculated using the Haversine formula, which
+    (unlike the acos of the spherical law of cosines) stays accurate for tiny distances.
+    Expects floats and returns a float."""
 
-    earth_radius = 6371
     lat1_rad = lat1 * pi/180
     lat2_rad = lat2 * pi/180
     lon1_rad = lon1 * pi/180
     lon2_rad = lon2 * pi/180
 
-    return acos(sin(lat1_rad)*sin(lat2_rad) + cos(lat1_rad)*cos(lat2_rad)*cos(lon2_rad-lon1_rad)) * earth_radius
+    hav = sin((lat2_rad-lat1_rad)/2)**2 + cos(lat1_rad)*cos(lat2_rad)*sin((lon2_rad-lon1_rad)/2)**2
+    return 2 * asin(sqrt(min(1.0, hav))) * EARTH_RADIUS_KM
+
+
+def haversine_distances(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Calculates the distances in km between arrays of locations, element by element, with the
+    same formula as haversine_distance. Expects arrays (or floats) of degrees and returns an array."""
+
+    lat1_rad, lon1_rad, lat2_rad, lon2_rad = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+
+    hav = np.sin((lat2_rad-lat1_rad)/2)**2 + np.cos(lat1_rad)*np.cos(lat2_rad)*np.sin((lon2_rad-lon1_rad)/2)**2
+    return 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))) * EARTH_RADIUS_KM
 
 
 def clean_airport_data(airport_info: list[dict]) -> dict[dict]:
@@ -34,14 +52,219 @@ def find_nearest_airport(lat: float, lon: float, airport_info: list[dict]) -> st
                   key=lambda x: haversine_distance(float(x[1]["lat"]), float(x[1]["lon"]), lat, lon))[0][0]
 
 
+def to_unit_vector(lat: float, lon: float) -> tuple[float, float, float]:
+    """Converts a latitude and longitude in degrees to a point on the unit sphere. The straight
+    line (chord) distance between two such points grows with their great-circle distance, so
+    the nearest point by one is the nearest by the other. Expects floats and returns a tuple."""
+
+    lat_rad = lat * pi/180
+    lon_rad = lon * pi/180
+    return (cos(lat_rad)*cos(lon_rad), cos(lat_rad)*sin(lon_rad), sin(lat_rad))
+
+
+def to_unit_vectors(lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Converts arrays of latitudes and longitudes in degrees to the x, y and z arrays of their
+    points on the unit sphere, as to_unit_vector does for a single location."""
+
+    lats_rad, lons_rad = np.radians(lats), np.radians(lons)
+    return np.cos(lats_rad)*np.cos(lons_rad), np.cos(lats_rad)*np.sin(lons_rad), np.sin(lats_rad)
+
+
+def find_flight_airports(dep_lats: np.ndarray, dep_lons: np.ndarray, arr_lats: np.ndarray, arr_lons: np.ndarray,
+                         airport_index: "AirportIndex") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Resolves the departure and arrival airports of a batch of flights (e.g. a whole day's) in one
+    call. Expects arrays of the departure and arrival coordinates and an AirportIndex. Returns arrays
+    of the departure IATA codes, the arrival IATA codes and the flight distances in km."""
+
+    n_flights = len(dep_lats)
+    iatas, _ = airport_index.nearest_many(np.concatenate([dep_lats, arr_lats]), np.concatenate([dep_lons, arr_lons]))
+    return iatas[:n_flights], iatas[n_flights:], haversine_distances(dep_lats, dep_lons, arr_lats, arr_lons)
+
+
+class AirportIndex():
+    """KD-tree of airports over their positions on the unit sphere, built once per run and giving
+    the same airports as find_nearest_airport in logarithmic time, one location at a time or for a
+    whole batch. The tree is kept implicitly in flat lists, and as arrays for the batch lookups: the
+    node of a slice [lo, hi) is at its middle, with its subtrees either side."""
+
+    def __init__(self, airport_info: dict[dict]) -> None:
+        self.setup(list(airport_info), np.array([float(airport["lat"]) for airport in airport_info.values()]),
+                   np.array([float(airport["lon"]) for airport in airport_info.values()]))
+        self.get_tree()
+
+    @classmethod
+    def from_arrays(cls, iatas: list[str], lats: np.ndarray, lons: np.ndarray, vectors: np.ndarray,
+                    tree_orders: np.ndarray, tree_axes: np.ndarray) -> "AirportIndex":
+        """Recreates an index from the arrays stored in a reference data snapshot, using them as they
+        are. Expects the IATA codes, coordinates and unit vectors in listing order, and the tree_orders
+        and tree_axes of the index the snapshot was made from. The batch lookups search these arrays
+        as they are, and the tree is only unpacked into lists the first time a single lookup needs it."""
+
+        airport_index = cls.__new__(cls)
+        airport_index.setup(iatas, lats, lons, vectors)
+        airport_index.tree_arrays = (tree_orders, tree_axes)
+        return airport_index
+
+    def setup(self, iatas: list[str], lats: np.ndarray, lons: np.ndarray, vectors: np.ndarray = None) -> None:
+        """Sets up the batch lookups over airports given in listing order, with their unit vectors
+        worked out unless they are given. The tree is left to be built or unpacked."""
+
+        self.iatas = iatas
+        self.iata_array = np.array(self.iatas, dtype=object)
+        self.lats, self.lons = lats, lons
+        self.vectors = np.column_stack(to_unit_vectors(lats, lons)) if vectors is None else vectors
+        self.points = self.orders = self.axes = self.tree_arrays = self.tree_vectors = None
+
+    def get_tree(self) -> tuple[list, list, list]:
+        """The points, listing orders and split axes of the tree's nodes, building the tree (or unpacking
+        the one loaded from a snapshot) on first use."""
+
+        if self.points is None:
+            lat_list, lon_list = self.lats.tolist(), self.lons.tolist()
+            if self.tree_arrays is None:
+                points = [(to_unit_vector(lat, lon), order) for order, (lat, lon) in enumerate(zip(lat_list, lon_list))]
+                self.points = [None] * len(points)
+                self.orders = [0] * len(points)
+                self.axes = [0] * len(points)
+                self.build(points, 0, len(points))
+            else:
+                self.orders = self.tree_arrays[0].tolist()
+                self.axes = self.tree_arrays[1].tolist()
+                self.points = [to_unit_vector(lat_list[order], lon_list[order]) for order in self.orders]
+        return self.points, self.orders, self.axes
+
+    def get_tree_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The listing orders, split axes and unit vectors of the tree's nodes as arrays, for searching
+        many locations at once. The tree is built on first use, unless it was loaded from a snapshot."""
+
+        if self.tree_arrays is None:
+            _, orders, axes = self.get_tree()
+            self.tree_arrays = (np.array(orders, dtype="<i4"), np.array(axes, dtype="i1"))
+        if self.tree_vectors is None:
+            self.tree_vectors = self.vectors[self.tree_arrays[0]]
+        return *self.tree_arrays, self.tree_vectors
+
+    def build(self, points: list[tuple], lo: int, hi: int) -> None:
+        """Places the points of the slice [lo, hi), split on their axis of greatest spread."""
+
+        if lo >= hi:
+            return
+        part = points[lo:hi]
+        axis = max(range(3), key=lambda i: max(p[0][i] for p in part) - min(p[0][i] for p in part))
+        part.sort(key=lambda p: p[0][axis])
+        points[lo:hi] = part
+
+        mid = (lo + hi) // 2
+        self.points[mid], self.orders[mid] = points[mid]
+        self.axes[mid] = axis
+        self.build(points, lo, mid)
+        self.build(points, mid + 1, hi)
+
+    def search(self, target: tuple, lo: int, hi: int, heap: list, k: int) -> None:
+        """Adds the nearest points of the slice [lo, hi) to a max-heap of the k nearest so far,
+        skipping subtrees that can't hold anything nearer."""
+
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        point = self.points[mid]
+        distance = (point[0]-target[0])**2 + (point[1]-target[1])**2 + (point[2]-target[2])**2
+        # ties go to the airport listed first, like the stable sort in find_nearest_airport
+        entry = (-distance, -self.orders[mid])
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+        offset = target[self.axes[mid]] - point[self.axes[mid]]
+        near, far = ((lo, mid), (mid + 1, hi)) if offset < 0 else ((mid + 1, hi), (lo, mid))
+        self.search(target, *near, heap, k)
+        if len(heap) < k or offset**2 <= -heap[0][0]:
+            self.search(target, *far, heap, k)
+
+    def k_nearest(self, lat: float, lon: float, k: int) -> list[str]:
+        """Finds the k closest airports to a latitude and longitude. Returns their IATA codes,
+        closest first."""
+
+        heap = []
+        self.get_tree()
+        self.search(to_unit_vector(lat, lon), 0, len(self.points), heap, k)
+        return [self.iatas[-order] for _, order in sorted(heap, reverse=True)]
+
+    def nearest(self, lat: float, lon: float) -> str:
+        """Finds the closest airport to a latitude and longitude and returns its IATA code."""
+
+        return self.k_nearest(lat, lon, 1)[0]
+
+    def visit_many(self, targets: np.ndarray, locations: np.ndarray, nodes: np.ndarray,
+                   best: tuple[np.ndarray, np.ndarray]) -> None:
+        """Checks the airports at some nodes of the tree against the locations searching them, keeping
+        each location's nearest so far in best (its squared chord distances and listing orders). Ties go
+        to the airport listed first, as in search."""
+
+        orders, _, vectors = self.get_tree_arrays()
+        offsets = vectors[nodes] - targets[locations]
+        distances = offsets[:, 0]**2 + offsets[:, 1]**2 + offsets[:, 2]**2
+        best_distances, best_orders = best
+
+        previous = best_distances[locations]
+        np.minimum.at(best_distances, locations, distances)
+        best_orders[locations[best_distances[locations] < previous]] = len(orders)
+        tied = distances == best_distances[locations]
+        np.minimum.at(best_orders, locations[tied], orders[nodes[tied]])
+
+    def nearest_many(self, lats: np.ndarray, lons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Finds the closest airport to each of an array of locations at once, searching the tree for
+        all of them together a level at a time, down to subtrees of up to LEAF_SIZE airports that are
+        checked whole. Each location first walks down its side of every split to a leaf, which bounds
+        how far its nearest airport can be, and then only the subtrees within that bound are searched.
+        Returns arrays of IATA codes and of the distances in km to those airports, None and NaN for
+        locations missing a coordinate."""
+
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        targets = np.column_stack(to_unit_vectors(lats, lons))
+        _, axes, vectors = self.get_tree_arrays()
+        n_airports = len(self.iatas)
+        best = (np.full(len(lats), np.inf), np.full(len(lats), n_airports))
+        missing = np.isnan(lats) | np.isnan(lons)
+
+        for bounded in (False, True):
+            locations = np.flatnonzero(~missing)
+            lo, hi = np.zeros(len(locations), dtype=int), np.full(len(locations), n_airports)
+            while locations.size:
+                leaf = hi - lo <= LEAF_SIZE
+                nodes = lo[leaf, None] + np.arange(LEAF_SIZE)
+                in_leaf = nodes < hi[leaf, None]
+                self.visit_many(targets, np.repeat(locations[leaf], in_leaf.sum(axis=1)), nodes[in_leaf], best)
+                locations, lo, hi = locations[~leaf], lo[~leaf], hi[~leaf]
+
+                mid = (lo + hi) // 2
+                self.visit_many(targets, locations, mid, best)
+                offsets = targets[locations, axes[mid]] - vectors[mid, axes[mid]]
+                left = offsets < 0
+                near_lo, near_hi = np.where(left, lo, mid + 1), np.where(left, mid, hi)
+                if bounded:
+                    far = offsets**2 <= best[0][locations]
+                    locations = np.concatenate([locations, locations[far]])
+                    near_lo = np.concatenate([near_lo, np.where(left, mid + 1, lo)[far]])
+                    near_hi = np.concatenate([near_hi, np.where(left, hi, mid)[far]])
+                searched = near_lo < near_hi
+                locations, lo, hi = locations[searched], near_lo[searched], near_hi[searched]
+
+        nearest = np.where(missing, 0, best[1])
+        return (np.where(missing, None, self.iata_array[nearest]),
+                haversine_distances(lats, lons, self.lats[nearest], self.lons[nearest]))
+
+
 def calculate_fuel_consumption(dep_time: datetime, arr_time: datetime, aircraft_model: str,
                                aircraft_info: dict[dict]) -> float:
     """Calculates fuel consumption by multiplying the flight duration in hours by the estimated 
     fuel consumption of the aircraft. Returns this as a float in gallons (galph = gallons per hour). 
-    Expects departure/arrival times as datetimes, the aircraft model code and aircraft info.
+    Expects departure/arrival times as datetimes, the aircraft model code and aircraft info. This is the
+    single flight version of emissions.calculate_flight_emissions.
     """
 
-    flight_duration_hours = (arr_time - dep_time).seconds / 60**2
+    flight_duration_hours = ((arr_time - dep_time) // timedelta(seconds=1)) / 60**2
     fuel_consumption_rate = aircraft_info[aircraft_model]["galph"]
 
     return flight_duration_hours * fuel_consumption_rate